@@ -0,0 +1,287 @@
+"""
+Benchmark file formats and codecs for storing profile data
+
+For each data level, write and read representative profiles (real files or
+synthetic profiles of the same shape) in every candidate format and record write
+and read throughput, file size, and round-trip precision.
+"""
+
+import sys
+import time
+import zlib
+import struct
+import pathlib
+import argparse
+import tempfile
+import importlib.util
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "utils"))
+from schema import get_schema, numeric_metadata, read_profiles, split_columns
+from store import write_store, load_store
+
+# Shapes of a single plate (levels 3-4b) and of a batch-level consensus (level 5)
+synthetic_shapes = {
+    "level_3": (384, 1783),
+    "level_4a": (384, 1783),
+    "level_4b": (384, 600),
+    "level_5": (10000, 1783),
+}
+
+has_pyarrow = importlib.util.find_spec("pyarrow") is not None
+has_zstandard = importlib.util.find_spec("zstandard") is not None
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        nargs="+",
+        default=[],
+        help="profile files to benchmark, formatted as <level>=<path>",
+    )
+    parser.add_argument(
+        "-s",
+        "--synthetic",
+        action="store_true",
+        help="benchmark synthetic profiles for every data level",
+    )
+    parser.add_argument(
+        "-r", "--repeats", type=int, default=3, help="timing repeats per format"
+    )
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        default="results/format_benchmark.tsv",
+        help="where to write the results table",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def make_synthetic_profiles(level, seed=1234):
+    n_rows, n_features = synthetic_shapes[level]
+    rng = np.random.default_rng(seed)
+
+    # Level 3 profiles are raw CellProfiler measurements, later levels are z-scores
+    if level == "level_3":
+        values = rng.lognormal(mean=2, sigma=2, size=(n_rows, n_features))
+    else:
+        values = rng.standard_t(df=5, size=(n_rows, n_features))
+
+    features = [f"Cells_Feature_{x}" for x in range(n_features)]
+    profile_df = pd.DataFrame(values, columns=features)
+
+    # Fill the metadata each data level is expected to carry
+    for position, col in enumerate(get_schema(level)["metadata"]):
+        if col in numeric_metadata:
+            metadata_values = rng.integers(0, 8, size=n_rows)
+        else:
+            metadata_values = [f"{col}_{x % 97}" for x in range(n_rows)]
+        profile_df.insert(position, col, metadata_values)
+
+    return profile_df
+
+
+def write_bgzf_block(bgzf_fh, block):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(block) + compressor.flush()
+    bgzf_fh.write(
+        b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+        + struct.pack("<H", len(deflated) + 25)
+        + deflated
+        + struct.pack("<II", zlib.crc32(block), len(block))
+    )
+
+
+def write_bgzf(text, output_file, block_size=65280):
+    # Blocked gzip: independent gzip members carrying their size in an extra field,
+    # terminated by an empty block
+    data = text.encode()
+    with open(output_file, "wb") as bgzf_fh:
+        for start in range(0, len(data), block_size):
+            write_bgzf_block(bgzf_fh, data[start : start + block_size])
+        write_bgzf_block(bgzf_fh, b"")
+
+
+def csv_writer(float_format, compression, float_dtype=None):
+    def write(profile_df, output_file):
+        if float_dtype is not None:
+            _, features = split_columns(profile_df.columns)
+            profile_df = profile_df.astype({x: float_dtype for x in features})
+        profile_df.to_csv(
+            output_file,
+            index=False,
+            float_format=float_format,
+            compression=compression,
+        )
+
+    return write
+
+
+def bgzf_write(profile_df, output_file):
+    write_bgzf(profile_df.to_csv(index=False, float_format="%.5g"), output_file)
+
+
+def csv_read(output_file, level):
+    return read_profiles(output_file, level=level)
+
+
+def bgzf_read(output_file, level):
+    return read_profiles(output_file, level=level, compression="gzip")
+
+
+def parquet_writer(codec, float_dtype):
+    def write(profile_df, output_file):
+        _, features = split_columns(profile_df.columns)
+        profile_df.astype({x: float_dtype for x in features}).to_parquet(
+            output_file, compression=codec, index=False
+        )
+
+    return write
+
+
+def parquet_read(output_file, level):
+    return pd.read_parquet(output_file)
+
+
+def npy_write(profile_df, output_file):
+    write_store(profile_df, output_file, dtype=np.float32)
+
+
+def npy_read(output_file, level):
+    return load_store(output_file).to_frame()
+
+
+def get_candidates():
+    gzip_options = {"method": "gzip", "mtime": 1}
+    candidates = {
+        "csv_5g_gzip": (csv_writer("%.5g", gzip_options), csv_read, ".csv.gz"),
+        "csv_float32_gzip": (
+            csv_writer("%.9g", gzip_options, float_dtype=np.float32),
+            csv_read,
+            ".csv.gz",
+        ),
+        "csv_5g_gzip_level1": (
+            csv_writer("%.5g", dict(gzip_options, compresslevel=1)),
+            csv_read,
+            ".csv.gz",
+        ),
+        "csv_5g_bgzf": (bgzf_write, bgzf_read, ".csv.gz"),
+        "npy_float32_store": (npy_write, npy_read, ""),
+    }
+
+    if has_zstandard:
+        candidates["csv_5g_zstd"] = (
+            csv_writer("%.5g", {"method": "zstd"}),
+            csv_read,
+            ".csv.zst",
+        )
+
+    if has_pyarrow:
+        for codec in ["snappy", "zstd", "gzip", None]:
+            for float_dtype in ["float32", "float64"]:
+                candidates[f"parquet_{codec}_{float_dtype}".lower()] = (
+                    parquet_writer(codec, float_dtype),
+                    parquet_read,
+                    ".parquet",
+                )
+
+    return candidates
+
+
+def get_size(output_file):
+    output_file = pathlib.Path(output_file)
+    if output_file.is_dir():
+        return sum(x.stat().st_size for x in output_file.iterdir())
+    return output_file.stat().st_size
+
+
+def time_call(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def benchmark_profiles(profile_df, level, candidates, repeats, tmp_dir):
+    _, features = split_columns(profile_df.columns)
+    reference = profile_df.loc[:, features].to_numpy(dtype=np.float64)
+    in_memory_mb = reference.nbytes / 1e6
+
+    results = []
+    for name, (write_func, read_func, extension) in candidates.items():
+        output_file = pathlib.Path(tmp_dir, f"{level}_{name}{extension}")
+
+        write_seconds, _ = time_call(
+            lambda: write_func(profile_df, output_file), repeats
+        )
+        read_seconds, read_df = time_call(
+            lambda: read_func(output_file, level), repeats
+        )
+
+        round_trip = read_df.loc[:, features].to_numpy(dtype=np.float64)
+        abs_error = np.abs(round_trip - reference)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rel_error = np.where(reference != 0, abs_error / np.abs(reference), 0)
+
+        results.append(
+            {
+                "level": level,
+                "format": name,
+                "n_rows": profile_df.shape[0],
+                "n_features": len(features),
+                "size_mb": get_size(output_file) / 1e6,
+                "compression_ratio": in_memory_mb * 1e6 / get_size(output_file),
+                "write_seconds": write_seconds,
+                "read_seconds": read_seconds,
+                "write_mb_per_second": in_memory_mb / write_seconds,
+                "read_mb_per_second": in_memory_mb / read_seconds,
+                "max_abs_error": np.nanmax(abs_error),
+                "max_rel_error": np.nanmax(rel_error),
+            }
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    inputs = {}
+    for level_input in args.input:
+        level, profile_file = level_input.split("=", 1)
+        inputs[level] = read_profiles(
+            profile_file, level=level, feature_dtype=np.float64
+        )
+
+    if args.synthetic or len(inputs) == 0:
+        for level in synthetic_shapes:
+            inputs.setdefault(level, make_synthetic_profiles(level))
+
+    candidates = get_candidates()
+    if not has_pyarrow:
+        print("pyarrow is not installed, skipping parquet formats")
+    if not has_zstandard:
+        print("zstandard is not installed, skipping zstd compressed csv")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for level, profile_df in inputs.items():
+            print(f"Now benchmarking {level} {profile_df.shape}...")
+            results += benchmark_profiles(
+                profile_df, level, candidates, args.repeats, tmp_dir
+            )
+
+    results_df = pd.DataFrame(results)
+
+    output_file = pathlib.Path(args.output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    results_df.to_csv(output_file, sep="\t", index=False, float_format="%.5g")
+
+    print(results_df.to_string(index=False, float_format="{:.4g}".format))
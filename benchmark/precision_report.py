@@ -0,0 +1,197 @@
+"""
+Report how far float32 processing drifts from the float64 path
+
+Either compare two output trees (e.g. profiles processed with --precision float32
+against the float64 profiles) file by file, or run normalization, feature
+selection, consensus and spherize on synthetic plates in both precisions.
+"""
+
+import sys
+import pathlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from pycytominer import consensus
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "utils"))
+from feature_selection import feature_select
+from frame import ProfileFrame
+from normalization import normalize_frame
+from schema import build_dtypes, read_profile_columns, split_columns
+from spherize import spherize
+
+# Relative error at which values written with "%.5g" may start to differ
+output_rel_precision = 5e-5
+
+synthetic_shape = {"n_plates": 20, "n_features": 600, "n_latent": 60}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-r", "--reference_dir", help="directory of profiles processed in float64"
+    )
+    parser.add_argument(
+        "-t", "--test_dir", help="directory of the same profiles processed in float32"
+    )
+    parser.add_argument(
+        "-s",
+        "--synthetic",
+        action="store_true",
+        help="process synthetic plates in float64 and float32 and compare",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        default="results/precision_report.tsv",
+        help="where to write the results table",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def feature_mb(profile_df, features):
+    row_bytes = sum(profile_df[x].dtype.itemsize for x in features)
+    return profile_df.shape[0] * row_bytes / 1e6
+
+
+def compare_profiles(reference_df, test_df):
+    _, reference_features = split_columns(reference_df.columns)
+    _, test_features = split_columns(test_df.columns)
+    features = [x for x in reference_features if x in set(test_features)]
+
+    reference = reference_df.loc[:, features].to_numpy(dtype=np.float64)
+    test = test_df.loc[:, features].to_numpy(dtype=np.float64)
+    abs_error = np.abs(test - reference)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_error = np.where(reference != 0, abs_error / np.abs(reference), 0)
+
+    return {
+        "n_rows": reference_df.shape[0],
+        "n_features_reference": len(reference_features),
+        "n_features_test": len(test_features),
+        "n_features_differ": len(set(reference_features) ^ set(test_features)),
+        "max_abs_error": np.nanmax(abs_error, initial=0),
+        "max_rel_error": np.nanmax(rel_error, initial=0),
+        "rmse": np.sqrt(np.nanmean(abs_error**2)) if features else np.nan,
+        "frac_beyond_output_precision": np.nanmean(rel_error > output_rel_precision),
+        "reference_mb": feature_mb(reference_df, reference_features),
+        "test_mb": feature_mb(test_df, test_features),
+    }
+
+
+def read_float64(profile_file):
+    dtypes = build_dtypes(read_profile_columns(profile_file), feature_dtype=np.float64)
+    return pd.read_csv(profile_file, dtype=dtypes)
+
+
+def compare_dirs(reference_dir, test_dir):
+    results = []
+    for reference_file in sorted(pathlib.Path(reference_dir).rglob("*.csv.gz")):
+        relative_file = reference_file.relative_to(reference_dir)
+        test_file = pathlib.Path(test_dir, relative_file)
+        if not test_file.exists():
+            continue
+
+        result = {"file": str(relative_file)}
+        result.update(
+            compare_profiles(read_float64(reference_file), read_float64(test_file))
+        )
+        results.append(result)
+
+    return results
+
+
+def make_synthetic_plates(n_plates, n_features, n_latent, seed=1234):
+    rng = np.random.default_rng(seed)
+    n_rows = n_plates * 384
+
+    # Correlated features on different scales, with plate effects
+    loadings = rng.normal(size=(n_latent, n_features)) * (
+        rng.random((n_latent, n_features)) < 0.2
+    )
+    values = rng.normal(size=(n_rows, n_latent)) @ loadings
+    values += rng.normal(scale=0.5, size=(n_rows, n_features))
+    values = np.exp(values / values.std(axis=0) / 3) * rng.lognormal(
+        2, 2, size=n_features
+    )
+    values += np.repeat(rng.normal(scale=0.1, size=(n_plates, n_features)), 384, axis=0)
+
+    profile_df = pd.DataFrame(
+        values, columns=[f"Cells_Feature_{x}" for x in range(n_features)]
+    )
+    profile_df.insert(0, "Metadata_Plate", np.repeat(np.arange(n_plates), 384))
+    profile_df.insert(1, "Metadata_Well", np.tile(np.arange(384), n_plates))
+    profile_df.insert(
+        2,
+        "Metadata_broad_sample",
+        np.where(
+            np.tile(np.arange(384), n_plates) % 16 == 0,
+            "DMSO",
+            [f"BRD-{x % 320}" for x in np.tile(np.arange(384), n_plates)],
+        ),
+    )
+    return profile_df.astype({"Metadata_Plate": str, "Metadata_Well": str})
+
+
+def process_synthetic(profile_df, dtype):
+    # Normalize per plate, then process the batch as the notebooks do
+    normalized_dfs = []
+    for _, plate_df in profile_df.groupby("Metadata_Plate", sort=False):
+        plate_frame = ProfileFrame.from_pandas(plate_df, dtype=dtype)
+        normalized = normalize_frame(
+            plate_frame, samples={"dmso": "Metadata_broad_sample == 'DMSO'"}
+        )
+        normalized_dfs.append(normalized[("dmso", "mad_robustize")].to_pandas())
+    normalized_df = pd.concat(normalized_dfs, ignore_index=True)
+
+    selected_df = feature_select(
+        normalized_df,
+        operation=["variance_threshold", "correlation_threshold", "drop_na_columns"],
+        corr_threshold=0.9,
+    )
+
+    levels = {"level_4a": normalized_df, "level_4b": selected_df}
+    for operation in ["median", "modz"]:
+        levels[f"level_5_{operation}"] = consensus(
+            profiles=normalized_df,
+            replicate_columns=["Metadata_broad_sample"],
+            operation=operation,
+        )
+    levels["spherized"] = spherize(
+        selected_df, samples="Metadata_broad_sample == 'DMSO'"
+    )
+    return levels
+
+
+def compare_synthetic():
+    profile_df = make_synthetic_plates(**synthetic_shape)
+    reference_levels = process_synthetic(profile_df, dtype=np.float64)
+    test_levels = process_synthetic(profile_df, dtype=np.float32)
+
+    results = []
+    for level, reference_df in reference_levels.items():
+        result = {"file": f"synthetic_{level}"}
+        result.update(compare_profiles(reference_df, test_levels[level]))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    results = []
+    if args.reference_dir is not None and args.test_dir is not None:
+        results += compare_dirs(args.reference_dir, args.test_dir)
+    if args.synthetic or len(results) == 0:
+        results += compare_synthetic()
+
+    results_df = pd.DataFrame(results)
+
+    output_file = pathlib.Path(args.output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    results_df.to_csv(output_file, sep="\t", index=False, float_format="%.5g")
+
+    print(results_df.to_string(index=False, float_format="{:.4g}".format))
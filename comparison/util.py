@@ -1,9 +1,21 @@
+import sys
 import pathlib
 import numpy as np
 import pandas as pd
 
 from pycytominer.cyto_utils import infer_cp_features
 
+sys.path.append("../utils")
+from loader import iter_plates
+
+# Data level of the files compared at each comparison level
+schema_levels = {
+    "level_3": "level_3",
+    "level_4a": "level_4a",
+    "level_4b": "level_4b",
+    "pycytominer_select": "level_4b",
+}
+
 
 def build_file_dictionary(base_dir, tool="pycytominer"):
     file_match = {}
@@ -59,14 +71,14 @@ def load_data(
         raise KeyError(f"Data not found, skipping! {plate}: {level}")
 
     # Load data
-    pycyto_df = pd.read_csv(pycyto_file)
-    try:
-        cyto_df = pd.read_csv(cyto_file).drop(
-            ["Cytoplasm_Parent_Cells", "Cytoplasm_Parent_Nuclei"], axis="columns"
-        )
-    except KeyError:
-        cyto_df = pd.read_csv(cyto_file)
-        
+    pycyto_df, cyto_df = iter_plates(
+        [pycyto_file, cyto_file], read_kwargs={"level": schema_levels[level]}, n_jobs=2
+    )
+    cyto_df = cyto_df.drop(
+        ["Cytoplasm_Parent_Cells", "Cytoplasm_Parent_Nuclei"],
+        axis="columns",
+        errors="ignore",
+    )
 
     # Confirm metadata are aligned
     pd.testing.assert_series_equal(pycyto_df.loc[:, well_col], cyto_df.loc[:, well_col])
@@ -0,0 +1,359 @@
+"""
+Build the consensus signature grid on a process pool
+
+Each batch and plate normalization is staged once as a memory-mapped store (see
+utils/store.py), together with the replicate group index of each platemap, and
+every consensus operation (with and without feature selection) runs as its own
+task over that store. Workers map the same matrix and load the same group index
+rather than receiving pickled profiles or rebuilding the index, and each output
+file is written by a single task, so files are identical to the
+build-consensus-signatures notebook.
+
+The spherized grid (spherized_profiles/1.generate-consensus-spherized-profiles)
+is built with --grid spherized.
+
+Builds of the level_4a grid also write a state file per batch and plate
+normalization (the plates of each replicate group and their checksums), and the
+unrounded values of each consensus. With --update, only the groups of reprocessed,
+added or removed plates are recomputed and spliced into the existing outputs (see
+utils/consensus_update.py).
+"""
+
+import sys
+import shutil
+import numpy as np
+import pathlib
+import argparse
+import tempfile
+import concurrent.futures
+
+from pycytominer.cyto_utils import output
+
+sys.path.append("../utils")
+from consensus_builder import (
+    build_consensus,
+    iter_platemap_profiles,
+    iter_store_platemaps,
+    load_store_group_indexes,
+    prepare_profiles,
+    split_platemaps,
+    stage_platemap_profiles,
+)
+from consensus_update import (
+    get_membership,
+    get_plate_checksums,
+    get_selection_stats,
+    update_consensus,
+    write_state,
+    write_values,
+)
+from feature_selection import feature_select
+from schema import consensus_metadata, read_profiles, split_columns
+from store import load_store
+
+batches = ["2016_04_01_a549_48hr_batch1", "2017_12_05_Batch2"]
+operations = ["median", "modz"]
+replicate_cols = consensus_metadata
+
+feature_select_ops = [
+    "drop_na_columns",
+    "variance_threshold",
+    "correlation_threshold",
+    "blocklist",
+]
+
+float_format = "%5g"
+compression_options = {"method": "gzip", "mtime": 1}
+
+file_suffixes = {"whole_plate": ".csv.gz", "dmso": "_dmso.csv.gz"}
+
+spherized_dir = pathlib.Path("../spherized_profiles")
+spherized_string = "_dmso_spherized_profiles_with_input_normalized_by_"
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-g",
+        "--grid",
+        choices=["level_4a", "spherized"],
+        default="level_4a",
+        help="which consensus grid to build",
+    )
+    parser.add_argument(
+        "-b", "--batches", nargs="+", default=batches, help="batches to process"
+    )
+    parser.add_argument(
+        "-n",
+        "--normalizations",
+        nargs="+",
+        default=list(file_suffixes),
+        help="plate normalizations to process",
+    )
+    parser.add_argument(
+        "-o",
+        "--operations",
+        nargs="+",
+        default=operations,
+        help="consensus operations to process",
+    )
+    parser.add_argument(
+        "--blocklist_file",
+        default="../utils/consensus_blocklist.txt",
+        help="blocklist used in feature selection of the level_4a grid",
+    )
+    parser.add_argument(
+        "-q",
+        "--qc",
+        action="store_true",
+        help="also write the replicate QC table of each consensus output",
+    )
+    parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        help="only recompute the groups of changed plates of the level_4a grid",
+    )
+    parser.add_argument(
+        "-s",
+        "--store_dir",
+        default=None,
+        help="where to stage the memory-mapped inputs (default: temporary directory)",
+    )
+    parser.add_argument(
+        "-d",
+        "--precision",
+        default="float64",
+        choices=["float64", "float32"],
+        help="floating point precision of the staged profile features",
+    )
+    parser.add_argument(
+        "-j", "--n_jobs", type=int, default=None, help="consensus tasks run at once"
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def get_grid(args):
+    """Yield each input, its platemap profiles to stage, its consensus tasks and its
+    state file
+    """
+    feature_dtype = np.dtype(args.precision)
+    for batch in args.batches:
+        for norm_strat in args.normalizations:
+            if args.grid == "level_4a":
+                platemap_profiles = iter_platemap_profiles(
+                    batch=batch,
+                    level="level_4a",
+                    normalization=norm_strat,
+                    feature_dtype=feature_dtype,
+                )
+                output_dir = pathlib.Path(batch)
+                file_base = f"{batch}_consensus_"
+                file_suffix = file_suffixes[norm_strat]
+                blocklist_file = args.blocklist_file
+                state_file = pathlib.Path(output_dir, f"{file_base}state{file_suffix}")
+                values_suffix = file_suffix.replace(".csv.gz", ".npz")
+            else:
+                spherized_file = pathlib.Path(
+                    spherized_dir,
+                    "profiles",
+                    f"{batch}{spherized_string}{norm_strat}.csv.gz",
+                )
+                platemap_profiles = split_platemaps(
+                    read_profiles(
+                        spherized_file, level="spherized", feature_dtype=feature_dtype
+                    )
+                )
+                output_dir = pathlib.Path(spherized_dir, "consensus")
+                file_base = f"{batch}{spherized_string}{norm_strat}_consensus_"
+                file_suffix = ".csv.gz"
+                blocklist_file = None
+                state_file = None
+                values_suffix = None
+
+            # QC tables do not depend on the operation, so a single task writes
+            # them all, the MODZ task if there is one as it has the replicate weights
+            qc_files = {}
+            if args.qc:
+                qc_files = {
+                    x: pathlib.Path(output_dir, f"{file_base}{x}_qc{file_suffix}")
+                    for x in args.operations
+                }
+            qc_operation = "modz" if "modz" in args.operations else args.operations[0]
+
+            tasks = []
+            for operation in args.operations:
+                consensus_file = pathlib.Path(
+                    output_dir, f"{file_base}{operation}{file_suffix}"
+                )
+                feature_select_file = None
+                if blocklist_file is not None:
+                    feature_select_file = pathlib.Path(
+                        output_dir,
+                        f"{file_base}{operation}_feature_select{file_suffix}",
+                    )
+                values_file = None
+                if values_suffix is not None:
+                    values_file = pathlib.Path(
+                        output_dir, f"{file_base}{operation}_values{values_suffix}"
+                    )
+                tasks.append(
+                    {
+                        "operation": operation,
+                        "consensus_file": consensus_file,
+                        "feature_select_file": feature_select_file,
+                        "values_file": values_file,
+                        "blocklist_file": blocklist_file,
+                        "qc_files": qc_files if operation == qc_operation else {},
+                    }
+                )
+
+            yield (
+                (batch, norm_strat),
+                prepare_profiles(platemap_profiles, batch),
+                tasks,
+                state_file,
+            )
+
+
+def get_feature_select_args(blocklist_file, n_jobs=None):
+    return {
+        "operation": feature_select_ops,
+        "blocklist_file": blocklist_file,
+        "n_jobs": n_jobs,
+    }
+
+
+def run_update(batch, norm_strat, tasks, state_file):
+    changed_plates, n_groups = update_consensus(
+        batch,
+        norm_strat,
+        replicate_cols=replicate_cols,
+        operations=[x["operation"] for x in tasks],
+        consensus_files={x["operation"]: x["consensus_file"] for x in tasks},
+        state_file=state_file,
+        values_files={x["operation"]: x["values_file"] for x in tasks},
+        feature_select_args=get_feature_select_args(tasks[0]["blocklist_file"]),
+        feature_select_files={x["operation"]: x["feature_select_file"] for x in tasks},
+        qc_files={k: v for x in tasks for k, v in x["qc_files"].items()},
+        float_format=float_format,
+        compression_options=compression_options,
+    )
+    print(f"{batch} {norm_strat}: {len(changed_plates)} changed plates")
+    print(f"  Updated {n_groups} replicate groups")
+
+
+def run_consensus_task(
+    store_dir,
+    operation,
+    consensus_file,
+    feature_select_file,
+    blocklist_file,
+    values_file=None,
+    qc_files=None,
+):
+    store = load_store(store_dir)
+    group_indexes = load_store_group_indexes(store_dir)
+    pathlib.Path(consensus_file).parent.mkdir(parents=True, exist_ok=True)
+
+    consensus_df = build_consensus(
+        iter_store_platemaps(store),
+        replicate_cols=replicate_cols,
+        operations=[operation],
+        output_files={operation: consensus_file},
+        float_format=float_format,
+        compression_options=compression_options,
+        qc_files=qc_files,
+        group_indexes=group_indexes,
+    )[operation]
+
+    # Tasks already run in parallel, so feature selection stays on one thread
+    feature_select_args = get_feature_select_args(blocklist_file, n_jobs=1)
+    if feature_select_file is not None:
+        consensus_feat_df = feature_select(consensus_df, **feature_select_args)
+        output(
+            df=consensus_feat_df,
+            output_filename=feature_select_file,
+            sep=",",
+            float_format=float_format,
+            compression_options=compression_options,
+        )
+
+    if values_file is not None:
+        # Updates select features on the same values (see consensus_update.py)
+        corr_stats = None
+        if feature_select_file is not None:
+            _, features = split_columns(consensus_df.columns)
+            corr_stats = get_selection_stats(
+                consensus_df.loc[:, features].to_numpy(dtype=np.float64),
+                features,
+                feature_select_args,
+            )
+        write_values(consensus_df, values_file, corr_stats)
+
+    return consensus_file, consensus_df.shape
+
+
+def run_grid(grid, store_root, n_jobs=None, dtype=np.float64):
+    """Stage each input of the grid under store_root and run its consensus tasks on
+    a process pool of n_jobs workers, returning the written files and shapes
+    """
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = []
+
+        # Tasks of each input start as soon as it is staged
+        for (batch, norm_strat), platemap_profiles, tasks, state_file in grid:
+            store_dir = pathlib.Path(store_root, f"{batch}_{norm_strat}")
+            print(f"Staging {batch} {norm_strat}")
+            stage_platemap_profiles(
+                platemap_profiles,
+                store_dir,
+                replicate_cols=replicate_cols,
+                dtype=dtype,
+            )
+            for task in tasks:
+                futures.append(pool.submit(run_consensus_task, store_dir, **task))
+
+            if state_file is not None:
+                state_file.parent.mkdir(parents=True, exist_ok=True)
+                write_state(
+                    get_membership(
+                        load_store(store_dir).metadata, replicate_cols, float_format
+                    ),
+                    get_plate_checksums(batch, "level_4a", norm_strat),
+                    state_file,
+                )
+
+        for future in futures:
+            consensus_file, shape = future.result()
+            print(f"Written: {consensus_file} {shape}")
+            results.append((consensus_file, shape))
+
+    return results
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    if args.update:
+        assert args.grid == "level_4a", "Only the level_4a grid can be updated"
+        for (batch, norm_strat), _, tasks, state_file in get_grid(args):
+            if state_file.exists():
+                run_update(batch, norm_strat, tasks, state_file)
+            else:
+                print(f"{batch} {norm_strat}: no state file, build without --update")
+        sys.exit(0)
+
+    store_root = tempfile.mkdtemp(dir=args.store_dir)
+    try:
+        run_grid(
+            get_grid(args),
+            store_root,
+            n_jobs=args.n_jobs,
+            dtype=np.dtype(args.precision),
+        )
+    finally:
+        shutil.rmtree(store_root)
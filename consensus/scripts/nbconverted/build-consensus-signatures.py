@@ -23,27 +23,32 @@
 # 
 # We generate eight files per batch.
 
-# In[1]:
+# In[ ]:
 
 
 get_ipython().run_line_magic('load_ext', 'nb_black')
 
 
-# In[2]:
+# In[ ]:
 
 
 import os
+import sys
 import pathlib
 import numpy as np
 import pandas as pd
 
-from pycytominer import aggregate, feature_select
+from pycytominer import aggregate
 
-from pycytominer import consensus
-from pycytominer.cyto_utils import infer_cp_features, output
+from pycytominer.cyto_utils import output
 
+sys.path.append("../utils")
+from catalog import load_manifest
+from consensus_builder import build_consensus, iter_platemap_profiles, prepare_profiles
+from feature_selection import feature_select
 
-# In[3]:
+
+# In[ ]:
 
 
 # Set constants
@@ -72,6 +77,10 @@ feature_select_ops = [
     "blocklist",
 ]
 
+# Profiles are held in float64, set to np.float32 to halve memory (opt-in, see
+# benchmark/precision_report.py for how far float32 outputs drift)
+feature_dtype = np.float64
+
 # Output option
 float_format = "%5g"
 compression_options = {"method": "gzip", "mtime": 1}
@@ -84,7 +93,7 @@ outlier_blocklist_file = pathlib.Path("../utils/outlier_blocklist_features.txt")
 full_blocklist_file = pathlib.Path("../utils/consensus_blocklist.txt")
 
 
-# In[4]:
+# In[ ]:
 
 
 # Procees blocklist output
@@ -103,33 +112,18 @@ print(full_blocklist_df.shape)
 full_blocklist_df.to_csv(full_blocklist_file, sep=",", index=False)
 
 
-# In[5]:
+# In[ ]:
 
 
 # Set file information
 file_bases = {
-    "whole_plate": {
-        "input_file_suffix": "_normalized.csv.gz",
-        "output_file_suffix": ".csv.gz",
-    },
-    "dmso": {
-        "input_file_suffix": "_normalized_dmso.csv.gz",
-        "output_file_suffix": "_dmso.csv.gz",
-    },
+    "whole_plate": {"output_file_suffix": ".csv.gz"},
+    "dmso": {"output_file_suffix": "_dmso.csv.gz"},
 }
 
-file_path_info = {"profile_dir": {}, "plate_dirs": {}, "plates": {}}
+# Plates are resolved from the barcode platemap manifest
 for batch in batches:
-    file_path_info["profile_dir"][batch] = pathlib.Path("..", "profiles", batch)
-    file_path_info["plate_dirs"][batch] = [
-        x
-        for x in file_path_info["profile_dir"][batch].iterdir()
-        if x.name != ".DS_Store"
-    ]
-    file_path_info["plates"][batch] = [
-        x.name for x in file_path_info["plate_dirs"][batch]
-    ]
-    print(len(file_path_info["plates"][batch]))
+    print(load_manifest(batch).shape[0])
 
 # The output directory is also the batch name
 for batch in batches:
@@ -138,150 +132,64 @@ for batch in batches:
 
 # ## Load and Process Data
 # 
-# We load data per plate, concatenate, add make minor modifications.
+# Replicate groups never span platemaps (`Metadata_Plate_Map_Name` is a replicate column).
+# We therefore load the replicate plates of one platemap at a time, make minor modifications, and compute their consensus profiles.
 # 
-# We perform this operation once per batch.
-
-# In[6]:
-
-
-# Load Data
-all_profiles_dfs = {batch: {} for batch in batches}
-cp_features = {batch: {} for batch in batches}
-
-for batch in batches:
-    for norm_strat, norm_file_base in file_bases.items():
-        file_base = norm_file_base["input_file_suffix"]
-        all_profiles_df = []
-        for plate_dir in file_path_info["plate_dirs"][batch]:
-            plate = plate_dir.name
-            plate_file = plate_dir / f"{plate}{file_base}"
-            plate_df = pd.read_csv(plate_file)
-            all_profiles_df.append(plate_df)
-
-        # Concatenate profiles
-        all_profiles_df = pd.concat(all_profiles_df, axis="rows")
-
-        # Add time metadata for batch 1 data
-        if batch == "2016_04_01_a549_48hr_batch1":
-            all_profiles_df = all_profiles_df.assign(Metadata_time_point="48H")
-
-        # Recode missing MOA and target values to be "unknown"
-        all_profiles_df.Metadata_moa = all_profiles_df.Metadata_moa.fillna("unknown")
-        all_profiles_df.Metadata_target = all_profiles_df.Metadata_target.fillna(
-            "unknown"
-        )
-
-        # Store concatenated data frame
-        all_profiles_dfs[batch][norm_strat] = all_profiles_df
-
-        # Determine every CellProfiler feature measured
-        cp_features[batch][norm_strat] = infer_cp_features(
-            all_profiles_dfs[batch][norm_strat]
-        )
+# We perform this operation once per batch and plate normalization strategy.
 
-        # Clean up
-        print(all_profiles_df.shape)
-        del all_profiles_df
-
-
-# ## Create consensus profiles
+# ## Create and output consensus signatures
 # 
-# Create profiles with and without feature selection.
+# Consensus profiles of each platemap are appended to the output files as soon as they are computed.
+# We then perform feature selection on the consensus profiles of the full batch, which are much smaller than the profiles they aggregate.
 # 
 # We generate two different consensus profiles for each of the normalization strategies, with and without feature selection.
 # This generates eight different files _per batch_.
 
-# In[7]:
+# In[ ]:
 
 
-all_consensus_dfs = {batch: {} for batch in batches}
 for batch in batches:
     print(f"Now processing batch: {batch}")
     for norm_strat in file_bases:
-        all_profiles_df = all_profiles_dfs[batch][norm_strat]
-        cp_norm_features = cp_features[batch][norm_strat]
+        file_suffix = file_bases[norm_strat]["output_file_suffix"]
+        consensus_files = {
+            operation: pathlib.Path(batch, f"{batch}_consensus_{operation}{file_suffix}")
+            for operation in operations
+        }
+
+        # No feature selection
+        print(f"  Now calculating {operations} consensus for {norm_strat} normalization")
+        platemap_profiles = iter_platemap_profiles(
+            batch=batch,
+            level="level_4a",
+            normalization=norm_strat,
+            feature_dtype=feature_dtype,
+        )
+        consensus_dfs = build_consensus(
+            prepare_profiles(platemap_profiles, batch),
+            replicate_cols=replicate_cols,
+            operations=operations,
+            output_files=consensus_files,
+            float_format=float_format,
+            compression_options=compression_options,
+        )
 
-        consensus_profiles = {}
         for operation in operations:
+            consensus_df = consensus_dfs.pop(operation)
             print(
-                f"  Now calculating {operation} consensus for {norm_strat} normalization"
-            )
-
-            consensus_profiles[operation] = {}
-
-            consensus_profiles[operation]["no_feat_select"] = consensus(
-                profiles=all_profiles_df,
-                replicate_columns=replicate_cols,
-                operation=operation,
-                features=cp_norm_features,
-            )
-
-            # How many DMSO profiles per well?
-            print(
-                f"  There are {consensus_profiles[operation]['no_feat_select'].shape[0]} {operation} consensus profiles for {norm_strat} normalization"
+                f"  Written: Feature selection: No; Consensus Operation: {operation}; Norm Strategy: {norm_strat}"
             )
+            print(f"  File: {consensus_files[operation]}")
+            print(consensus_df.shape)
 
-            # Perform feature selection
-            print(
-                f"  Now feature selecting on {operation} consensus for {norm_strat} normalization"
-            )
-            consensus_profiles[operation]["feat_select"] = feature_select(
-                profiles=consensus_profiles[operation]["no_feat_select"],
+            # With feature selection
+            consensus_feat_df = feature_select(
+                profiles=consensus_df,
                 features="infer",
                 operation=feature_select_ops,
                 blocklist_file=full_blocklist_file,
             )
 
-            # How many features in feature selected profile?
-            print(
-                f"  There are {consensus_profiles[operation]['feat_select'].shape[1]} features in {operation} consensus profiles for {norm_strat} normalization"
-            )
-
-        all_consensus_dfs[batch][norm_strat] = consensus_profiles
-    print("\n")
-
-
-# ## Merge and output consensus signatures
-# 
-# Output with and without feature selection.
-
-# In[8]:
-
-
-for batch in batches:
-    print(f"Now processing batch: {batch}")
-    for norm_strat in file_bases:
-        file_suffix = file_bases[norm_strat]["output_file_suffix"]
-        for operation in operations:
-
-            # No feature selection
-            consensus_file = f"{batch}_consensus_{operation}{file_suffix}"
-            consensus_file = pathlib.Path(batch, consensus_file)
-
-            consensus_df = all_consensus_dfs[batch][norm_strat][operation][
-                "no_feat_select"
-            ]
-
-            print(
-                f"  Now Writing: Feature selection: No; Consensus Operation: {operation}; Norm Strategy: {norm_strat}"
-            )
-            print(f"  File: {consensus_file}")
-            print(consensus_df.shape)
-
-            output(
-                df=consensus_df,
-                output_filename=consensus_file,
-                sep=",",
-                float_format=float_format,
-                compression_options=compression_options,
-            )
-
-            # With feature selection
-            consensus_feat_df = all_consensus_dfs[batch][norm_strat][operation][
-                "feat_select"
-            ]
-
             consensus_feat_file = (
                 f"{batch}_consensus_{operation}_feature_select{file_suffix}"
             )
@@ -300,5 +208,6 @@ for batch in batches:
                 float_format=float_format,
                 compression_options=compression_options,
             )
+            del consensus_df, consensus_feat_df
     print("\n")
 
@@ -0,0 +1,109 @@
+"""
+Propose an outlier feature blocklist from the normalized profiles of a batch
+
+Streams over every level 4a plate of the batch once and writes per-feature
+evidence (extreme value fraction, max |z|, MAD collapse) and the proposed
+blocklist, in the format of utils/outlier_blocklist_features.txt, for review.
+"""
+
+import sys
+import pathlib
+import argparse
+import numpy as np
+
+sys.path.append("../utils")
+from catalog import get_plate_files
+from loader import iter_plates
+from outlier_features import (
+    accumulate_outlier_stats,
+    default_rules,
+    extreme_cutoff,
+    get_outlier_evidence,
+    mad_collapse_cutoff,
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-b",
+        "--batch",
+        default="2016_04_01_a549_48hr_batch1",
+        help="string indicating the batch name",
+    )
+    parser.add_argument(
+        "-n",
+        "--normalization",
+        default="dmso",
+        help="which level 4a normalization to scan",
+    )
+    parser.add_argument(
+        "-z",
+        "--extreme_cutoff",
+        type=float,
+        default=extreme_cutoff,
+        help="|z| beyond which a value is extreme",
+    )
+    parser.add_argument(
+        "-m",
+        "--mad_collapse_cutoff",
+        type=float,
+        default=mad_collapse_cutoff,
+        help="plate MAD below which a feature has collapsed",
+    )
+    for rule, cutoff in default_rules.items():
+        parser.add_argument(
+            f"--{rule}",
+            type=float,
+            default=cutoff,
+            help=f"propose features with {rule} above this value",
+        )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        default="outlier_features",
+        help="directory to save the evidence and proposed blocklist",
+    )
+    parser.add_argument(
+        "-j", "--n_jobs", type=int, default=None, help="plates read concurrently"
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+args = get_args()
+
+batch = args.batch
+rules = {rule: getattr(args, rule) for rule in default_rules}
+output_dir = pathlib.Path(args.output_dir)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+profile_files = get_plate_files(
+    batch, level="level_4a", normalization=args.normalization
+)
+plates = iter_plates(
+    profile_files,
+    read_kwargs={"level": "level_4a", "feature_dtype": np.float64},
+    n_jobs=args.n_jobs,
+)
+
+features, stats = accumulate_outlier_stats(
+    plates,
+    extreme_cutoff=args.extreme_cutoff,
+    mad_collapse_cutoff=args.mad_collapse_cutoff,
+)
+evidence_df = get_outlier_evidence(features, stats, rules=rules)
+
+evidence_file = pathlib.Path(
+    output_dir, f"{batch}_{args.normalization}_outlier_feature_evidence.tsv"
+)
+evidence_df.to_csv(evidence_file, sep="\t", index=False, float_format="%.5g")
+
+blocklist_file = pathlib.Path(
+    output_dir, f"{batch}_{args.normalization}_outlier_blocklist_features.txt"
+)
+blocklist = evidence_df.query("proposed").feature.tolist()
+blocklist_file.write_text("".join(f"{x}\n" for x in blocklist))
+
+print(f"Proposed {len(blocklist)} of {len(features)} features, see {evidence_file}")
@@ -0,0 +1,85 @@
+"""
+Normalize every plate of a batch against batch-wide reference statistics
+
+The first pass reduces mergeable statistics of the DMSO and whole plate profiles of
+each plate into a batch reference, the second pass normalizes and writes one plate
+at a time. Reads level 3 profiles and writes level 4a profiles next to them.
+"""
+
+import sys
+import argparse
+import numpy as np
+from pycytominer import cyto_utils
+
+sys.path.append("../utils")
+from batch_normalization import fit_batch_reference, normalize_plate, sketch_size
+from catalog import get_plate_file, get_plate_files, get_suffix
+from loader import iter_plates
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-b",
+        "--batch",
+        default="2016_04_01_a549_48hr_batch1",
+        help="string indicating the batch name",
+    )
+    parser.add_argument(
+        "-d",
+        "--precision",
+        default="float64",
+        choices=["float64", "float32"],
+        help="floating point precision to hold profile features in",
+    )
+    parser.add_argument(
+        "-k",
+        "--sketch_size",
+        type=int,
+        default=sketch_size,
+        help="points per feature kept to estimate batch quantiles",
+    )
+    parser.add_argument(
+        "-j", "--n_jobs", type=int, default=None, help="plates read concurrently"
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+args = get_args()
+
+batch = args.batch
+feature_dtype = np.dtype(args.precision)  # Default is float64
+
+norm_method = "mad_robustize"
+compression = {"method": "gzip", "mtime": 1}
+float_format = "%.5g"
+norm_samples = {"dmso": "Metadata_broad_sample == 'DMSO'", "whole_plate": "all"}
+
+profile_files = get_plate_files(batch, level="level_3", normalization="none")
+read_kwargs = {"level": "level_3", "feature_dtype": feature_dtype}
+
+# First pass - reduce plate statistics to the batch reference
+batch_reference = fit_batch_reference(
+    iter_plates(profile_files, read_kwargs=read_kwargs, n_jobs=args.n_jobs),
+    samples=norm_samples,
+    size=args.sketch_size,
+)
+
+# Second pass - normalize each plate against the batch reference - Level 4A Data
+plates = iter_plates(profile_files, read_kwargs=read_kwargs, n_jobs=args.n_jobs)
+for profile_file, plate_df in zip(profile_files, plates):
+    plate = profile_file.parent.name
+    print(f"Now normalizing... Plate: {plate}")
+
+    normalized = normalize_plate(plate_df, batch_reference, methods=[norm_method])
+    for norm_strat in norm_samples:
+        cyto_utils.output(
+            df=normalized[(norm_strat, norm_method)],
+            output_filename=get_plate_file(
+                batch, plate, get_suffix("level_4a", f"batch_{norm_strat}")
+            ),
+            float_format=float_format,
+            compression_options=compression,
+        )
@@ -5,14 +5,14 @@ Perform the image-based profiling pipeline to process data
 import os
 import sys
 import pathlib
-import pandas as pd
-from pycytominer import aggregate, annotate, normalize, feature_select, cyto_utils
-from pycytominer.cyto_utils.cells import SingleCells
+import numpy as np
 
 from profile_utils import get_args
 
 sys.path.append("../utils")
-from dose import recode_dose
+from annotation import load_platemap_annotation
+from dose import get_dose_ladder
+from pipeline import Pipeline
 
 
 # Load Command Line Arguments
@@ -29,10 +29,14 @@ cell_id = args.cell_id
 output_dir = args.output_dir
 plate_col = args.plate_col  # Default is "Image_Metadata_Plate"
 well_col = args.well_col  # Default is "Image_Metadata_Well"
+annotation_cache_dir = args.annotation_cache_dir
+feature_dtype = np.dtype(args.precision)  # Default is float64
+explain = args.explain
 
 # Initialize profile processing
 os.makedirs(output_dir, exist_ok=True)
 os.makedirs(cell_count_dir, exist_ok=True)
+os.makedirs(annotation_cache_dir, exist_ok=True)
 
 aggregate_method = "median"
 norm_method = "mad_robustize"
@@ -45,130 +49,53 @@ feature_select_ops = [
     "correlation_threshold",
     "blocklist",
 ]
-primary_dose_mapping = [0.04, 0.12, 0.37, 1.11, 3.33, 10, 20]
-
-# Define external metadata to add to annotation
-moa_df = pd.read_csv(moa_file, sep="\t")
-barcode_platemap_df = pd.read_csv(barcode_platemap_file).query(
-    "Assay_Plate_Barcode == @plate_name"
-)
-
-# Aggregate profiles
-out_file = pathlib.PurePath(output_dir, f"{plate_name}.csv.gz")
-sc = SingleCells(
-    file_or_conn=sql_file, strata=strata, aggregation_operation=aggregate_method
-)
-sc.aggregate_profiles(
-    output_file=out_file, float_format=float_format, compression_options=compression
-)
-
-# Count cells
-count_file = pathlib.PurePath(cell_count_dir, f"{plate_name}_cell_count.csv")
-cell_count_df = sc.count_cells()
-cell_count_df.to_csv(count_file, sep=",", index=False)
-
-del sc
-
-# Annotate profiles - Level 3 Data
-anno_file = pathlib.PurePath(output_dir, f"{plate_name}_augmented.csv.gz")
-anno_df = annotate(
-    profiles=out_file,
-    platemap=platemap_file,
-    join_on=["Metadata_well_position", well_col],
-    format_broad_cmap=True,
-    external_metadata=moa_df,
-    external_join_left=["Metadata_broad_sample"],
-    external_join_right=["Metadata_broad_sample"],
-    cmap_args={"cell_id": cell_id, "perturbation_mode": "chemical"},
-)
-
-# Rename columns
-anno_df = anno_df.rename(
-    {"Image_Metadata_Plate": "Metadata_Plate", "Image_Metadata_Well": "Metadata_Well"},
-    axis="columns",
+norm_samples = {"dmso": "Metadata_broad_sample == 'DMSO'", "whole_plate": "all"}
+dose_mapping = get_dose_ladder(batch)
+
+# Platemap, MOA and barcode platemap annotations are built once per platemap
+annotation = load_platemap_annotation(
+    platemap_file=platemap_file,
+    moa_file=moa_file,
+    barcode_platemap_file=barcode_platemap_file,
+    cache_dir=annotation_cache_dir,
+    well_col=well_col,
+    cell_id=cell_id,
+    dose_mapping=dose_mapping,
 )
 
-# Add barcode platemap info
-try:
-    anno_df = anno_df.assign(
-        Metadata_Assay_Plate_Barcode=barcode_platemap_df.Assay_Plate_Barcode.values[0],
-        Metadata_Plate_Map_Name=barcode_platemap_df.Plate_Map_Name.values[0],
-        Metadata_Batch_Number=barcode_platemap_df.Batch_Number.values[0],
-        Metadata_Batch_Date=barcode_platemap_df.Batch_Date.values[0],
-    )
-except AttributeError:
-    anno_df = anno_df.assign(
-        Metadata_Assay_Plate_Barcode=barcode_platemap_df.Assay_Plate_Barcode.values[0],
-        Metadata_Plate_Map_Name=barcode_platemap_df.Plate_Map_Name.values[0],
-    )
 
-# Add dose recoding information
-anno_df = anno_df.assign(
-    Metadata_dose_recode=(
-        anno_df.Metadata_mmoles_per_liter.apply(
-            lambda x: recode_dose(x, primary_dose_mapping, return_level=True)
-        )
-    )
-)
+def get_output_file(suffix):
+    return pathlib.PurePath(output_dir, f"{plate_name}{suffix}")
 
-# Reoroder columns
-metadata_cols = cyto_utils.infer_cp_features(anno_df, metadata=True)
-cp_cols = cyto_utils.infer_cp_features(anno_df)
-reindex_cols = metadata_cols + cp_cols
-anno_df = anno_df.reindex(reindex_cols, axis="columns")
-
-# Output annotated file
-cyto_utils.output(
-    df=anno_df,
-    output_filename=anno_file,
-    float_format=float_format,
-    compression_options=compression,
-)
 
-# Normalize Profiles (DMSO Control) - Level 4A Data
-norm_dmso_file = pathlib.PurePath(output_dir, f"{plate_name}_normalized_dmso.csv.gz")
-normalize(
-    profiles=anno_df,
-    samples="Metadata_broad_sample == 'DMSO'",
-    method=norm_method,
-    output_file=norm_dmso_file,
-    float_format=float_format,
-    compression_options=compression,
-)
+# Define the plan, steps only run (optimized) at pipeline.run()
+pipeline = Pipeline(float_format=float_format, compression_options=compression)
+single_cells = pipeline.single_cells(sql_file, strata, aggregate_method)
 
-# Normalize Profiles (Whole Plate) - Level 4A Data
-norm_file = pathlib.PurePath(output_dir, f"{plate_name}_normalized.csv.gz")
-normalize(
-    profiles=anno_df,
-    samples="all",
-    method=norm_method,
-    output_file=norm_file,
-    float_format=float_format,
-    compression_options=compression,
+# Aggregate profiles and count cells
+profiles = single_cells.aggregate(get_output_file(".csv.gz"), feature_dtype)
+single_cells.count_cells(
+    pathlib.PurePath(cell_count_dir, f"{plate_name}_cell_count.csv")
 )
 
-# Feature Selection (DMSO Control) - Level 4B Data
-feat_dmso_file = pathlib.PurePath(
-    output_dir, f"{plate_name}_normalized_feature_select_dmso.csv.gz"
-)
-feature_select(
-    profiles=norm_dmso_file,
-    features="infer",
-    operation=feature_select_ops,
-    output_file=feat_dmso_file,
-    float_format=float_format,
-    compression_options=compression,
+# Annotate profiles - Level 3 Data
+annotated = profiles.annotate(
+    annotation, plate_name=plate_name, plate_col=plate_col, well_col=well_col
+).rename_metadata(
+    {"Image_Metadata_Plate": "Metadata_Plate", "Image_Metadata_Well": "Metadata_Well"}
 )
+annotated.output(get_output_file("_augmented.csv.gz"))
+
+# Normalize Profiles (DMSO Control and Whole Plate) - Level 4A Data
+# Feature Selection (DMSO Control and Whole Plate) - Level 4B Data
+for norm_strat, samples in norm_samples.items():
+    suffix = "_dmso" if norm_strat == "dmso" else ""
+    normalized = annotated.normalize(samples=samples, method=norm_method)
+    normalized.output(get_output_file(f"_normalized{suffix}.csv.gz"))
+    normalized.feature_select(operation=feature_select_ops).output(
+        get_output_file(f"_normalized_feature_select{suffix}.csv.gz")
+    )
 
-# Feature Selection (Whole Plate) - Level 4B Data
-feat_file = pathlib.PurePath(
-    output_dir, f"{plate_name}_normalized_feature_select.csv.gz"
-)
-feature_select(
-    profiles=norm_file,
-    features="infer",
-    operation=feature_select_ops,
-    output_file=feat_file,
-    float_format=float_format,
-    compression_options=compression,
-)
+if explain:
+    print(pipeline.explain())
+pipeline.run()
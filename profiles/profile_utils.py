@@ -16,6 +16,12 @@ def get_args():
         "-i", "--cell_id", default="A549", help="the profiled cell line"
     )
     parser.add_argument("-c", "--cell_count_dir", help="directory to save cell counts")
+    parser.add_argument(
+        "-n",
+        "--annotation_cache_dir",
+        default="annotation_cache",
+        help="directory to cache platemap annotations",
+    )
     parser.add_argument(
         "-w",
         "--well_col",
@@ -28,6 +34,19 @@ def get_args():
         default="Image_Metadata_Plate",
         help="which column to represent plate",
     )
+    parser.add_argument(
+        "-d",
+        "--precision",
+        default="float64",
+        choices=["float64", "float32"],
+        help="floating point precision to hold profile features in",
+    )
+    parser.add_argument(
+        "-e",
+        "--explain",
+        action="store_true",
+        help="print the optimized processing plan before running it",
+    )
     args = parser.parse_args()
 
     return args
@@ -68,6 +87,13 @@ def get_pipeline_args():
         action="store_true",
         help="Add flag to extract cell line from platemap id",
     )
+    parser.add_argument(
+        "-d",
+        "--precision",
+        default="float64",
+        choices=["float64", "float32"],
+        help="floating point precision to hold profile features in",
+    )
     args = parser.parse_args()
 
     return args
@@ -16,6 +16,7 @@ plate_prefix = args.plate_prefix  # The default is "SQ"
 well_col = args.well_col  # The default is "Image_Metadata_Well"
 plate_col = args.plate_col  # The default is "Image_Metadata_Plate"
 extract_cell_line = args.extract_cell_line  # The default is False
+precision = args.precision  # The default is "float64"
 
 # Load constants
 project = "2015_10_05_DrugRepurposing_AravindSubramanian_GolubLab_Broad"
@@ -59,6 +60,7 @@ for plate in plates:
     output_dir.mkdir(parents=True, exist_ok=True)
     cell_count_dir = pathlib.Path("cell_count", batch, plate)
     cell_count_dir.mkdir(parents=True, exist_ok=True)
+    annotation_cache_dir = pathlib.Path("annotation_cache", batch)
 
     platemap_id = barcode_platemap_df.query(
         "Assay_Plate_Barcode == @plate"
@@ -94,9 +96,13 @@ for plate in plates:
         cell_id,
         "--cell_count_dir",
         cell_count_dir,
+        "--annotation_cache_dir",
+        annotation_cache_dir,
         "--well_col",
         well_col,
         "--plate_col",
         plate_col,
+        "--precision",
+        precision,
     ]
     subprocess.call(cmd)
@@ -0,0 +1,104 @@
+"""
+Spherize new or reprocessed plates with a saved spherize transform
+
+Transforms are saved by 0.spherize-batch-effects (one per batch and plate
+normalization, and per cell line and time point in Batch 2). Each plate is read,
+transformed and written on its own, so the rest of the batch is neither reloaded
+nor refit.
+"""
+
+import sys
+import pathlib
+import argparse
+import numpy as np
+
+from pycytominer.cyto_utils import output
+
+sys.path.append("../utils")
+from catalog import get_plate_files, resolve_plates
+from loader import iter_plates
+from spherize import apply_spherize, get_group_where, load_spherize
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t",
+        "--transform_file",
+        required=True,
+        help="saved spherize transform (.npz) to apply",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        default="2016_04_01_a549_48hr_batch1",
+        help="string indicating the batch name",
+    )
+    parser.add_argument(
+        "-n",
+        "--normalization",
+        default="whole_plate",
+        help="level 4a normalization the transform was fit on",
+    )
+    parser.add_argument(
+        "-p",
+        "--plates",
+        nargs="+",
+        default=None,
+        help="plates to spherize (default: every plate of the fitting group)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        default="profiles/plates",
+        help="directory to save the spherized plates",
+    )
+    parser.add_argument(
+        "-j", "--n_jobs", type=int, default=None, help="plates read concurrently"
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+args = get_args()
+
+fitted_spherize, features, group_keys, samples = load_spherize(args.transform_file)
+where = get_group_where(group_keys)
+print(f"Loaded {fitted_spherize.method} transform of {len(features)} features")
+print(f"  Fit on {fitted_spherize.count} profiles ({samples}) of {group_keys}")
+
+plates = args.plates
+if plates is None:
+    plates = resolve_plates(args.batch, where=where).Metadata_Plate.tolist()
+plate_files = get_plate_files(
+    args.batch,
+    level="level_4a",
+    normalization=args.normalization,
+    where=f"Metadata_Plate in {plates}",
+)
+if len(plate_files) < len(set(plates)):
+    raise ValueError(f"Not all of {plates} are plates of {args.batch}")
+
+output_dir = pathlib.Path(args.output_dir)
+output_suffix = (
+    f"_dmso_spherized_profiles_with_input_normalized_by_{args.normalization}.csv.gz"
+)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+plate_dfs = iter_plates(
+    plate_files,
+    read_kwargs={"level": "level_4a", "feature_dtype": np.float64},
+    n_jobs=args.n_jobs,
+)
+for plate_df in plate_dfs:
+    plate = plate_df.Metadata_Plate.iloc[0]
+
+    # Plates outside the fitting group would be spherized against the wrong DMSO
+    if where is not None and plate_df.eval(where).sum() < plate_df.shape[0]:
+        raise ValueError(f"{plate} has profiles outside of {group_keys}")
+
+    spherize_df = apply_spherize(fitted_spherize, plate_df, features=features)
+    output_file = pathlib.Path(output_dir, f"{plate}{output_suffix}")
+    output(df=spherize_df, output_filename=output_file)
+    print(f"Written: {output_file} {spherize_df.shape}")
@@ -7,41 +7,40 @@
 # 
 # We've previously observed that sphering (aka whitening) the data successfully adjusts for technical artifacts induced by batch to batch variation and plate position effects.
 
-# In[1]:
+# In[ ]:
 
 
 import os
+import sys
 import pathlib
 import subprocess
+import numpy as np
 import pandas as pd
 
-from pycytominer import normalize, feature_select
 from pycytominer.cyto_utils import output, infer_cp_features
 
+sys.path.append("../utils")
+from catalog import get_plate_files, load_profiles, resolve_plates
+from feature_selection import feature_select
+from group_executor import (
+    GroupExecutor,
+    check_groups,
+    feature_select_groups,
+    spherize_groups,
+    spherize_plate_groups,
+)
+from spherize import get_group_where, spherize
 
-# In[2]:
 
+# In[ ]:
 
-input_dir = pathlib.Path("../profiles/")
-batches = ["2016_04_01_a549_48hr_batch1", "2017_12_05_Batch2"]
-
-suffixes = {
-    "whole_plate": "_normalized.csv.gz",
-    "dmso": "_normalized_dmso.csv.gz"
-}
 
-plates = {
-    batch: [x.name for x in pathlib.Path(f"{input_dir}/{batch}").iterdir() if ".DS_Store" not in x.name]
-    for batch in batches
-}
+batches = ["2016_04_01_a549_48hr_batch1", "2017_12_05_Batch2"]
+suffixes = ["whole_plate", "dmso"]
 
-files = {
-    batch: {
-        suffix: [pathlib.Path(f"{input_dir}/{batch}/{x}/{x}{suffixes[suffix]}") for x in plates[batch]]
-        for suffix in suffixes
-    }
-    for batch in batches
-}
+# Profiles are held in float64, set to np.float32 to halve memory (opt-in, see
+# benchmark/precision_report.py for how far float32 outputs drift)
+feature_dtype = np.float64
 
 feature_select_ops = [
     "variance_threshold",
@@ -53,11 +52,24 @@ feature_select_ops = [
 na_cut = 0
 corr_threshold = 0.95
 output_dir = "profiles"
+transform_dir = "transforms"
 
 full_blocklist_file = pathlib.Path("../utils/consensus_blocklist.txt")
 
+# Fit the spherize transform from per-plate DMSO statistics and transform one plate
+# at a time, rather than spherizing the loaded batch in memory. Feature selection
+# (Step 1) still runs on the loaded batch, so peak memory still grows with its rows
+# Fitted transforms are saved to transform_dir, see apply_spherize.py
+streaming = True
+dmso_samples = "Metadata_broad_sample == 'DMSO'"
+
+# Batch 2 is feature selected and spherized per cell line and time point, with the
+# groups processed in parallel, also when streaming (None uses every core)
+group_cols = ["Metadata_cell_line", "Metadata_time_point"]
+n_jobs = None
+
 
-# In[3]:
+# In[ ]:
 
 
 for batch in batches:
@@ -67,30 +79,26 @@ for batch in batches:
         )
         print(f"Now processing {output_file}...")
 
-        profile_df = pd.concat([pd.read_csv(x) for x in files[batch][suffix]]).reset_index(drop=True)
+        profile_df = load_profiles(
+            batch=batch,
+            level="level_4a",
+            normalization=suffix,
+            feature_dtype=feature_dtype,
+        )
         print(profile_df.shape)
         
         # Step 1: Perform feature selection
         if batch == "2017_12_05_Batch2":
-            profile_df = (
-                profile_df
-                .groupby(["Metadata_cell_line", "Metadata_time_point"])
-                .apply(
-                    lambda x: feature_select(
-                        profiles=x,
-                        operation=feature_select_ops,
-                        na_cutoff=na_cut,
-                        corr_threshold=corr_threshold,
-                        blocklist_file=full_blocklist_file
-                    )
-                )
-            )
-            
-            # Drop features that weren't selected in the grouped splits
-            profile_df = feature_select(
-                profiles=profile_df,
-                operation="drop_na_columns",
-                na_cutoff=na_cut
+            # Split the batch by group once, for feature selection and spherize
+            group_executor = GroupExecutor(profile_df, group_cols, n_jobs=n_jobs)
+
+            # Keep only features selected in every group
+            features = feature_select_groups(
+                group_executor,
+                operation=feature_select_ops,
+                na_cutoff=na_cut,
+                corr_threshold=corr_threshold,
+                blocklist_file=full_blocklist_file
             )
         else:
             profile_df = feature_select(
@@ -100,29 +108,74 @@ for batch in batches:
                 corr_threshold=corr_threshold,
                 blocklist_file=full_blocklist_file
             )
+            features = infer_cp_features(profile_df)
 
         # Step 2: Spherize transform
-        if batch == "2017_12_05_Batch2":
-            spherize_df = (
-                profile_df
-                .groupby(["Metadata_cell_line", "Metadata_time_point"])
-                .apply(
-                    lambda x: normalize(
-                        profiles=x,
-                        features="infer",
-                        meta_features="infer",
-                        samples="Metadata_broad_sample == 'DMSO'",
-                        method="spherize"
-                    )
+        # The transform is fit in float64, spherized features stay in feature_dtype
+
+        if streaming:
+            # Only the selected features are needed from the loaded batch
+            del profile_df
+
+            # Batch 2 is spherized per cell line and time point, in groupby order,
+            # each group fit and transformed in its own process
+            if batch == "2017_12_05_Batch2":
+                group_df = resolve_plates(batch).loc[
+                    :, group_cols
+                ].drop_duplicates().sort_values(group_cols)
+                groups = group_df.loc[:, group_cols].to_dict(orient="records")
+
+                # Plates are grouped from the manifest, features were selected on
+                # the groups of the loaded profiles
+                check_groups(group_executor, groups)
+                del group_executor
+            else:
+                groups = [{}]
+
+            # Step 3: Save each fitted transform, to apply to new or reprocessed plates
+            group_plates = []
+            transform_files = []
+            for group_keys in groups:
+                plate_files = get_plate_files(
+                    batch,
+                    level="level_4a",
+                    normalization=suffix,
+                    where=get_group_where(group_keys),
                 )
+                group_plates.append((group_keys, plate_files))
+
+                group_name = "".join(f"_{x}" for x in group_keys.values())
+                transform_files.append(pathlib.Path(
+                    f"{transform_dir}/{batch}_dmso_spherize_transform_normalized_by_{suffix}{group_name}.npz"
+                ))
+
+            # Step 4: Output profiles, one plate at a time
+            spherize_plate_groups(
+                group_plates,
+                features=features,
+                output_file=output_file,
+                read_kwargs={"level": "level_4a", "feature_dtype": feature_dtype},
+                transform_files=transform_files,
+                samples=dmso_samples,
+                compression_options={"method": "gzip", "mtime": 1},
+                n_jobs=n_jobs,
+            )
+            continue
+
+        if batch == "2017_12_05_Batch2":
+            spherize_df = spherize_groups(
+                group_executor,
+                features=features,
+                meta_features="infer",
+                samples=dmso_samples
             )
+            del group_executor
         else:
-            spherize_df = normalize(
+            spherize_df = spherize(
                 profiles=profile_df,
                 features="infer",
                 meta_features="infer",
-                samples="Metadata_broad_sample == 'DMSO'",
-                method="spherize"
+                samples="Metadata_broad_sample == 'DMSO'"
             )
 
         print(spherize_df.shape)
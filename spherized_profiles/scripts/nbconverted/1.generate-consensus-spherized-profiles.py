@@ -16,13 +16,18 @@ get_ipython().run_line_magic('load_ext', 'nb_black')
 
 
 import os
+import sys
 import pathlib
 import numpy as np
 import pandas as pd
 
-from pycytominer import consensus
 from pycytominer.cyto_utils import infer_cp_features, output
 
+sys.path.append("../utils")
+from consensus_builder import consensus_operations
+from groups import get_group_index
+from schema import read_profiles
+
 
 # In[3]:
 
@@ -90,7 +95,7 @@ for batch in batches:
         spherized_file = batch_files[norm_strat]
         print(f"  Now forming consensus signature for: {spherized_file}")
 
-        spherized_df = pd.read_csv(spherized_file, low_memory=False)
+        spherized_df = read_profiles(spherized_file, level="spherized")
         print(spherized_df.shape)
 
         # Recode missing MOA and target values to be "unknown"
@@ -101,17 +106,20 @@ for batch in batches:
         if batch == "2016_04_01_a549_48hr_batch1":
             spherized_df = spherized_df.assign(Metadata_time_point="48H")
 
+        # Replicate groups are indexed once, for all consensus operations
+        group_index = get_group_index(spherized_df, replicate_cols)
+
         for operation in operations:
             output_file = pathlib.Path(
                 f"{output_dir}/{batch}{spherized_string}{norm_strat}_consensus_{operation}.csv.gz"
             )
             print(f"    with consensus operation: {operation}")
 
-            spherized_consensus_df = consensus(
-                profiles=spherized_df,
-                replicate_columns=replicate_cols,
-                operation=operation,
+            spherized_consensus_df = consensus_operations[operation](
+                spherized_df,
+                replicate_cols,
                 features=features,
+                group_index=group_index,
             )
             print(spherized_consensus_df.shape)
 
@@ -0,0 +1,108 @@
+"""
+Sweep spherize whitening methods and regularization from a single fit
+
+Takes the features, reference samples and fitting group of a transform saved by
+0.spherize-batch-effects, decomposes the reference statistics of that group's
+plates once and scores every requested method and epsilon by the batch effect
+left in the spherized reference profiles (see sweep_spherize_plates in
+utils/spherize.py). Plates are streamed, twice.
+"""
+
+import sys
+import pathlib
+import argparse
+import numpy as np
+
+sys.path.append("../utils")
+from catalog import get_plate_files
+from loader import iter_plates
+from spherize import get_group_where, load_spherize, sweep_spherize_plates
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t",
+        "--transform_file",
+        required=True,
+        help="saved spherize transform (.npz) whose fit to sweep",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        default="2016_04_01_a549_48hr_batch1",
+        help="string indicating the batch name",
+    )
+    parser.add_argument(
+        "-n",
+        "--normalization",
+        default="whole_plate",
+        help="level 4a normalization the transform was fit on",
+    )
+    parser.add_argument(
+        "-m",
+        "--methods",
+        nargs="+",
+        default=["ZCA-cor", "PCA-cor", "ZCA", "PCA"],
+        help="whitening methods to evaluate",
+    )
+    parser.add_argument(
+        "-e",
+        "--epsilons",
+        nargs="+",
+        type=float,
+        default=[1e-6, 1e-4, 1e-2, 1e-1, 1],
+        help="regularization values to evaluate",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        default="sweeps",
+        help="directory to save the results table",
+    )
+    parser.add_argument(
+        "-j", "--n_jobs", type=int, default=None, help="plates read concurrently"
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+args = get_args()
+
+fitted_spherize, features, group_keys, samples = load_spherize(args.transform_file)
+print(f"Sweeping {len(features)} features of {group_keys}")
+
+plate_files = get_plate_files(
+    args.batch,
+    level="level_4a",
+    normalization=args.normalization,
+    where=get_group_where(group_keys),
+)
+
+
+def get_plates():
+    return iter_plates(
+        plate_files,
+        read_kwargs={"level": "level_4a", "feature_dtype": np.float64},
+        n_jobs=args.n_jobs,
+    )
+
+
+sweep_df = sweep_spherize_plates(
+    get_plates,
+    features=features,
+    samples=samples,
+    methods=args.methods,
+    epsilons=args.epsilons,
+    center=fitted_spherize.center,
+)
+
+output_dir = pathlib.Path(args.output_dir)
+output_dir.mkdir(parents=True, exist_ok=True)
+output_file = pathlib.Path(
+    output_dir, f"{pathlib.Path(args.transform_file).stem}_sweep.tsv"
+)
+sweep_df.to_csv(output_file, sep="\t", index=False)
+print(sweep_df.sort_values("plate_r2").to_string(index=False))
+print(f"Written: {output_file}")
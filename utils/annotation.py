@@ -0,0 +1,179 @@
+"""
+Cache one annotation table per platemap and annotate plates with a single well join
+
+Replicate plates share a platemap, so the platemap, MOA and dose annotations are
+built once per platemap and cached on disk, keyed by platemap name and a hash of
+the inputs. Each plate then only looks up its wells in the cached table.
+"""
+
+import os
+import pathlib
+import inspect
+import hashlib
+import numpy as np
+import pandas as pd
+
+from pycytominer import annotate
+
+from dose import recode_doses
+from frame import ProfileFrame, categorize
+from schema import split_columns
+
+# Barcode platemap fields added to every plate, in output order
+barcode_fields = {
+    "Assay_Plate_Barcode": "Metadata_Assay_Plate_Barcode",
+    "Plate_Map_Name": "Metadata_Plate_Map_Name",
+    "Batch_Number": "Metadata_Batch_Number",
+    "Batch_Date": "Metadata_Batch_Date",
+}
+
+# Annotations derived after the barcode platemap fields are added
+derived_cols = ["Metadata_dose_recode"]
+
+# The pinned pycytominer joins external metadata on external_join_left and
+# external_join_right, later releases take external_join_on and rename CellProfiler
+# columns unless asked not to
+if "external_join_on" in inspect.signature(annotate).parameters:
+    external_join_args = {
+        "external_join_on": ["Metadata_broad_sample"],
+        "clean_cellprofiler": False,
+    }
+else:
+    external_join_args = {
+        "external_join_left": ["Metadata_broad_sample"],
+        "external_join_right": ["Metadata_broad_sample"],
+    }
+
+
+def hash_inputs(input_files, **params):
+    input_hash = hashlib.sha256()
+    for input_file in input_files:
+        with open(input_file, "rb") as input_fh:
+            input_hash.update(input_fh.read())
+    input_hash.update(repr(sorted(params.items())).encode())
+    return input_hash.hexdigest()[:16]
+
+
+def build_platemap_annotation(
+    platemap_file, moa_file, barcode_platemap_file, well_col, cell_id, dose_mapping
+):
+    platemap_name = pathlib.Path(platemap_file).stem
+    moa_df = pd.read_csv(moa_file, sep="\t")
+    platemap_df = pd.read_csv(platemap_file, sep="\t")
+
+    # Annotate the platemap wells, profiles only contribute the well column
+    wells_df = pd.DataFrame({well_col: platemap_df.well_position.unique()})
+    annotation_df = annotate(
+        profiles=wells_df,
+        platemap=platemap_file,
+        join_on=["Metadata_well_position", well_col],
+        format_broad_cmap=True,
+        external_metadata=moa_df,
+        cmap_args={"cell_id": cell_id, "perturbation_mode": "chemical"},
+        **external_join_args,
+    ).reset_index(drop=True)
+
+    annotation_df = annotation_df.assign(
+        Metadata_dose_recode=recode_doses(
+            annotation_df.Metadata_mmoles_per_liter, dose_mapping, return_level=True
+        )
+    )
+
+    plates_df = (
+        pd.read_csv(barcode_platemap_file)
+        .query("Plate_Map_Name == @platemap_name")
+        .set_index("Assay_Plate_Barcode", drop=False)
+    )
+
+    return {"annotation": annotation_df, "plates": plates_df}
+
+
+def load_platemap_annotation(
+    platemap_file,
+    moa_file,
+    barcode_platemap_file,
+    cache_dir,
+    well_col,
+    cell_id,
+    dose_mapping,
+):
+    """Load the annotation of a platemap, building and caching it on first use"""
+    params = {"well_col": well_col, "cell_id": cell_id, "dose_mapping": dose_mapping}
+    input_hash = hash_inputs([platemap_file, moa_file, barcode_platemap_file], **params)
+
+    platemap_name = pathlib.Path(platemap_file).stem
+    cache_file = pathlib.Path(cache_dir, f"{platemap_name}_{input_hash}.pkl")
+    if cache_file.exists():
+        return pd.read_pickle(cache_file)
+
+    annotation = build_platemap_annotation(
+        platemap_file, moa_file, barcode_platemap_file, **params
+    )
+
+    # Write then rename, so plates processed concurrently never read a partial file
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    pd.to_pickle(annotation, tmp_file)
+    os.replace(tmp_file, cache_file)
+
+    return annotation
+
+
+def get_plate_info(annotation, plate_name):
+    plate_info = annotation["plates"].loc[plate_name]
+    return {y: plate_info[x] for x, y in barcode_fields.items() if x in plate_info}
+
+
+def annotate_plate(profile_df, annotation, plate_name, well_col, id_cols=None):
+    """Annotate the profiles of one plate with its cached platemap annotation
+
+    Returns a ProfileFrame with wells in platemap order, as pycytominer.annotate()
+    """
+    annotation_df = annotation["annotation"]
+    if id_cols is None:
+        id_cols = [well_col]
+
+    # Profiles are inner joined on their well, as in pycytominer.annotate(): wells
+    # missing from the platemap are dropped, and a well the platemap (or the MOA
+    # map) annotates more than once repeats its profiles
+    join_df = pd.merge(
+        pd.DataFrame(
+            {
+                "well": annotation_df[well_col].to_numpy(),
+                "annotation_row": np.arange(annotation_df.shape[0]),
+            }
+        ),
+        pd.DataFrame(
+            {
+                "well": profile_df[well_col].to_numpy(),
+                "profile_row": np.arange(profile_df.shape[0]),
+            }
+        ),
+        on="well",
+        how="inner",
+    )
+    annotation_rows = join_df.annotation_row.to_numpy()
+    profile_rows = join_df.profile_row.to_numpy()
+
+    # Profile identifiers take the place of the well column among annotations
+    metadata_df = annotation_df.take(annotation_rows).reset_index(drop=True)
+    well_position = metadata_df.columns.get_loc(well_col)
+    annotation_cols = [x for x in metadata_df.columns if x not in derived_cols]
+    metadata_df = pd.concat(
+        [
+            metadata_df.loc[:, annotation_cols[:well_position]],
+            profile_df.loc[:, id_cols].take(profile_rows).reset_index(drop=True),
+            metadata_df.loc[:, annotation_cols[well_position + 1 :]],
+        ],
+        axis="columns",
+    )
+    metadata_df = metadata_df.assign(
+        **get_plate_info(annotation, plate_name),
+        **{x: annotation_df[x].take(annotation_rows).values for x in derived_cols},
+    )
+
+    _, features = split_columns(profile_df.columns)
+    profile_frame = ProfileFrame.from_pandas(
+        profile_df.take(profile_rows), features=features, meta_features=[]
+    )
+    return profile_frame.with_metadata(categorize(metadata_df))
@@ -0,0 +1,238 @@
+"""
+Normalize every plate of a batch against batch-wide reference statistics
+
+Each plate emits compact, mergeable statistics for each reference sample subset:
+per-feature counts, means and sums of squared deviations (merged exactly), and a
+weighted quantile sketch (merged approximately, exact until the batch has more
+reference profiles than the sketch size). Plate statistics are reduced in a
+binary tree, then a second streaming pass normalizes each plate against the
+batch reference. Only one plate is held in memory at a time.
+"""
+
+import collections
+import numpy as np
+import pandas as pd
+
+from normalization import get_center_scale, get_reference_masks, mad_scale
+from normalization import method_quantiles
+from schema import split_columns
+
+# Points kept per feature in a quantile sketch
+sketch_size = 4096
+
+
+class ReferenceStats(
+    collections.namedtuple(
+        "ReferenceStats", ["count", "mean", "m2", "sketch_values", "sketch_weights"]
+    )
+):
+    __slots__ = ()
+
+    @property
+    def std(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.sqrt(self.m2 / self.count)
+
+
+def interpolate_columns(positions, values, targets):
+    # Linear interpolation of every column at the same target positions in [0, 1];
+    # columns are offset so a single searchsorted covers all of them
+    n_points, n_features = positions.shape
+    n_valid = np.isfinite(values).sum(axis=0)
+    offsets = 3 * np.arange(n_features)
+
+    positions = np.where(np.isfinite(values), positions, 1.5) + offsets
+    flat_positions = positions.T.ravel()
+    flat_targets = (targets[:, None] + offsets).ravel()
+
+    left = np.searchsorted(flat_positions, flat_targets, side="right") - 1
+    left = left.reshape(len(targets), n_features) - n_points * np.arange(n_features)
+    left = np.clip(left, 0, np.maximum(n_valid - 1, 0))
+    right = np.minimum(left + 1, np.maximum(n_valid - 1, 0))
+
+    columns = np.arange(n_features)
+    left_pos, right_pos = positions[left, columns], positions[right, columns]
+    left_val, right_val = values[left, columns], values[right, columns]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(
+            right_pos > left_pos,
+            (targets[:, None] + offsets - left_pos) / (right_pos - left_pos),
+            0,
+        )
+    interpolated = left_val + np.clip(fraction, 0, 1) * (right_val - left_val)
+    return np.where(n_valid > 0, interpolated, np.nan)
+
+
+def sort_sketch(values, weights):
+    order = np.argsort(values, axis=0)
+    return (
+        np.take_along_axis(values, order, axis=0),
+        np.take_along_axis(weights, order, axis=0),
+    )
+
+
+def sketch_positions(values, weights):
+    # Positions in [0, 1] that reduce to np.percentile's for unit weights
+    weights = np.where(np.isfinite(values), weights, 0)
+    cumulative = np.cumsum(weights, axis=0) - weights / 2
+    n_valid = np.isfinite(values).sum(axis=0)
+    columns = np.arange(values.shape[1])
+
+    first = weights[0] / 2
+    last = weights[np.maximum(n_valid - 1, 0), columns] / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        span = weights.sum(axis=0) - first - last
+        positions = np.where(span > 0, (cumulative - first) / span, 0)
+    return positions
+
+
+def get_quantiles(values, weights, q):
+    positions = sketch_positions(values, weights)
+    return interpolate_columns(positions, values, np.asarray(q) / 100)
+
+
+def compress_sketch(values, weights, size=sketch_size):
+    if values.shape[0] <= size:
+        return values, weights
+
+    total = np.where(np.isfinite(values), weights, 0).sum(axis=0)
+    compressed = get_quantiles(values, weights, np.linspace(0, 100, size))
+    return compressed, np.broadcast_to(total / size, compressed.shape).copy()
+
+
+def compute_plate_stats(x, size=sketch_size):
+    x = x.astype(np.float64, copy=False)
+    count = np.isfinite(x).sum(axis=0)
+    mean = np.nanmean(x, axis=0) if x.shape[0] > 0 else np.full(x.shape[1], np.nan)
+    m2 = np.nansum((x - mean) ** 2, axis=0)
+
+    values, weights = sort_sketch(x.copy(), np.ones_like(x))
+    values, weights = compress_sketch(values, weights, size)
+    return ReferenceStats(count, mean, m2, values, weights)
+
+
+def merge_stats(a, b, size=sketch_size):
+    # Counts, means and squared deviations merge exactly (Chan et al.)
+    count = a.count + b.count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.nan_to_num(b.mean - a.mean)
+        mean = np.where(
+            count > 0,
+            (a.count * np.nan_to_num(a.mean) + b.count * np.nan_to_num(b.mean)) / count,
+            np.nan,
+        )
+        m2 = a.m2 + b.m2 + np.where(count > 0, delta**2 * a.count * b.count / count, 0)
+
+    values, weights = sort_sketch(
+        np.concatenate([a.sketch_values, b.sketch_values]),
+        np.concatenate([a.sketch_weights, b.sketch_weights]),
+    )
+    values, weights = compress_sketch(values, weights, size)
+    return ReferenceStats(count, mean, m2, values, weights)
+
+
+def reduce_stats(plate_stats, size=sketch_size):
+    # Merge as a binary tree, so each profile goes through few compressions
+    levels = []
+    for stats in plate_stats:
+        level = 0
+        while levels and levels[-1][0] == level:
+            stats = merge_stats(levels.pop()[1], stats, size)
+            level += 1
+        levels.append((level, stats))
+
+    if not levels:
+        raise ValueError("No plate statistics to reduce")
+
+    stats = levels.pop()[1]
+    while levels:
+        stats = merge_stats(levels.pop()[1], stats, size)
+    return stats
+
+
+def get_reference_stats(stats, methods):
+    """Reference statistics in the form normalization.get_center_scale() uses"""
+    quantiles = sorted(set(q for method in methods for q in method_quantiles[method]))
+
+    reference_stats = {}
+    if quantiles:
+        reference_stats.update(
+            zip(
+                quantiles,
+                get_quantiles(stats.sketch_values, stats.sketch_weights, quantiles),
+            )
+        )
+
+    if "mad_robustize" in methods:
+        deviations, weights = sort_sketch(
+            np.abs(stats.sketch_values - reference_stats[50]), stats.sketch_weights
+        )
+        reference_stats["mad"] = mad_scale * get_quantiles(deviations, weights, [50])[0]
+
+    if "standardize" in methods:
+        reference_stats["mean"] = stats.mean
+        reference_stats["std"] = stats.std
+
+    return reference_stats
+
+
+def iter_plate_stats(plate_dfs, samples, size=sketch_size):
+    features = None
+    for plate_df in plate_dfs:
+        _, plate_features = split_columns(plate_df.columns)
+        if features is None:
+            features = plate_features
+        elif plate_features != features:
+            raise ValueError("Every plate of a batch must have the same features")
+
+        x = plate_df.loc[:, features].to_numpy()
+        reference_masks = get_reference_masks(plate_df, samples)
+        yield {
+            sample_name: compute_plate_stats(
+                x if reference_mask is None else x[reference_mask], size
+            )
+            for sample_name, reference_mask in reference_masks.items()
+        }
+
+
+def fit_batch_reference(plate_dfs, samples, size=sketch_size):
+    """First pass: reduce the statistics of every plate per reference sample subset
+
+    Returns a dictionary of batch-wide ReferenceStats keyed by sample name
+    """
+    plate_stats = {sample_name: [] for sample_name in samples}
+    for stats in iter_plate_stats(plate_dfs, samples, size):
+        for sample_name, sample_stats in stats.items():
+            plate_stats[sample_name].append(sample_stats)
+
+    return {
+        sample_name: reduce_stats(sample_stats, size)
+        for sample_name, sample_stats in plate_stats.items()
+    }
+
+
+def normalize_plate(plate_df, batch_reference, methods, mad_robustize_epsilon=1e-18):
+    """Second pass: normalize one plate against the batch reference statistics
+
+    Returns a dictionary keyed by (sample name, method), as normalize_variants()
+    """
+    meta_features, features = split_columns(plate_df.columns)
+    x = plate_df.loc[:, features].to_numpy()
+    meta_df = plate_df.loc[:, meta_features]
+
+    normalized = {}
+    for sample_name, stats in batch_reference.items():
+        reference_stats = get_reference_stats(stats, methods)
+        for method in methods:
+            center, scale = get_center_scale(
+                reference_stats, method, mad_robustize_epsilon
+            )
+            center, scale = center.astype(x.dtype), scale.astype(x.dtype)
+            feature_df = pd.DataFrame(
+                (x - center) / scale, columns=features, index=plate_df.index
+            )
+            normalized[(sample_name, method)] = pd.concat(
+                [meta_df, feature_df], axis="columns"
+            )
+
+    return normalized
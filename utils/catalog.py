@@ -0,0 +1,231 @@
+"""
+Resolve and load profiles by batch, data level, and normalization strategy
+
+Plates are resolved from the barcode platemap manifest of each batch.
+Filters on plate-level partition columns (plate, platemap, cell line, time point)
+prune plates before any file is opened, all other filters are applied per chunk
+while reading so only matching rows are kept in memory. Row filters can only use
+columns of the file or plate partition values from the manifest, so level 5
+consensus files (one file per batch, without a manifest) cannot be filtered by
+plate partition columns they do not have.
+"""
+
+import re
+import pathlib
+import numpy as np
+import pandas as pd
+
+from loader import load_plates
+from schema import read_profile_columns, read_profiles
+
+repo_dir = pathlib.Path(__file__).resolve().parents[1]
+profile_dir = pathlib.Path(repo_dir, "profiles")
+consensus_dir = pathlib.Path(repo_dir, "consensus")
+platemap_dir = pathlib.Path(repo_dir, "metadata", "platemaps")
+
+# Batch 1 profiled a single cell line at a single time point
+batch_info = {
+    "2016_04_01_a549_48hr_batch1": {"cell_line": "A549", "time_point": "48H"},
+    "2017_12_05_Batch2": {"cell_line": None, "time_point": None},
+}
+
+level_suffixes = {
+    "level_3": {"none": "_augmented.csv.gz"},
+    "level_4a": {
+        "whole_plate": "_normalized.csv.gz",
+        "dmso": "_normalized_dmso.csv.gz",
+        "batch_whole_plate": "_normalized_batch.csv.gz",
+        "batch_dmso": "_normalized_batch_dmso.csv.gz",
+    },
+    "level_4b": {
+        "whole_plate": "_normalized_feature_select.csv.gz",
+        "dmso": "_normalized_feature_select_dmso.csv.gz",
+    },
+    "level_5": {"whole_plate": ".csv.gz", "dmso": "_dmso.csv.gz"},
+}
+
+partition_cols = [
+    "Metadata_Plate",
+    "Metadata_Plate_Map_Name",
+    "Metadata_cell_id",
+    "Metadata_cell_line",
+    "Metadata_time_point",
+]
+
+
+def load_manifest(batch):
+    try:
+        info = batch_info[batch]
+    except KeyError:
+        raise ValueError(
+            f"{batch} is not a known batch, select one of {list(batch_info)}"
+        )
+
+    barcode_platemap_file = pathlib.Path(platemap_dir, batch, "barcode_platemap.csv")
+    manifest_df = pd.read_csv(barcode_platemap_file, dtype=str).rename(
+        {
+            "Assay_Plate_Barcode": "Metadata_Plate",
+            "Plate_Map_Name": "Metadata_Plate_Map_Name",
+        },
+        axis="columns",
+    )
+
+    # Only plates that went through the profiling pipeline have a cell count
+    cell_count_dir = pathlib.Path(profile_dir, "cell_count", batch)
+    profiled_plates = [x.name for x in cell_count_dir.iterdir() if x.is_dir()]
+    manifest_df = manifest_df.query("Metadata_Plate in @profiled_plates")
+
+    # Batch 2 platemap names encode cell line and time point (e.g. LKCP001_A549_6H)
+    platemap_parts = manifest_df.Metadata_Plate_Map_Name.str.split("_")
+    cell_line = info["cell_line"] or platemap_parts.str[1]
+    time_point = info["time_point"] or platemap_parts.str[2]
+
+    manifest_df = manifest_df.assign(
+        Metadata_cell_id=cell_line,
+        Metadata_cell_line=cell_line,
+        Metadata_time_point=time_point,
+        Metadata_Batch=batch,
+    )
+    return manifest_df.loc[:, partition_cols + ["Metadata_Batch"]].reset_index(
+        drop=True
+    )
+
+
+def get_suffix(level, normalization):
+    try:
+        return level_suffixes[level][normalization]
+    except KeyError:
+        raise ValueError(
+            f"{level} with {normalization} normalization is not available, "
+            f"select one of {level_suffixes}"
+        )
+
+
+def get_filter_columns(where, columns):
+    return [x for x in columns if re.search(rf"\b{re.escape(x)}\b", where)]
+
+
+def resolve_plates(batch, where=None):
+    manifest_df = load_manifest(batch)
+
+    # Push down filters that only reference plate-level partition columns
+    if where is not None and is_partition_filter(where):
+        manifest_df = manifest_df.query(where)
+
+    return manifest_df.reset_index(drop=True)
+
+
+def is_partition_filter(where):
+    identifiers = set(re.findall(r"\bMetadata_\w+\b", where))
+    return len(identifiers) > 0 and identifiers.issubset(partition_cols)
+
+
+def get_plate_file(batch, plate, suffix):
+    return pathlib.Path(profile_dir, batch, plate, f"{plate}{suffix}")
+
+
+def get_plate_files(batch, level, normalization="whole_plate", where=None):
+    suffix = get_suffix(level, normalization)
+    plates = resolve_plates(batch, where=where).Metadata_Plate
+    return [get_plate_file(batch, x, suffix) for x in plates]
+
+
+def get_consensus_file(batch, normalization="whole_plate", operation="modz"):
+    suffix = get_suffix("level_5", normalization)
+    return pathlib.Path(consensus_dir, batch, f"{batch}_consensus_{operation}{suffix}")
+
+
+def read_filtered(
+    profile_file,
+    level,
+    columns=None,
+    where=None,
+    partition=None,
+    chunksize=None,
+    feature_dtype=np.float64,
+):
+    if where is None:
+        return read_profiles(
+            profile_file, level=level, usecols=columns, feature_dtype=feature_dtype
+        )
+
+    file_columns = read_profile_columns(profile_file)
+    if columns is not None:
+        columns = list(columns) + [
+            x for x in get_filter_columns(where, file_columns) if x not in columns
+        ]
+
+    # Partition values absent from the file (e.g. batch 1 cell line) come from the manifest
+    partition = {x: y for x, y in (partition or {}).items() if x not in file_columns}
+
+    missing_cols = set(re.findall(r"\bMetadata_\w+\b", where)).difference(
+        file_columns, partition
+    )
+    if len(missing_cols) > 0:
+        raise ValueError(
+            f"Cannot filter {profile_file} on {sorted(missing_cols)}, "
+            "the file has no such columns"
+        )
+
+    # Filter chunk by chunk so only matching rows are held in memory
+    chunks = read_profiles(
+        profile_file,
+        level=level,
+        usecols=columns,
+        chunksize=chunksize,
+        feature_dtype=feature_dtype,
+    )
+    if chunksize is None:
+        chunks = [chunks]
+    return pd.concat(
+        [chunk.loc[chunk.assign(**partition).eval(where)] for chunk in chunks],
+        axis="rows",
+    )
+
+
+def load_profiles(
+    batch,
+    level,
+    normalization="whole_plate",
+    columns=None,
+    where=None,
+    operation="modz",
+    chunksize=96,
+    n_jobs=None,
+    executor="thread",
+    feature_dtype=np.float64,
+):
+    """Load profiles of one batch, data level and normalization from the manifest"""
+    read_kwargs = {
+        "level": level,
+        "columns": columns,
+        "chunksize": chunksize,
+        "feature_dtype": feature_dtype,
+    }
+
+    if level == "level_5":
+        profile_df = read_filtered(
+            get_consensus_file(batch, normalization, operation),
+            where=where,
+            **read_kwargs,
+        )
+    else:
+        suffix = get_suffix(level, normalization)
+        plates_df = resolve_plates(batch, where=where)
+        row_where = None if where is None or is_partition_filter(where) else where
+
+        profile_df = load_plates(
+            [get_plate_file(batch, x, suffix) for x in plates_df.Metadata_Plate],
+            read_func=read_filtered,
+            read_kwargs=[
+                dict(read_kwargs, where=row_where, partition=partition)
+                for partition in plates_df.to_dict("records")
+            ],
+            n_jobs=n_jobs,
+            executor=executor,
+        )
+
+    if columns is not None:
+        profile_df = profile_df.loc[:, [x for x in columns if x in profile_df.columns]]
+
+    return profile_df.reset_index(drop=True)
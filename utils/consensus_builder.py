@@ -0,0 +1,293 @@
+"""
+Build consensus profiles one platemap at a time
+
+Replicate groups never span platemaps (Metadata_Plate_Map_Name is a replicate
+column), so consensus profiles are computed from the replicate plates of one
+platemap at a time and appended to the outputs. Platemaps are processed in sorted
+order, so groups come out in the same order as a consensus over the whole batch
+and the output files are identical.
+"""
+
+import io
+import gzip
+import shutil
+import pathlib
+import numpy as np
+import pandas as pd
+
+from pycytominer import consensus
+
+from catalog import get_plate_file, get_suffix, resolve_plates
+from consensus_qc import consensus_qc
+from groups import (
+    GroupIndex,
+    get_group_index,
+    load_group_indexes,
+    median_consensus,
+    save_group_indexes,
+)
+from loader import load_plates
+from store import append_store, get_store_paths, load_store
+from modz import modz_consensus
+from schema import build_dtypes
+
+# Consensus operations over a shared replicate group index
+consensus_operations = {"median": median_consensus, "modz": modz_consensus}
+
+
+def iter_platemap_profiles(
+    batch, level, normalization, feature_dtype=np.float64, n_jobs=None, where=None
+):
+    """Yield the platemap name and the profiles of its plates, one platemap at a time
+
+    where is a manifest filter (see catalog.resolve_plates), e.g. to load some platemaps
+    """
+    suffix = get_suffix(level, normalization)
+    plates_df = resolve_plates(batch, where=where)
+    for platemap, platemap_df in plates_df.groupby("Metadata_Plate_Map_Name"):
+        profile_files = [
+            get_plate_file(batch, x, suffix) for x in platemap_df.Metadata_Plate
+        ]
+        profile_df = load_plates(
+            profile_files,
+            read_kwargs={"level": level, "feature_dtype": feature_dtype},
+            n_jobs=n_jobs,
+        )
+        yield platemap, profile_df.reset_index(drop=True)
+
+
+def prepare_profiles(platemap_profiles, batch):
+    """Metadata fixes applied before forming consensus profiles"""
+    for platemap, profile_df in platemap_profiles:
+        # Add time metadata for batch 1 data
+        if batch == "2016_04_01_a549_48hr_batch1":
+            profile_df = profile_df.assign(Metadata_time_point="48H")
+
+        # Recode missing MOA and target values to be "unknown"
+        profile_df.Metadata_moa = profile_df.Metadata_moa.fillna("unknown")
+        profile_df.Metadata_target = profile_df.Metadata_target.fillna("unknown")
+
+        yield platemap, profile_df
+
+
+def split_platemaps(profile_df):
+    """Yield the platemap name and profiles of each platemap of a loaded batch"""
+    for platemap, platemap_df in profile_df.groupby("Metadata_Plate_Map_Name"):
+        yield platemap, platemap_df.reset_index(drop=True)
+
+
+def stage_platemap_profiles(
+    platemap_profiles, store_dir, replicate_cols=None, dtype=np.float64
+):
+    """Write platemap profiles to a memory-mapped store, platemap after platemap
+
+    With replicate_cols, the replicate group index of each platemap is built once
+    from the staged metadata and saved with the store (see load_store_group_indexes)
+    """
+    append_store((x for _, x in platemap_profiles), store_dir, dtype=dtype)
+
+    if replicate_cols is not None:
+        metadata_df = load_store(store_dir).metadata
+        save_group_indexes(
+            {
+                platemap: GroupIndex.from_profiles(
+                    metadata_df.iloc[rows].reset_index(drop=True), replicate_cols
+                )
+                for platemap, rows in get_platemap_slices(metadata_df)
+            },
+            get_store_paths(store_dir)["groups"],
+        )
+
+
+def load_store_group_indexes(store_dir):
+    """Replicate group index of each platemap saved with a store, by platemap"""
+    return load_group_indexes(get_store_paths(store_dir)["groups"])
+
+
+def get_platemap_slices(metadata_df):
+    """Yield the platemap name and rows of each platemap, as staged in a store"""
+    platemaps = metadata_df.Metadata_Plate_Map_Name.to_numpy()
+    starts = np.flatnonzero(np.append(True, platemaps[1:] != platemaps[:-1]))
+    stops = np.append(starts[1:], len(platemaps))
+    for start, stop in zip(starts, stops):
+        yield platemaps[start], slice(start, stop)
+
+
+def iter_store_platemaps(store):
+    """Yield the platemap name and profiles of each platemap staged in a store"""
+    for platemap, rows in get_platemap_slices(store.metadata):
+        yield platemap, store.to_frame(rows=rows)
+
+
+def as_written(df, float_format):
+    """Round trip a frame through csv, so values compare as they are written"""
+    csv_buffer = io.StringIO()
+    df.to_csv(csv_buffer, index=False, float_format=float_format)
+    csv_buffer.seek(0)
+    return pd.read_csv(
+        csv_buffer, dtype=build_dtypes(df.columns, feature_dtype=np.float64)
+    )
+
+
+class CsvAppender:
+    """Write a frame to csv chunk by chunk, as a single DataFrame.to_csv() call would
+
+    Gzip output uses the header pandas writes (file name and mtime), so the bytes
+    match pycytominer.cyto_utils.output() of the concatenated frame
+    """
+
+    def __init__(
+        self, output_file, sep=",", float_format=None, compression_options=None
+    ):
+        self.sep = sep
+        self.float_format = float_format
+        self.n_chunks = 0
+
+        if isinstance(compression_options, str):
+            compression_options = {"method": compression_options}
+        compression_options = dict(compression_options or {"method": None})
+        method = compression_options.pop("method")
+
+        if method == "gzip":
+            self.binary_handle = gzip.GzipFile(
+                filename=str(output_file), mode="wb", **compression_options
+            )
+        elif method is None:
+            self.binary_handle = open(output_file, "wb")
+        else:
+            raise ValueError(f"{method} compression is not supported")
+        self.handle = io.TextIOWrapper(self.binary_handle, encoding="utf-8", newline="")
+
+    def append(self, profile_df):
+        profile_df.to_csv(
+            self.handle,
+            sep=self.sep,
+            float_format=self.float_format,
+            header=self.n_chunks == 0,
+            index=False,
+        )
+        self.n_chunks += 1
+
+    def append_csv(self, csv_file):
+        """Append the rows of a csv file written (uncompressed) with the same options"""
+        with open(csv_file, encoding="utf-8", newline="") as csv_fh:
+            header = csv_fh.readline()
+            if self.n_chunks == 0:
+                self.handle.write(header)
+            shutil.copyfileobj(csv_fh, self.handle)
+        self.n_chunks += 1
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def build_consensus(
+    platemap_profiles,
+    replicate_cols,
+    operations,
+    output_files=None,
+    features="infer",
+    float_format=None,
+    compression_options=None,
+    qc_files=None,
+    group_indexes=None,
+    return_qc=False,
+):
+    """Compute consensus profiles platemap by platemap
+
+    platemap_profiles yields (platemap, profiles) pairs, and each operation's
+    consensus is appended to its output file (if given) as each platemap finishes.
+    The replicate QC table (see consensus_qc.py) of the same groups is appended to
+    each of qc_files (if given). group_indexes are prebuilt replicate group indexes
+    by platemap (see load_store_group_indexes), other platemaps are indexed here.
+    Returns the concatenated consensus profiles of each operation, and with
+    return_qc, the concatenated replicate QC table as well.
+
+    QC reuses the replicate weights of the MODZ consensus, if it is one of the
+    operations, rather than running the MODZ pass again.
+    """
+    if output_files is None:
+        output_files = {}
+    if qc_files is None:
+        qc_files = {}
+    if group_indexes is None:
+        group_indexes = {}
+
+    def get_appenders(files):
+        return {
+            operation: CsvAppender(
+                output_file,
+                float_format=float_format,
+                compression_options=compression_options,
+            )
+            for operation, output_file in files.items()
+        }
+
+    appenders = get_appenders(output_files)
+    qc_appenders = get_appenders(qc_files)
+
+    consensus_dfs = {operation: [] for operation in operations}
+    qc_dfs = []
+    try:
+        for platemap, profile_df in platemap_profiles:
+            group_index = group_indexes.get(platemap)
+            if group_index is None or group_index.replicate_cols != replicate_cols:
+                group_index = get_group_index(profile_df, replicate_cols)
+            modz_weights = None
+            for operation in operations:
+                if operation == "modz":
+                    consensus_df, modz_weights = modz_consensus(
+                        profile_df,
+                        replicate_cols,
+                        features=features,
+                        group_index=group_index,
+                        return_weights=True,
+                    )
+                elif operation in consensus_operations:
+                    consensus_df = consensus_operations[operation](
+                        profile_df,
+                        replicate_cols,
+                        features=features,
+                        group_index=group_index,
+                    )
+                else:
+                    consensus_df = consensus(
+                        profiles=profile_df,
+                        replicate_columns=replicate_cols,
+                        operation=operation,
+                        features=features,
+                    )
+                if operation in appenders:
+                    appenders[operation].append(consensus_df)
+                consensus_dfs[operation].append(consensus_df)
+
+            if len(qc_appenders) > 0 or return_qc:
+                qc_df = consensus_qc(
+                    profile_df,
+                    replicate_cols,
+                    features=features,
+                    group_index=group_index,
+                    modz_weights=modz_weights,
+                )
+                for appender in qc_appenders.values():
+                    appender.append(qc_df)
+                if return_qc:
+                    qc_dfs.append(qc_df)
+            del profile_df
+    finally:
+        for appender in [*appenders.values(), *qc_appenders.values()]:
+            appender.close()
+
+    consensus_dfs = {
+        operation: pd.concat(x, ignore_index=True)
+        for operation, x in consensus_dfs.items()
+    }
+    if return_qc:
+        return consensus_dfs, pd.concat(qc_dfs, ignore_index=True)
+    return consensus_dfs
@@ -0,0 +1,72 @@
+"""
+Replicate QC tables that accompany consensus profiles
+
+For each replicate group: the number of replicates, their mean pairwise
+correlation, the plates and MODZ weights of the replicates (in the same order), and
+the median absolute deviation (MAD) of each feature across replicates. Tables are
+computed from the same group index and sorted feature matrix as the consensus
+profiles, and have one row per consensus profile, in the same order.
+"""
+
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import infer_cp_features
+
+from groups import get_group_index, segment_mad
+from modz import compute_modz
+
+
+def join_segments(values, group_index):
+    if group_index.n_groups == 0:
+        return []
+    return [";".join(map(str, x)) for x in np.split(values, group_index.starts[1:])]
+
+
+def consensus_qc(
+    profiles,
+    replicate_cols,
+    features="infer",
+    method="spearman",
+    min_weight=0.01,
+    precision=4,
+    group_index=None,
+    modz_weights=None,
+):
+    """Replicate QC of each replicate group, MAD in the feature columns
+
+    modz_weights are the (weights, mean_cor) of a MODZ pass over the same groups
+    (see modz_consensus(return_weights=True)), computed here if not given
+    """
+    if features == "infer":
+        features = infer_cp_features(profiles)
+    if group_index is None:
+        group_index = get_group_index(profiles, replicate_cols)
+
+    if modz_weights is None:
+        _, weights, mean_cor = compute_modz(
+            profiles,
+            features,
+            group_index,
+            method=method,
+            min_weight=min_weight,
+            precision=precision,
+        )
+    else:
+        weights, mean_cor = modz_weights
+    mad_x = segment_mad(
+        group_index.sort_features(profiles, features, dtype=None), group_index
+    )
+
+    qc_df = group_index.get_keys(profiles).assign(
+        Metadata_n_replicates=group_index.sizes,
+        Metadata_mean_replicate_correlation=mean_cor,
+    )
+    if "Metadata_Plate" in profiles.columns:
+        plates = profiles.Metadata_Plate.to_numpy()[group_index.order]
+        qc_df = qc_df.assign(
+            Metadata_replicate_plates=join_segments(plates, group_index)
+        )
+    qc_df = qc_df.assign(Metadata_modz_weights=join_segments(weights, group_index))
+
+    return pd.concat([qc_df, pd.DataFrame(mad_x, columns=features)], axis="columns")
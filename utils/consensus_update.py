@@ -0,0 +1,379 @@
+"""
+Update consensus outputs after plates are reprocessed, added or removed
+
+A state file records, for each replicate group of a consensus build, the plates
+that contribute to it and the checksum of each plate file. An update compares the
+checksums to the current plate files, reloads only the platemaps of changed plates,
+recomputes only the groups those plates contribute (or contributed) to, and splices
+them into the existing consensus outputs.
+
+Groups are matched as they are written (float metadata such as doses are written
+with the output float format), so spliced outputs are identical to a full rebuild.
+
+A full build selects features on the consensus values it computed, before they are
+written with the output float format. So that an update selects on the same
+values, builds save them next to each consensus file (see write_values), with the
+correlation statistics of the features correlation_threshold sees. Feature
+selection only reruns when the changed groups could alter its decisions: the per
+feature checks are recomputed on the old and updated values, and correlation
+decisions are taken from the statistics, updated with the replaced rows. Otherwise
+the updated consensus keeps the features selected before. Any change of values
+can move a feature across a threshold, so decisions that come within
+correlation.stats_tolerance of one rerun the selection as well.
+"""
+
+import hashlib
+import pathlib
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import output
+
+from catalog import get_plate_file, get_suffix, resolve_plates
+from consensus_builder import (
+    as_written,
+    build_consensus,
+    iter_platemap_profiles,
+    prepare_profiles,
+)
+from correlation import get_correlation_stats, update_correlation_stats
+from feature_selection import feature_select, replay_feature_select
+from groups import GroupIndex
+from schema import build_dtypes, read_profile_columns, read_profiles, split_columns
+
+checksum_chunk_size = 2**20
+
+
+def get_checksum(path, chunk_size=checksum_chunk_size):
+    md5 = hashlib.md5()
+    with open(path, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_plate_checksums(batch, level, normalization):
+    """Checksum of the current profile file of each plate of the batch"""
+    suffix = get_suffix(level, normalization)
+    plates_df = resolve_plates(batch).loc[
+        :, ["Metadata_Plate", "Metadata_Plate_Map_Name"]
+    ]
+    checksums = [
+        get_checksum(get_plate_file(batch, x, suffix)) for x in plates_df.Metadata_Plate
+    ]
+    return plates_df.assign(checksum=checksums)
+
+
+def get_membership(profile_df, replicate_cols, float_format):
+    """Plates contributing to each replicate group"""
+    membership_df = profile_df.loc[:, replicate_cols + ["Metadata_Plate"]]
+    return as_written(membership_df.drop_duplicates(), float_format)
+
+
+def write_state(membership_df, plate_checksums_df, state_file):
+    state_df = membership_df.merge(
+        plate_checksums_df.loc[:, ["Metadata_Plate", "checksum"]],
+        on="Metadata_Plate",
+        how="left",
+    )
+    group_index = GroupIndex.from_profiles(state_df, membership_df.columns.tolist())
+    state_df = state_df.take(group_index.order)
+    state_df.to_csv(state_file, index=False, compression={"method": "gzip", "mtime": 1})
+
+
+def read_state(state_file):
+    columns = pd.read_csv(state_file, nrows=0).columns
+    dtypes = build_dtypes(columns)
+    dtypes.update({"Metadata_Plate": str, "checksum": str})
+    return pd.read_csv(state_file, dtype=dtypes)
+
+
+def get_selection_stats(x, features, feature_select_args):
+    """Correlation statistics of the features correlation_threshold sees, if any"""
+    _, corr_features = replay_feature_select(x, features, **feature_select_args)
+    if corr_features is None:
+        return None
+    corr_x = x[:, [features.index(feature) for feature in corr_features]]
+    if not np.isfinite(corr_x).all():
+        return None
+    return get_correlation_stats(corr_x, corr_features)
+
+
+def write_values(consensus_df, values_file, corr_stats=None):
+    """Save the consensus feature values unrounded, with their correlation statistics"""
+    _, features = split_columns(consensus_df.columns)
+    values = {
+        "features": features,
+        "x": consensus_df.loc[:, features].to_numpy(dtype=np.float64),
+    }
+    if corr_stats is not None:
+        values.update({f"corr_{x}": y for x, y in corr_stats.items()})
+    np.savez(values_file, **values)
+
+
+def read_values(values_file):
+    """The features, values and correlation statistics (or None) of write_values()"""
+    with np.load(values_file) as values:
+        values = dict(values)
+    features = values.pop("features").tolist()
+    x = values.pop("x")
+
+    corr_stats = None
+    if "corr_features" in values:
+        corr_stats = {k[len("corr_") :]: v for k, v in values.items()}
+        corr_stats["features"] = corr_stats["features"].tolist()
+        corr_stats["n"] = corr_stats["n"].item()
+    return features, x, corr_stats
+
+
+def get_changed_plates(state_df, plate_checksums_df):
+    """Plates that were added, removed or whose profile file changed"""
+    old = state_df.drop_duplicates("Metadata_Plate").set_index("Metadata_Plate")
+    new = plate_checksums_df.set_index("Metadata_Plate")
+    plates = old.index.union(new.index)
+    old_checksums = old.checksum.reindex(plates)
+    new_checksums = new.checksum.reindex(plates)
+    return plates[(old_checksums != new_checksums).to_numpy()].tolist()
+
+
+def is_in(df, keys_df):
+    """Whether each row of df has a key (the columns of keys_df) in keys_df"""
+    keys_df = keys_df.drop_duplicates()
+    matched = df.loc[:, keys_df.columns].merge(keys_df, how="left", indicator=True)
+    return (matched._merge == "both").to_numpy()
+
+
+def splice_consensus(consensus_df, update_df, affected_keys_df, replicate_cols):
+    """Replace the affected groups of a consensus by their update, in group order"""
+    keep = ~is_in(consensus_df, affected_keys_df)
+    spliced_df = pd.concat([consensus_df[keep], update_df], ignore_index=True)
+    group_index = GroupIndex.from_profiles(spliced_df, replicate_cols)
+    return spliced_df.take(group_index.order).reset_index(drop=True)
+
+
+def update_feature_select(
+    table_df,
+    spliced_df,
+    affected_keys_df,
+    corr_stats,
+    feature_select_args,
+    feature_select_file,
+):
+    """Feature select a spliced consensus, as the last build did if nothing changed
+
+    The selection reruns only if the decisions it takes on the spliced consensus
+    could differ from those it took on the consensus before (see
+    replay_feature_select), otherwise the features in feature_select_file are kept.
+    Returns the selected consensus and the correlation statistics of its values.
+    """
+    _, features = split_columns(spliced_df.columns)
+    old_x = table_df.loc[:, features].to_numpy(dtype=np.float64)
+    new_x = spliced_df.loc[:, features].to_numpy(dtype=np.float64)
+
+    # Statistics of the spliced values, replacing the rows of the affected groups
+    new_stats = None
+    if corr_stats is not None:
+        new_stats = update_correlation_stats(
+            corr_stats,
+            table_df[is_in(table_df, affected_keys_df)]
+            .loc[:, corr_stats["features"]]
+            .to_numpy(dtype=np.float64),
+            spliced_df[is_in(spliced_df, affected_keys_df)]
+            .loc[:, corr_stats["features"]]
+            .to_numpy(dtype=np.float64),
+        )
+
+    old_exclusions, _ = replay_feature_select(
+        old_x, features, corr_stats=corr_stats, **feature_select_args
+    )
+    new_exclusions, _ = replay_feature_select(
+        new_x, features, corr_stats=new_stats, **feature_select_args
+    )
+    if old_exclusions is not None and new_exclusions == old_exclusions:
+        return spliced_df.loc[:, read_profile_columns(feature_select_file)], new_stats
+
+    selected_df = feature_select(spliced_df, **feature_select_args)
+    return selected_df, get_selection_stats(new_x, features, feature_select_args)
+
+
+def update_consensus(
+    batch,
+    normalization,
+    replicate_cols,
+    operations,
+    consensus_files,
+    state_file,
+    values_files=None,
+    feature_select_args=None,
+    feature_select_files=None,
+    qc_files=None,
+    level="level_4a",
+    feature_dtype=np.float64,
+    float_format=None,
+    compression_options=None,
+):
+    """Recompute the consensus groups of changed plates and splice them into the outputs
+
+    values_files hold the unrounded values of each consensus (see write_values), and
+    are updated too. With feature_select_args (keyword arguments of feature_select()),
+    the feature selected consensus is written to feature_select_files. Replicate QC
+    tables in qc_files (if any) are spliced as well. Returns the changed plates and
+    the number of updated groups.
+    """
+    if values_files is None:
+        values_files = {}
+    if qc_files is None:
+        qc_files = {}
+
+    # Feature selection of an update runs on the values the last build saved
+    missing = [
+        x
+        for x in operations
+        if x not in values_files or not pathlib.Path(values_files[x]).exists()
+    ]
+    if feature_select_args is not None and len(missing) > 0:
+        raise ValueError(
+            f"The unrounded {missing} consensus values of the last build are missing, "
+            "rebuild the consensus to save them"
+        )
+
+    state_df = read_state(state_file)
+    plate_checksums_df = get_plate_checksums(batch, level, normalization)
+    changed_plates = get_changed_plates(state_df, plate_checksums_df)
+    if len(changed_plates) == 0:
+        return changed_plates, 0
+
+    # Changed plates only contribute to groups of their (old or new) platemaps
+    platemaps = pd.concat(
+        [
+            state_df.query("Metadata_Plate in @changed_plates").Metadata_Plate_Map_Name,
+            plate_checksums_df.query(
+                "Metadata_Plate in @changed_plates"
+            ).Metadata_Plate_Map_Name,
+        ]
+    )
+    platemaps = sorted(set(platemaps.astype(str)))
+    platemap_profiles = iter_platemap_profiles(
+        batch,
+        level=level,
+        normalization=normalization,
+        feature_dtype=feature_dtype,
+        where=f"Metadata_Plate_Map_Name in {platemaps}",
+    )
+
+    # Groups that changed plates contributed to before, and contribute to now
+    affected_keys = [
+        state_df.query("Metadata_Plate in @changed_plates").loc[:, replicate_cols]
+    ]
+    membership_dfs = [state_df.query("Metadata_Plate_Map_Name not in @platemaps")]
+    profile_dfs = []
+    for _, profile_df in prepare_profiles(platemap_profiles, batch):
+        membership_df = get_membership(profile_df, replicate_cols, float_format)
+        membership_dfs.append(membership_df)
+        affected_keys.append(
+            membership_df.query("Metadata_Plate in @changed_plates").loc[
+                :, replicate_cols
+            ]
+        )
+        profile_dfs.append(profile_df)
+    affected_keys_df = pd.concat(affected_keys).drop_duplicates()
+
+    # Recompute only the affected groups, as they are written
+    update_profiles = []
+    for profile_df in profile_dfs:
+        keys_df = as_written(profile_df.loc[:, replicate_cols], float_format)
+        profile_df = profile_df[is_in(keys_df, affected_keys_df)]
+        if profile_df.shape[0] > 0:
+            update_profiles.append((None, profile_df.reset_index(drop=True)))
+    # The QC table of each group does not depend on the consensus operation
+    update_dfs = {}
+    qc_df = None
+    if len(update_profiles) > 0:
+        update_dfs = build_consensus(
+            update_profiles,
+            replicate_cols=replicate_cols,
+            operations=operations,
+            return_qc=len(qc_files) > 0,
+        )
+        if len(qc_files) > 0:
+            update_dfs, qc_df = update_dfs
+
+    def splice_file(table_file, update_df, values_file=None):
+        table_df = read_profiles(table_file, level="level_5", feature_dtype=np.float64)
+        _, features = split_columns(table_df.columns)
+        if values_file is not None:
+            # Spliced with unrounded values, which are written as a rebuild writes them
+            values_features, x, _ = read_values(values_file)
+            if values_features != features or x.shape[0] != table_df.shape[0]:
+                raise ValueError(f"{values_file} does not match {table_file}")
+            table_df.loc[:, features] = x
+
+        if update_df is None:
+            # Only plates of removed platemaps changed
+            update_df = table_df.iloc[:0]
+        elif values_file is None:
+            update_df = as_written(update_df, float_format)
+        else:
+            update_df = pd.concat(
+                [
+                    as_written(update_df.drop(features, axis="columns"), float_format),
+                    update_df.loc[:, features].reset_index(drop=True),
+                ],
+                axis="columns",
+            )
+
+        spliced_df = splice_consensus(
+            table_df, update_df, affected_keys_df, replicate_cols
+        )
+        if spliced_df.equals(table_df):
+            return None
+
+        output(
+            df=spliced_df,
+            output_filename=table_file,
+            sep=",",
+            float_format=float_format,
+            compression_options=compression_options,
+        )
+        return table_df, spliced_df
+
+    for operation in operations:
+        values_file = values_files.get(operation)
+        spliced = splice_file(
+            consensus_files[operation], update_dfs.get(operation), values_file
+        )
+        if spliced is None or values_file is None:
+            continue
+
+        table_df, spliced_df = spliced
+        corr_stats = None
+        if feature_select_args is not None:
+            selected_df, corr_stats = update_feature_select(
+                table_df,
+                spliced_df,
+                affected_keys_df,
+                read_values(values_file)[2],
+                feature_select_args,
+                feature_select_files[operation],
+            )
+            output(
+                df=selected_df,
+                output_filename=feature_select_files[operation],
+                sep=",",
+                float_format=float_format,
+                compression_options=compression_options,
+            )
+        write_values(spliced_df, values_file, corr_stats)
+
+    for qc_file in qc_files.values():
+        if pathlib.Path(qc_file).exists():
+            splice_file(qc_file, qc_df)
+
+    write_state(
+        pd.concat(membership_dfs, ignore_index=True).loc[
+            :, replicate_cols + ["Metadata_Plate"]
+        ],
+        plate_checksums_df,
+        state_file,
+    )
+    return changed_plates, affected_keys_df.shape[0]
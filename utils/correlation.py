@@ -0,0 +1,215 @@
+"""
+Blocked float32 engine for the correlation_threshold feature selection operation
+
+Features are standardized once, and feature-by-feature correlations are computed
+in cache-sized float32 blocks of the lower triangle. Each block adds to the
+absolute correlation sums and contributes its highly correlated pairs, so the full
+correlation matrix is never held in memory. Borderline correlations and close
+correlation sums are refined in float64, so the excluded features match
+pycytominer's correlation_threshold at the same threshold.
+"""
+
+import numpy as np
+
+from pycytominer.cyto_utils import infer_cp_features
+from pycytominer.operations import correlation_threshold as pycytominer_correlation
+
+# Error bounds for float32 block products, beyond which float64 values are computed
+corr_tolerance = 1e-4
+sum_tolerance = 1e-5
+tie_tolerance = 1e-9
+
+# Candidate pairs confirmed in float64 at a time
+pair_chunk_size = 4096
+
+# Margin around decisions taken from updated correlation statistics, within which
+# they are not trusted
+stats_tolerance = 1e-9
+
+
+def standardize(x, dtype=np.float64):
+    # Columns scaled to unit norm, so that z.T @ z is the correlation matrix
+    centered = x - x.mean(axis=0)
+    norms = np.sqrt((centered**2).sum(axis=0))
+    constant = norms == 0
+    norms[constant] = 1
+    z = (centered / norms).astype(dtype, copy=False)
+    z[:, constant] = 0
+    return z, constant
+
+
+def get_blocks(n_features, block_size):
+    return [
+        np.arange(start, min(start + block_size, n_features))
+        for start in range(0, n_features, block_size)
+    ]
+
+
+def exact_cor_sums(x, feature_idx, block_size):
+    z64, _ = standardize(x)
+    sums = np.zeros(len(feature_idx))
+    for block in get_blocks(z64.shape[1], block_size):
+        sums += np.abs(z64[:, feature_idx].T @ z64[:, block]).sum(axis=1)
+    return sums
+
+
+def blocked_correlation_pairs(x, threshold, block_size=256):
+    z, constant = standardize(x, dtype=np.float32)
+    n_features = z.shape[1]
+
+    cor_sums = np.zeros(n_features, dtype=np.float64)
+    pair_a = []
+    pair_b = []
+    for i, block_i in enumerate(get_blocks(n_features, block_size)):
+        z_i = z[:, block_i]
+        for block_j in get_blocks(n_features, block_size)[: i + 1]:
+            cor_block = z_i.T @ z[:, block_j]
+            abs_block = np.abs(cor_block, dtype=np.float64)
+            cor_sums[block_i] += abs_block.sum(axis=1)
+
+            if block_j[0] == block_i[0]:
+                # Diagonal block: keep the strict lower triangle for pairs
+                cor_block = np.tril(cor_block, k=-1)
+            else:
+                cor_sums[block_j] += abs_block.sum(axis=0)
+
+            rows, cols = np.nonzero(cor_block > threshold - corr_tolerance)
+            pair_a.append(block_i[rows])
+            pair_b.append(block_j[cols])
+
+    # Constant features have undefined correlations and are never in a pair
+    cor_sums[constant] = 0
+    pair_a = np.concatenate(pair_a)
+    pair_b = np.concatenate(pair_b)
+
+    # Confirm candidate pairs in float64
+    if len(pair_a) > 0:
+        z64, _ = standardize(x)
+        exact = np.concatenate(
+            [
+                np.einsum(
+                    "ij,ij->j",
+                    z64[:, pair_a[start : start + pair_chunk_size]],
+                    z64[:, pair_b[start : start + pair_chunk_size]],
+                )
+                > threshold
+                for start in range(0, len(pair_a), pair_chunk_size)
+            ]
+        )
+        pair_a, pair_b = pair_a[exact], pair_b[exact]
+
+    return cor_sums, pair_a, pair_b
+
+
+def correlation_threshold(
+    population_df,
+    features="infer",
+    samples="all",
+    threshold=0.9,
+    method="pearson",
+    block_size=256,
+):
+    """Return the features to exclude, matching pycytominer's correlation_threshold"""
+    if not 0 <= threshold <= 1:
+        raise ValueError("threshold variable must be between (0 and 1)")
+
+    if samples != "all":
+        population_df = population_df.query(samples)
+
+    if features == "infer":
+        features = infer_cp_features(population_df)
+
+    x = population_df.loc[:, features].to_numpy(dtype=np.float64)
+
+    # Rank correlations and pairwise complete observations need the full matrix
+    if method != "pearson" or not np.isfinite(x).all():
+        return pycytominer_correlation(
+            population_df,
+            features=features,
+            threshold=threshold,
+            method=method,
+        )
+
+    cor_sums, pair_a, pair_b = blocked_correlation_pairs(
+        x, threshold=threshold, block_size=block_size
+    )
+    if len(pair_a) == 0:
+        return []
+
+    # Refine the sums that decide a pair but are too close to trust in float32
+    tolerance = sum_tolerance * len(features)
+    close = np.abs(cor_sums[pair_a] - cor_sums[pair_b]) < tolerance
+    refine_idx = np.unique(np.concatenate([pair_a[close], pair_b[close]]))
+    if len(refine_idx) > 0:
+        cor_sums[refine_idx] = exact_cor_sums(x, refine_idx, block_size)
+
+    # Duplicated features tie exactly, pycytominer's sort order decides between them
+    if (np.abs(cor_sums[pair_a] - cor_sums[pair_b]) < tie_tolerance).any():
+        return pycytominer_correlation(
+            population_df, features=features, threshold=threshold, method=method
+        )
+
+    # Of each highly correlated pair, drop the feature more correlated to all others
+    sum_rank = np.empty(len(features), dtype=np.intp)
+    sum_rank[np.argsort(cor_sums)] = np.arange(len(features))
+    excluded = np.where(sum_rank[pair_a] > sum_rank[pair_b], pair_a, pair_b)
+
+    return list(set(np.array(features)[excluded].tolist()))
+
+
+def get_correlation_stats(x, features):
+    """Sufficient statistics of the correlations between the columns of x
+
+    Cross products are taken around the column means of x, and stay accurate as
+    rows are replaced (see update_correlation_stats)
+    """
+    shift = x.mean(axis=0)
+    deviations = x - shift
+    return {
+        "features": list(features),
+        "n": x.shape[0],
+        "shift": shift,
+        "sums": deviations.sum(axis=0),
+        "cross": deviations.T @ deviations,
+    }
+
+
+def update_correlation_stats(stats, removed_x, added_x):
+    """Correlation statistics after removing and adding rows"""
+    removed = removed_x - stats["shift"]
+    added = added_x - stats["shift"]
+    return dict(
+        stats,
+        n=stats["n"] - removed.shape[0] + added.shape[0],
+        sums=stats["sums"] - removed.sum(axis=0) + added.sum(axis=0),
+        cross=stats["cross"] - removed.T @ removed + added.T @ added,
+    )
+
+
+def stats_correlation_threshold(stats, threshold=0.9):
+    """The features correlation_threshold() excludes, from correlation statistics
+
+    Returns None when a correlation or a correlation sum deciding a pair is within
+    stats_tolerance of the decision, or when a feature is (nearly) constant.
+    """
+    cov = stats["cross"] - np.outer(stats["sums"], stats["sums"]) / stats["n"]
+    var = np.diag(cov).copy()
+    if (var <= stats_tolerance * np.diag(stats["cross"])).any():
+        return None
+    cor = cov / np.sqrt(np.outer(var, var))
+
+    # Pairs of the strict lower triangle, as in blocked_correlation_pairs()
+    pair_a, pair_b = np.tril_indices(len(var), k=-1)
+    pair_cor = cor[pair_a, pair_b]
+    if (np.abs(pair_cor - threshold) < stats_tolerance).any():
+        return None
+    pair_a, pair_b = pair_a[pair_cor > threshold], pair_b[pair_cor > threshold]
+
+    # Of each highly correlated pair, drop the feature more correlated to all others
+    cor_sums = np.abs(cor).sum(axis=1)
+    tolerance = stats_tolerance * len(cor_sums)
+    if (np.abs(cor_sums[pair_a] - cor_sums[pair_b]) < tolerance).any():
+        return None
+    excluded = np.where(cor_sums[pair_a] > cor_sums[pair_b], pair_a, pair_b)
+
+    return list(set(np.array(stats["features"])[excluded].tolist()))
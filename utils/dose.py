@@ -1,11 +1,50 @@
 import numpy as np
 
+# Most Drug Repurposing Hub doses are near these dose points (mmoles per liter)
+primary_dose_mapping = [0.04, 0.12, 0.37, 1.11, 3.33, 10, 20]
+
+# Batches profiled on a different dose ladder than the primary dose points
+# Batch 2 doses stay below 20 mM, so its 6 dose points are the first 6 primary ones
+batch_dose_ladders = {"2017_12_05_Batch2": primary_dose_mapping[:6]}
+
+
+def get_dose_ladder(batch):
+    return batch_dose_ladders.get(batch, primary_dose_mapping)
+
+
+def recode_doses(x, doses, return_level=False):
+    """Recode every dose in x to its nearest dose point in one vectorized pass
+
+    Levels count from 1 in the order doses are given and missing doses recode to 0.
+    Doses halfway between two dose points recode to the first one given.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    doses = np.asarray(doses, dtype=np.float64)
+
+    # Nearest neighbours are the sorted dose points on either side of each value,
+    # a repeated dose point keeps its first position
+    sorted_doses, order = np.unique(doses, return_index=True)
+    right = np.clip(np.searchsorted(sorted_doses, x), 1, len(sorted_doses) - 1)
+    left = right - 1
+    if len(sorted_doses) == 1:
+        left = right = np.zeros_like(right)
+
+    left_distance = np.abs(sorted_doses[left] - x)
+    right_distance = np.abs(sorted_doses[right] - x)
+    closest = np.where(
+        (left_distance < right_distance)
+        | ((left_distance == right_distance) & (order[left] < order[right])),
+        order[left],
+        order[right],
+    )
+
+    missing = np.isnan(x)
+    if return_level:
+        return np.where(missing, 0, closest + 1)
+    return np.where(missing, 0, doses[closest])
+
 
 def recode_dose(x, doses, return_level=False):
-    closest_index = np.argmin([np.abs(dose - x) for dose in doses])
     if np.isnan(x):
         return 0
-    if return_level:
-        return closest_index + 1
-    else:
-        return doses[closest_index]
+    return recode_doses([x], doses, return_level=return_level)[0]
@@ -0,0 +1,209 @@
+"""
+Feature selection with the blocked correlation_threshold engine
+
+A drop-in replacement for pycytominer.feature_select(). Operations run in the same
+order and each operation sees only the features kept by the previous ones, but the
+correlation_threshold operation runs on the blocked float32 engine, and the
+variance, frequency and missing value checks run on parallel feature-wise kernels.
+"""
+
+import inspect
+import numpy as np
+import pandas as pd
+
+from pycytominer import feature_select as pycytominer_feature_select
+from pycytominer.cyto_utils import infer_cp_features, load_profiles, output
+from pycytominer.operations import variance_threshold as pycytominer_variance_threshold
+
+from correlation import correlation_threshold, stats_correlation_threshold
+from frame import ProfileFrame
+from kernels import frequency_stats, na_fraction, variance
+
+# The pinned pycytominer checks value frequencies in variance_threshold, later
+# releases check the variance there and moved frequencies to frequency_threshold
+frequency_variance_threshold = (
+    "freq_cut" in inspect.signature(pycytominer_variance_threshold).parameters
+)
+
+
+def get_na_columns(x, na_cutoff=0.05, n_jobs=None, **kwargs):
+    return na_fraction(x, n_jobs) > na_cutoff
+
+
+def frequency_threshold(x, freq_cut=0.05, unique_cut=0.01, n_jobs=None, **kwargs):
+    stats = frequency_stats(x, n_jobs)
+    return (stats["freq_ratio"] < freq_cut) | (
+        stats["n_unique"] / x.shape[0] < unique_cut
+    )
+
+
+def variance_threshold(x, min_variance=1e-6, n_jobs=None, **kwargs):
+    if frequency_variance_threshold:
+        return frequency_threshold(x, n_jobs=n_jobs, **kwargs)
+    return ~(variance(x, n_jobs) > min_variance)
+
+
+# Operations deciding on each feature independently, returning a mask of exclusions
+feature_kernels = {
+    "drop_na_columns": get_na_columns,
+    "frequency_threshold": frequency_threshold,
+    "variance_threshold": variance_threshold,
+}
+
+
+# Operations deciding on feature names alone
+name_ops = ["blocklist"]
+
+
+def run_pycytominer_op(profiles, op, features, samples, **kwargs):
+    selected_df = pycytominer_feature_select(
+        profiles=profiles,
+        features=features,
+        samples=samples,
+        operation=[op],
+        **kwargs,
+    )
+    return [x for x in features if x not in selected_df.columns]
+
+
+def feature_select(
+    profiles,
+    features="infer",
+    samples="all",
+    operation="variance_threshold",
+    output_file=None,
+    corr_threshold=0.9,
+    corr_method="pearson",
+    compression_options=None,
+    float_format=None,
+    block_size=256,
+    n_jobs=None,
+    **kwargs,
+):
+    """Select features as pycytominer.feature_select() does
+
+    A ProfileFrame input returns a ProfileFrame selecting the kept features.
+    Additional keyword arguments are passed to pycytominer.feature_select()
+    """
+    if isinstance(operation, str):
+        operation = [operation]
+
+    profile_frame = None
+    if isinstance(profiles, ProfileFrame):
+        # Select on the feature matrix, without copying it into a profile table
+        profile_frame = profiles
+        profiles = pd.DataFrame(
+            profile_frame.values, columns=profile_frame.features, copy=False
+        )
+        metadata_df = profile_frame.metadata
+    else:
+        profiles = load_profiles(profiles)
+        metadata_df = profiles
+
+    if features == "infer":
+        features = infer_cp_features(profiles)
+
+    # Operations see the sample rows only, so they run with samples="all"
+    sample_df = profiles
+    if samples != "all":
+        sample_df = profiles.loc[metadata_df.eval(samples).to_numpy(dtype=bool)]
+
+    excluded_features = []
+    for op in operation:
+        if op in feature_kernels:
+            x = sample_df.loc[:, features].to_numpy()
+            excluded = feature_kernels[op](x, n_jobs=n_jobs, **kwargs)
+            exclude = np.array(features)[excluded].tolist()
+        elif op == "correlation_threshold":
+            exclude = correlation_threshold(
+                sample_df,
+                features=features,
+                threshold=corr_threshold,
+                method=corr_method,
+                block_size=block_size,
+            )
+        else:
+            op_df = sample_df
+            if profile_frame is not None:
+                # Other operations may read metadata, such as noise_removal groups
+                op_df = pd.concat(
+                    [metadata_df.loc[sample_df.index], sample_df], axis="columns"
+                )
+            exclude = run_pycytominer_op(op_df, op, features, "all", **kwargs)
+
+        excluded_features += exclude
+        features = [x for x in features if x not in set(excluded_features)]
+
+    excluded_features = set(excluded_features)
+    if profile_frame is not None:
+        profile_frame = profile_frame.drop(excluded_features)
+        if output_file in [None, "none"]:
+            return profile_frame
+        selected_df = profile_frame.to_pandas()
+    else:
+        selected_df = profiles.drop(list(excluded_features), axis="columns")
+
+    if output_file not in [None, "none"]:
+        output(
+            df=selected_df,
+            output_filename=output_file,
+            compression_options=compression_options,
+            float_format=float_format,
+        )
+    else:
+        return selected_df
+
+
+def replay_feature_select(
+    x,
+    features,
+    operation,
+    corr_stats=None,
+    corr_threshold=0.9,
+    corr_method="pearson",
+    n_jobs=None,
+    **kwargs,
+):
+    """Replay the decisions feature_select() takes on all rows of feature matrix x
+
+    Per feature operations are recomputed, correlation_threshold decisions are taken
+    from the correlation statistics of the features it sees (corr_stats, see
+    correlation.get_correlation_stats) and blocklist decisions from feature names.
+    Returns the features each operation excludes, or None if a decision cannot be
+    replayed (see correlation.stats_correlation_threshold, or an operation reading
+    profile values other than these), and the features correlation_threshold sees.
+    """
+    if isinstance(operation, str):
+        operation = [operation]
+
+    x = np.asarray(x)
+    columns = {feature: idx for idx, feature in enumerate(features)}
+    exclusions = []
+    corr_features = None
+    for op in operation:
+        feature_x = x[:, [columns[feature] for feature in features]]
+        if op in feature_kernels:
+            excluded = feature_kernels[op](feature_x, n_jobs=n_jobs, **kwargs)
+            exclude = np.array(features)[excluded].tolist()
+        elif op == "correlation_threshold":
+            corr_features = features
+            if (
+                corr_stats is None
+                or corr_method != "pearson"
+                or corr_stats["features"] != features
+                or not np.isfinite(feature_x).all()
+            ):
+                return None, corr_features
+            exclude = stats_correlation_threshold(corr_stats, threshold=corr_threshold)
+            if exclude is None:
+                return None, corr_features
+        elif op in name_ops:
+            profiles = pd.DataFrame(feature_x[:1], columns=features)
+            exclude = run_pycytominer_op(profiles, op, features, "all", **kwargs)
+        else:
+            return None, corr_features
+
+        exclusions.append(sorted(exclude))
+        features = [x for x in features if x not in set(exclude)]
+
+    return exclusions, corr_features
@@ -0,0 +1,113 @@
+"""
+Hold profiles as a metadata table next to one contiguous feature matrix
+
+Metadata and features are split once when profiles enter the pipeline. Metadata
+stay a small (categorical) table that can be renamed and assigned to cheaply, and
+features stay a single float matrix with a feature name index. Selecting features
+only records column positions, so the matrix is copied once, when it is needed.
+"""
+
+import io
+import collections
+import numpy as np
+import pandas as pd
+
+from schema import split_columns
+
+
+def categorize(metadata_df):
+    # Strings read as object columns, or as string columns in later pandas releases
+    string_cols = metadata_df.select_dtypes(include=["object", "string"]).columns
+    return metadata_df.astype({x: "category" for x in string_cols})
+
+
+class ProfileFrame(
+    collections.namedtuple(
+        "ProfileFrame", ["metadata", "features", "matrix", "columns"], defaults=[None]
+    )
+):
+    __slots__ = ()
+
+    @classmethod
+    def from_pandas(
+        cls,
+        profile_df,
+        features="infer",
+        meta_features="infer",
+        dtype=None,
+        categorical_metadata=True,
+    ):
+        metadata_cols, feature_cols = split_columns(profile_df.columns)
+        if features == "infer":
+            features = feature_cols
+        if meta_features == "infer":
+            meta_features = metadata_cols
+
+        metadata_df = profile_df.loc[:, meta_features].reset_index(drop=True)
+        if categorical_metadata:
+            metadata_df = categorize(metadata_df)
+
+        matrix = np.ascontiguousarray(profile_df.loc[:, features].to_numpy(dtype=dtype))
+        return cls(metadata=metadata_df, features=list(features), matrix=matrix)
+
+    @property
+    def shape(self):
+        return (self.metadata.shape[0], len(self.features))
+
+    @property
+    def values(self):
+        # Materialize pending feature selections
+        if self.columns is None:
+            return self.matrix
+        return self.matrix[:, self.columns]
+
+    def feature_index(self, features):
+        lookup = {feature: idx for idx, feature in enumerate(self.features)}
+        return np.array([lookup[x] for x in features], dtype=np.intp)
+
+    def column(self, feature):
+        idx = self.feature_index([feature])[0]
+        if self.columns is not None:
+            idx = self.columns[idx]
+        return self.matrix[:, idx]
+
+    def select(self, features):
+        idx = self.feature_index(features)
+        if self.columns is not None:
+            idx = self.columns[idx]
+        return self._replace(features=list(features), columns=idx)
+
+    def drop(self, features):
+        features = set(features)
+        return self.select([x for x in self.features if x not in features])
+
+    def with_metadata(self, metadata_df):
+        assert metadata_df.shape[0] == self.shape[0], "Metadata rows do not match"
+        return self._replace(metadata=metadata_df.reset_index(drop=True))
+
+    def with_matrix(self, matrix, features=None):
+        if features is None:
+            features = self.features
+        assert matrix.shape == (self.shape[0], len(features)), "Matrix shape differs"
+        return self._replace(features=list(features), matrix=matrix, columns=None)
+
+    def as_written(self, float_format, dtype=np.float64):
+        """Features as they read back from a file written with float_format"""
+        csv_buffer = io.StringIO()
+        pd.DataFrame(self.values).to_csv(
+            csv_buffer, index=False, header=False, float_format=float_format
+        )
+        csv_buffer.seek(0)
+        matrix = pd.read_csv(csv_buffer, header=None, dtype=dtype).to_numpy()
+        return self.with_matrix(matrix.reshape(self.shape))
+
+    def to_pandas(self, categorical_metadata=False):
+        metadata_df = self.metadata
+        if not categorical_metadata:
+            categorical_cols = metadata_df.select_dtypes("category").columns
+            metadata_df = metadata_df.astype(
+                {x: metadata_df[x].cat.categories.dtype for x in categorical_cols}
+            )
+
+        feature_df = pd.DataFrame(self.values, columns=self.features, copy=False)
+        return pd.concat([metadata_df, feature_df], axis="columns")
@@ -0,0 +1,232 @@
+"""
+Run feature selection and spherize over groups of profiles on a process pool
+
+Profiles are split by their group keys (e.g. cell line and time point) once, with
+a group index (see groups.py), and every group is processed as its own task. Each
+task returns only what the next step needs (the features it selects, or its
+spherized matrix), and spherized groups are copied into a single preallocated
+matrix, so group results are never concatenated. Spherized rows keep their input
+order, as groupby(group_cols).apply(spherize) returns them (each group keeps its
+index).
+
+Groups can also be spherized from their plate files, without loading the batch:
+each task fits its group's transform from plates streamed one at a time, saves
+it, and writes the group's spherized plates to a part file. Parts are appended to
+the output in group order, so the file is the one a serial run would write.
+Groups of plates come from the plate manifest, see check_groups() to confirm they
+are the groups of the loaded profiles.
+"""
+
+import pathlib
+import tempfile
+import functools
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import infer_cp_features
+
+from consensus_builder import CsvAppender
+from feature_selection import feature_select
+from groups import GroupIndex
+from loader import iter_plates
+from spherize import apply_spherize, fit_spherize_plates, save_spherize, spherize
+
+
+class GroupExecutor:
+    """Split profiles by group keys once and map tasks over the groups"""
+
+    def __init__(self, profiles, group_cols, n_jobs=None):
+        self.profiles = profiles
+        self.group_cols = list(group_cols)
+        self.n_jobs = n_jobs
+        self.group_index = GroupIndex.from_profiles(profiles, self.group_cols)
+
+    def get_group(self, group, columns=None):
+        group_df = self.profiles.take(self.group_index.get_rows(group))
+        if columns is not None:
+            group_df = group_df.loc[:, columns]
+        return group_df
+
+    def get_keys(self):
+        """Group columns of each group, in group order"""
+        return self.group_index.get_keys(self.profiles)
+
+    def map(self, func, columns=None, **kwargs):
+        """Results of func(group profiles, **kwargs), in group order"""
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+            futures = [
+                pool.submit(func, self.get_group(group, columns=columns), **kwargs)
+                for group in range(self.group_index.n_groups)
+            ]
+            return [future.result() for future in futures]
+
+
+def get_selected_features(profiles, **kwargs):
+    # Groups already run in parallel, so feature selection stays on one thread
+    selected_df = feature_select(profiles=profiles, n_jobs=1, **kwargs)
+    return infer_cp_features(selected_df)
+
+
+def get_spherized_features(profiles, features, **kwargs):
+    spherize_df = spherize(profiles, features=features, meta_features=[], **kwargs)
+    return spherize_df.to_numpy()
+
+
+def feature_select_groups(group_executor, features="infer", **kwargs):
+    """Features selected in every group, in profile column order
+
+    As feature selection of each group, followed by drop_na_columns (with
+    na_cutoff=0) over the concatenated groups
+    """
+    if features == "infer":
+        features = infer_cp_features(group_executor.profiles)
+
+    metadata_cols = infer_cp_features(group_executor.profiles, metadata=True)
+    group_features = group_executor.map(
+        get_selected_features,
+        columns=metadata_cols + features,
+        features="infer",
+        **kwargs,
+    )
+
+    selected = set.intersection(*[set(x) for x in group_features])
+    return [x for x in features if x in selected]
+
+
+def spherize_groups(
+    group_executor, features, meta_features="infer", dtype=None, **kwargs
+):
+    """Spherize each group with its own transform, as groupby().apply(spherize)"""
+    profiles = group_executor.profiles
+    group_index = group_executor.group_index
+    if meta_features == "infer":
+        meta_features = infer_cp_features(profiles, metadata=True)
+    if dtype is None:
+        dtype = np.result_type(*profiles.dtypes[features])
+
+    # The reference query needs metadata, only spherized features come back
+    group_matrices = group_executor.map(
+        get_spherized_features,
+        columns=meta_features + features,
+        features=features,
+        dtype=dtype,
+        **kwargs,
+    )
+
+    # Each group's rows go back to their input positions
+    spherized_x = np.empty((len(group_index.order), len(features)), dtype=dtype)
+    for group, group_x in enumerate(group_matrices):
+        spherized_x[group_index.get_rows(group)] = group_x
+    del group_matrices
+
+    # PCA whitening returns principal components rather than features
+    if kwargs.get("method", "ZCA-cor").startswith("PCA"):
+        columns = [f"PC{x}" for x in range(1, len(features) + 1)]
+    else:
+        columns = features
+
+    spherize_df = pd.DataFrame(
+        spherized_x, columns=columns, index=profiles.index, copy=False
+    )
+    for position, col in enumerate(meta_features):
+        spherize_df.insert(position, col, profiles[col])
+
+    return spherize_df
+
+
+def check_groups(group_executor, groups):
+    """Raise a ValueError unless groups (dicts of group keys, e.g. from the plate
+    manifest) are the groups of the profiles, in group order
+    """
+    keys_df = group_executor.get_keys().astype(str)
+    groups_df = pd.DataFrame(list(groups), columns=group_executor.group_cols)
+    if not keys_df.equals(groups_df.astype(str)):
+        raise ValueError(
+            f"Groups {groups_df.to_dict(orient='records')} are not the groups of "
+            f"the profiles {keys_df.to_dict(orient='records')}"
+        )
+
+
+def spherize_plate_group(
+    plate_files,
+    features,
+    part_file,
+    read_kwargs=None,
+    transform_file=None,
+    group_keys=None,
+    samples="all",
+    **kwargs,
+):
+    """Fit, save and apply the transform of one group of plates, into part_file"""
+    # Groups already run in parallel, so plates are read on one thread
+    get_plates = functools.partial(
+        iter_plates, plate_files, read_kwargs=read_kwargs, n_jobs=1
+    )
+    fitted_spherize = fit_spherize_plates(
+        get_plates, features=features, samples=samples, **kwargs
+    )
+    if transform_file is not None:
+        save_spherize(
+            fitted_spherize,
+            transform_file,
+            features=features,
+            group_keys=group_keys,
+            samples=samples,
+        )
+
+    with CsvAppender(part_file) as appender:
+        for plate_df in get_plates():
+            appender.append(
+                apply_spherize(fitted_spherize, plate_df, features=features)
+            )
+    return part_file
+
+
+def spherize_plate_groups(
+    group_plates,
+    features,
+    output_file,
+    read_kwargs=None,
+    transform_files=None,
+    samples="all",
+    compression_options=None,
+    n_jobs=None,
+    **kwargs,
+):
+    """Spherize groups of plates with their own transforms, a group per process
+
+    group_plates is a list of (group keys, plate files) pairs, and transform_files
+    (if given) the file each group's transform is saved to. Groups are written to
+    output_file in list order.
+    """
+    if transform_files is None:
+        transform_files = [None] * len(group_plates)
+
+    with tempfile.TemporaryDirectory() as part_dir:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [
+                pool.submit(
+                    spherize_plate_group,
+                    plate_files,
+                    features,
+                    f"{part_dir}/{group}.csv",
+                    read_kwargs=read_kwargs,
+                    transform_file=transform_file,
+                    group_keys=group_keys,
+                    samples=samples,
+                    **kwargs,
+                )
+                for group, ((group_keys, plate_files), transform_file) in enumerate(
+                    zip(group_plates, transform_files)
+                )
+            ]
+
+            # Each part is appended as soon as the groups before it are written
+            with CsvAppender(
+                output_file, compression_options=compression_options
+            ) as appender:
+                for future in futures:
+                    part_file = future.result()
+                    appender.append_csv(part_file)
+                    pathlib.Path(part_file).unlink()
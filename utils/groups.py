@@ -0,0 +1,232 @@
+"""
+Replicate group index shared by consensus operations
+
+Replicate keys are factorized once into integer codes, rows are sorted by group,
+and each group is a contiguous segment of the sorted rows. Groups are in pandas
+groupby(sort=True, dropna=False) order, so consensus profiles computed over the
+segments come out as pycytominer.consensus() output. Indexes are cached per
+frame, so median, MODZ and other aggregations of the same frame share one index,
+and can be saved next to a store so processes mapping it do not rebuild them.
+"""
+
+import weakref
+import warnings
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import infer_cp_features
+
+# Elements of the (groups, replicates, features) blocks processed at a time
+block_elements = 2**24
+
+# Largest groups whose median is found with a sorting network
+max_network_size = 16
+
+# Group indexes of live frames, by frame id and replicate columns
+group_indexes = {}
+
+
+class GroupIndex:
+    """Row permutation and segment offsets of replicate groups
+
+    Group g spans sorted rows starts[g]:starts[g] + sizes[g], that is the original
+    rows order[starts[g]:starts[g] + sizes[g]]
+    """
+
+    def __init__(self, replicate_cols, codes, order, starts, sizes):
+        self.replicate_cols = replicate_cols
+        self.codes = codes
+        self.order = order
+        self.starts = starts
+        self.sizes = sizes
+
+    @classmethod
+    def from_profiles(cls, profiles, replicate_cols):
+        codes = np.stack(
+            [
+                pd.factorize(profiles[x], sort=True, use_na_sentinel=False)[0]
+                for x in replicate_cols
+            ]
+        )
+        order = np.lexsort(codes[::-1])
+
+        sorted_codes = codes[:, order]
+        new_group = np.ones(len(order), dtype=bool)
+        new_group[1:] = (sorted_codes[:, 1:] != sorted_codes[:, :-1]).any(axis=0)
+
+        starts = np.flatnonzero(new_group)
+        sizes = np.diff(np.append(starts, len(order)))
+        return cls(list(replicate_cols), codes, order, starts, sizes)
+
+    @property
+    def n_groups(self):
+        return len(self.starts)
+
+    def get_rows(self, group):
+        """Original rows of a group"""
+        return self.order[self.starts[group] : self.starts[group] + self.sizes[group]]
+
+    def get_keys(self, profiles):
+        """Replicate columns of each group, from its first row"""
+        return (
+            profiles.loc[:, self.replicate_cols]
+            .take(self.order[self.starts])
+            .reset_index(drop=True)
+        )
+
+    def sort_features(self, profiles, features, dtype=np.float64):
+        """Features with rows in group order, as dtype (None keeps their own dtype)"""
+        x = profiles.loc[:, features].to_numpy()
+        return np.asarray(x.take(self.order, axis=0), dtype=dtype)
+
+    def get_missing(self, x):
+        """Whether each group has missing values, over sorted rows x"""
+        if self.n_groups == 0:
+            return np.zeros(0, dtype=bool)
+        return np.add.reduceat(np.isnan(x).any(axis=1), self.starts) > 0
+
+    def iter_blocks(self, n_features, groups=None, block_elements=block_elements):
+        """Yield groups of the same size and their sorted rows, a block at a time
+
+        Rows are (groups, size) positions in the sorted rows, so x[rows] gathers a
+        (groups, size, features) block
+        """
+        if groups is None:
+            groups = np.arange(self.n_groups)
+        sizes = self.sizes[groups]
+        for size in np.unique(sizes):
+            size_groups = groups[sizes == size]
+            block_groups = max(1, block_elements // (size * max(n_features, 1)))
+            for block_start in range(0, len(size_groups), block_groups):
+                block = size_groups[block_start : block_start + block_groups]
+                yield block, self.starts[block][:, None] + np.arange(size)
+
+
+def get_group_index(profiles, replicate_cols):
+    """Group index of a frame, built once per frame and replicate columns
+
+    Frames are expected not to change their replicate columns once indexed
+    """
+    key = (id(profiles), tuple(replicate_cols))
+    if key in group_indexes:
+        profiles_ref, group_index = group_indexes[key]
+        if profiles_ref() is profiles and len(group_index.order) == len(profiles):
+            return group_index
+
+    group_index = GroupIndex.from_profiles(profiles, replicate_cols)
+    group_indexes[key] = (weakref.ref(profiles), group_index)
+    weakref.finalize(profiles, group_indexes.pop, key, None)
+    return group_index
+
+
+def save_group_indexes(group_indexes, index_file):
+    """Save named group indexes (e.g. of each platemap of a store) to one npz file"""
+    indexes = list(group_indexes.values())
+    replicate_cols = indexes[0].replicate_cols if len(indexes) > 0 else []
+    assert all(
+        x.replicate_cols == replicate_cols for x in indexes
+    ), "Group indexes have different replicate columns"
+
+    empty = np.zeros(0, dtype=np.intp)
+    np.savez(
+        index_file,
+        names=np.array(list(group_indexes), dtype=str),
+        replicate_cols=np.array(replicate_cols, dtype=str),
+        n_rows=np.array([len(x.order) for x in indexes], dtype=np.intp),
+        n_groups=np.array([x.n_groups for x in indexes], dtype=np.intp),
+        codes=np.hstack(
+            [np.zeros((len(replicate_cols), 0), dtype=np.intp)]
+            + [x.codes for x in indexes]
+        ),
+        order=np.concatenate([empty] + [x.order for x in indexes]),
+        starts=np.concatenate([empty] + [x.starts for x in indexes]),
+        sizes=np.concatenate([empty] + [x.sizes for x in indexes]),
+    )
+
+
+def load_group_indexes(index_file):
+    """Group indexes saved by save_group_indexes(), by name"""
+    with np.load(index_file, allow_pickle=False) as index_npz:
+        replicate_cols = index_npz["replicate_cols"].tolist()
+        row_splits = np.cumsum(index_npz["n_rows"])[:-1]
+        group_splits = np.cumsum(index_npz["n_groups"])[:-1]
+        return {
+            name: GroupIndex(replicate_cols, codes, order, starts, sizes)
+            for name, codes, order, starts, sizes in zip(
+                index_npz["names"].tolist(),
+                np.split(index_npz["codes"], row_splits, axis=1),
+                np.split(index_npz["order"], row_splits),
+                np.split(index_npz["starts"], group_splits),
+                np.split(index_npz["sizes"], group_splits),
+            )
+        }
+
+
+def sort_replicates(replicates):
+    """Sort a (size, groups, features) block along replicates
+
+    Odd-even transposition sort, so each step is an elementwise minimum and maximum
+    over all groups and features, rather than a sort of each short segment
+    """
+    size = len(replicates)
+    replicates = list(replicates)
+    for step in range(size):
+        for i in range(step % 2, size - 1, 2):
+            low = np.minimum(replicates[i], replicates[i + 1])
+            high = np.maximum(replicates[i], replicates[i + 1])
+            replicates[i], replicates[i + 1] = low, high
+    return replicates
+
+
+def segment_median(x, group_index, block_elements=block_elements):
+    """Median of each group over sorted rows x, ignoring missing values"""
+    median_x = np.empty((group_index.n_groups, x.shape[1]))
+    missing = group_index.get_missing(x)
+
+    for block, rows in group_index.iter_blocks(
+        x.shape[1], groups=np.flatnonzero(~missing), block_elements=block_elements
+    ):
+        size = rows.shape[1]
+        if size <= max_network_size:
+            # Replicates as contiguous (groups, features) slices
+            # Sorting only moves values, so it runs in the dtype of the features
+            replicates = sort_replicates(x[rows.T])
+            median_x[block] = replicates[size // 2]
+            if size % 2 == 0:
+                median_x[block] += replicates[size // 2 - 1]
+                median_x[block] /= 2
+        else:
+            median_x[block] = np.median(x[rows].astype(np.float64), axis=1)
+
+    # All missing features have a missing median, as in pandas
+    for block, rows in group_index.iter_blocks(
+        x.shape[1], groups=np.flatnonzero(missing), block_elements=block_elements
+    ):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median_x[block] = np.nanmedian(x[rows].astype(np.float64), axis=1)
+
+    return median_x
+
+
+def segment_mad(x, group_index, median_x=None):
+    """Median absolute deviation of each group from its median, over sorted rows x"""
+    if median_x is None:
+        median_x = segment_median(x, group_index)
+    row_groups = np.repeat(np.arange(group_index.n_groups), group_index.sizes)
+    return segment_median(np.abs(x - median_x[row_groups]), group_index)
+
+
+def median_consensus(profiles, replicate_cols, features="infer", group_index=None):
+    """Median consensus profiles, as pycytominer.consensus(operation="median")"""
+    if features == "infer":
+        features = infer_cp_features(profiles)
+    if group_index is None:
+        group_index = get_group_index(profiles, replicate_cols)
+
+    x = group_index.sort_features(profiles, features, dtype=None)
+    median_x = segment_median(x, group_index)
+    return pd.concat(
+        [group_index.get_keys(profiles), pd.DataFrame(median_x, columns=features)],
+        axis="columns",
+    )
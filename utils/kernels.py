@@ -0,0 +1,109 @@
+"""
+Feature-wise kernels run over column chunks on a thread pool
+
+Normalization statistics and the variance, frequency and missing value checks of
+feature selection are independent per feature. Column chunks are processed on
+threads, numpy releases the GIL while sorting, partitioning and reducing, and
+results are identical to processing all columns at once.
+"""
+
+import os
+import concurrent.futures
+import numpy as np
+
+# Columns per chunk below which a chunk is not worth its own task
+min_chunk_columns = 64
+
+
+def get_n_jobs(n_jobs=None):
+    if n_jobs is None:
+        return os.cpu_count()
+    return n_jobs
+
+
+def get_column_chunks(n_columns, n_jobs=None, min_chunk_columns=min_chunk_columns):
+    n_chunks = max(1, min(get_n_jobs(n_jobs), n_columns // min_chunk_columns))
+    bounds = np.linspace(0, n_columns, n_chunks + 1).astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def concat_chunks(results):
+    if isinstance(results[0], dict):
+        return {x: concat_chunks([y[x] for y in results]) for x in results[0]}
+    return np.concatenate(results, axis=-1)
+
+
+def map_column_chunks(func, x, n_jobs=None, **kwargs):
+    """Apply func to column chunks of x and concatenate the results by column
+
+    func returns an array, or a dictionary of arrays, with one value per column
+    """
+    chunks = get_column_chunks(x.shape[1], n_jobs)
+    if len(chunks) == 1:
+        return func(x, **kwargs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        results = list(pool.map(lambda chunk: func(x[:, chunk], **kwargs), chunks))
+    return concat_chunks(results)
+
+
+def na_fraction(x, n_jobs=None):
+    def count_na(x):
+        return np.isnan(x).sum(axis=0)
+
+    return map_column_chunks(count_na, x, n_jobs) / x.shape[0]
+
+
+def variance(x, n_jobs=None):
+    """Variance of each feature, in float64 ignoring missing values (as sklearn)"""
+
+    def nanvar(x):
+        return np.nanvar(x.astype(np.float64), axis=0)
+
+    return map_column_chunks(nanvar, x, n_jobs)
+
+
+def count_values(x):
+    # Sorted columns have missing values last and equal values in runs
+    x = np.sort(x, axis=0)
+    n_rows, n_columns = x.shape
+    valid = ~np.isnan(x)
+    n_valid = valid.sum(axis=0)
+
+    run_start = np.ones(x.shape, dtype=bool)
+    run_start[1:] = x[1:] != x[:-1]
+    run_start &= valid
+    n_unique = run_start.sum(axis=0)
+
+    # Runs in column order, each ends where the next run of its column starts
+    run_columns, run_rows = np.nonzero(run_start.T)
+    last_run = np.append(run_columns[1:] != run_columns[:-1], True)
+    run_ends = np.where(last_run, n_valid[run_columns], np.roll(run_rows, -1))
+    run_lengths = run_ends - run_rows
+
+    # Two longest runs per column
+    order = np.lexsort((-run_lengths, run_columns))
+    run_lengths, run_columns = run_lengths[order], run_columns[order]
+    first = np.flatnonzero(np.diff(run_columns, prepend=-1))
+
+    top_counts = np.zeros((2, n_columns), dtype=np.int64)
+    top_counts[0, run_columns[first]] = run_lengths[first]
+    second = first[n_unique[run_columns[first]] > 1] + 1
+    top_counts[1, run_columns[second]] = run_lengths[second]
+
+    return {"n_unique": n_unique, "top_counts": top_counts}
+
+
+def frequency_stats(x, n_jobs=None):
+    """Unique value counts and the ratio of the second to the most common value count
+
+    Missing values are not counted, as pandas.Series.value_counts() and nunique()
+    """
+    counts = map_column_chunks(count_values, x, n_jobs)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        freq_ratio = np.where(
+            counts["n_unique"] > 1,
+            counts["top_counts"][1] / counts["top_counts"][0],
+            0.0,
+        )
+    return {"n_unique": counts["n_unique"], "freq_ratio": freq_ratio}
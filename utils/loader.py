@@ -0,0 +1,131 @@
+"""
+Read many plate files concurrently and assemble them into one frame
+
+Plates are read on a thread or process pool with a bounded number of plates in
+flight, and are consumed in input order. Features are copied into a single
+preallocated matrix as each plate arrives, so the batch is never held twice.
+"""
+
+import os
+import collections
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from schema import read_profiles, split_columns
+
+executors = {
+    "thread": concurrent.futures.ThreadPoolExecutor,
+    "process": concurrent.futures.ProcessPoolExecutor,
+}
+
+# Level 3 and 4 files have one row per well of a 384-well plate
+rows_per_plate = 384
+
+
+def get_read_kwargs(read_kwargs, n_files):
+    if read_kwargs is None:
+        read_kwargs = {}
+    if isinstance(read_kwargs, dict):
+        return [read_kwargs] * n_files
+    assert len(read_kwargs) == n_files, "Provide one set of read arguments per file"
+    return read_kwargs
+
+
+def iter_plates(
+    profile_files,
+    read_func=read_profiles,
+    read_kwargs=None,
+    n_jobs=None,
+    executor="thread",
+    max_in_flight=None,
+):
+    """Yield one frame per plate file, in input order, reading ahead concurrently"""
+    profile_files = list(profile_files)
+    read_kwargs = get_read_kwargs(read_kwargs, len(profile_files))
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * n_jobs
+
+    with executors[executor](max_workers=n_jobs) as pool:
+        pending = collections.deque()
+        tasks = zip(profile_files, read_kwargs)
+
+        def submit_next():
+            task = next(tasks, None)
+            if task is not None:
+                pending.append(pool.submit(read_func, task[0], **task[1]))
+
+        for _ in range(max_in_flight):
+            submit_next()
+
+        while pending:
+            plate_df = pending.popleft().result()
+            submit_next()
+            yield plate_df
+
+
+def load_plates(
+    profile_files,
+    read_func=read_profiles,
+    read_kwargs=None,
+    n_jobs=None,
+    executor="thread",
+    max_in_flight=None,
+):
+    """Load plate files concurrently into one frame, preserving plate order"""
+    profile_files = list(profile_files)
+    plates = iter_plates(
+        profile_files,
+        read_func=read_func,
+        read_kwargs=read_kwargs,
+        n_jobs=n_jobs,
+        executor=executor,
+        max_in_flight=max_in_flight,
+    )
+
+    features = None
+    matrix = None
+    n_rows = 0
+    metadata_dfs = []
+    for plate_df in plates:
+        _, plate_features = split_columns(plate_df.columns)
+        other_cols = [x for x in plate_df.columns if x not in plate_features]
+
+        if features is None:
+            features = plate_features
+            dtype = np.result_type(*plate_df.dtypes[features]) if features else float
+            capacity = max(len(profile_files) * rows_per_plate, plate_df.shape[0])
+            matrix = np.empty((capacity, len(features)), dtype=dtype)
+        elif plate_features != features:
+            raise ValueError(
+                "Plates do not share the same features, load feature selected "
+                "(level 4b) plates individually"
+            )
+
+        n_plate = plate_df.shape[0]
+        if n_rows + n_plate > matrix.shape[0]:
+            matrix = np.resize(matrix, (2 * (n_rows + n_plate), len(features)))
+
+        matrix[n_rows : n_rows + n_plate] = plate_df.loc[:, features].to_numpy()
+        metadata_dfs.append(plate_df.loc[:, other_cols])
+        n_rows += n_plate
+        del plate_df
+
+    if features is None:
+        raise ValueError("No plate files to load")
+
+    # Release the unused capacity if the plates were much smaller than expected
+    if n_rows < matrix.shape[0] // 2:
+        matrix = matrix[:n_rows].copy()
+    else:
+        matrix = matrix[:n_rows]
+
+    profile_df = pd.DataFrame(matrix, columns=features, copy=False)
+    metadata_df = pd.concat(metadata_dfs, axis="rows", ignore_index=True)
+    for position, col in enumerate(metadata_df.columns):
+        profile_df.insert(position, col, metadata_df[col].values)
+
+    return profile_df
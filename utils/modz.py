@@ -0,0 +1,182 @@
+"""
+Batched MODZ consensus over every replicate group at once
+
+MODZ weights each replicate by its mean (clipped) correlation to the other
+replicates of its group. Instead of correlating group by group, profiles are
+rank-transformed and standardized once, rows are sorted by group (see groups.py),
+and the correlation matrices, weights and weighted sums of all groups of the same
+size are computed as block operations over contiguous segments. Results match
+pycytominer.consensus(operation="modz").
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+from pycytominer.cyto_utils import infer_cp_features
+from pycytominer.cyto_utils.modz import modz_base
+from pycytominer.cyto_utils.util import get_pairwise_correlation
+
+from groups import block_elements, get_group_index
+
+# Weights this close to a rounding boundary are recomputed by pycytominer
+round_tolerance = 1e-9
+
+
+def standardize_rows(x, method):
+    # Correlations between rows are then dot products of their standardized rows
+    if method == "spearman":
+        x = rankdata(x, axis=1)
+    centered = x - x.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.einsum("ij,ij->i", centered, centered))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return centered / norms[:, None], norms > 0
+
+
+def get_weights(z, valid, min_weight, precision):
+    # z is (groups, replicates, features), as in pycytominer.cyto_utils.modz_base()
+    n_replicates = z.shape[1]
+    cor = np.einsum("gkf,glf->gkl", z, z)
+
+    # Correlations with constant replicates are missing, as is the diagonal
+    pair_valid = valid[:, :, None] & valid[:, None, :]
+    pair_valid &= ~np.eye(n_replicates, dtype=bool)
+    n_pairs = pair_valid.sum(axis=2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_cor = np.where(pair_valid, cor, 0).sum(axis=(1, 2)) / n_pairs.sum(axis=1)
+
+        cor = np.where(pair_valid, np.maximum(cor, 0), 0)
+        raw_weights = np.where(n_pairs > 0, cor.sum(axis=2) / n_pairs, np.nan)
+        raw_weights = np.maximum(raw_weights, min_weight)
+
+        weight_sums = np.nansum(raw_weights, axis=1, keepdims=True)
+        weights = np.where(
+            weight_sums == 0, 1 / n_replicates, raw_weights / weight_sums
+        )
+
+    scaled = weights * 10**precision
+    ambiguous = np.abs(scaled - np.floor(scaled) - 0.5) < round_tolerance
+    return np.round(weights, precision), ambiguous.any(axis=1), mean_cor
+
+
+def get_group_weights(population_df, method, min_weight, precision):
+    """Replicate weights and mean replicate correlation of one group, as modz_base()"""
+    cor = get_pairwise_correlation(population_df.transpose(), method=method)[0]
+    cor = cor.to_numpy(copy=True)
+    np.fill_diagonal(cor, np.nan)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_cor = np.nansum(cor) / np.isfinite(cor).sum()
+        raw_weights = np.nansum(np.maximum(cor, 0), axis=1) / np.isfinite(cor).sum(
+            axis=1
+        )
+    raw_weights = np.maximum(raw_weights, min_weight)
+
+    weight_sum = np.nansum(raw_weights)
+    if weight_sum == 0:
+        weights = np.full(len(raw_weights), 1 / len(raw_weights))
+    else:
+        weights = raw_weights / weight_sum
+    return np.round(weights, precision), mean_cor
+
+
+def compute_modz(
+    profiles,
+    features,
+    group_index,
+    method="spearman",
+    min_weight=0.01,
+    precision=4,
+    block_elements=block_elements,
+):
+    """MODZ profile of each group, the weight of each (sorted) row and the mean
+    pairwise correlation of the replicates of each group
+    """
+    x = group_index.sort_features(profiles, features)
+    n_features = x.shape[1]
+
+    modz_x = np.empty((group_index.n_groups, n_features))
+    weights = np.ones(x.shape[0])
+    mean_cor = np.full(group_index.n_groups, np.nan)
+    fallback = np.zeros(group_index.n_groups, dtype=bool)
+
+    # Groups with missing values or other methods are left to pycytominer
+    if method in ["pearson", "spearman"]:
+        missing = group_index.get_missing(x)
+    else:
+        missing = np.ones(group_index.n_groups, dtype=bool)
+    fallback |= missing
+
+    for block, rows in group_index.iter_blocks(
+        n_features, groups=np.flatnonzero(~missing), block_elements=block_elements
+    ):
+        block_x = x[rows]
+        if rows.shape[1] == 1:
+            modz_x[block] = block_x[:, 0]
+            continue
+
+        z, valid = standardize_rows(block_x.reshape(-1, n_features), method)
+        block_weights, ambiguous, mean_cor[block] = get_weights(
+            z.reshape(block_x.shape), valid.reshape(rows.shape), min_weight, precision
+        )
+
+        # Replicates with missing weights do not contribute, as when pandas sums
+        block_weights = np.nan_to_num(block_weights)
+        modz_x[block] = np.einsum("gk,gkf->gf", block_weights, block_x)
+        weights[rows] = block_weights
+        fallback[block[ambiguous]] = True
+
+    for group in np.flatnonzero(fallback):
+        group_df = profiles.loc[:, features].take(group_index.get_rows(group))
+        modz_x[group] = modz_base(
+            group_df, method=method, min_weight=min_weight, precision=precision
+        ).to_numpy()
+
+        if group_df.shape[0] > 1:
+            group_weights, mean_cor[group] = get_group_weights(
+                group_df, method, min_weight, precision
+            )
+            start = group_index.starts[group]
+            weights[start : start + len(group_weights)] = np.nan_to_num(group_weights)
+
+    return modz_x, weights, mean_cor
+
+
+def modz_consensus(
+    profiles,
+    replicate_cols,
+    features="infer",
+    method="spearman",
+    min_weight=0.01,
+    precision=4,
+    group_index=None,
+    block_elements=block_elements,
+    return_weights=False,
+):
+    """MODZ consensus profiles, as pycytominer.consensus(operation="modz")
+
+    With return_weights, also returns the (weights, mean_cor) of compute_modz(), so
+    the replicate QC of the same groups does not repeat the MODZ pass
+    """
+    if features == "infer":
+        features = infer_cp_features(profiles)
+    if group_index is None:
+        group_index = get_group_index(profiles, replicate_cols)
+
+    modz_x, weights, mean_cor = compute_modz(
+        profiles,
+        features,
+        group_index,
+        method=method,
+        min_weight=min_weight,
+        precision=precision,
+        block_elements=block_elements,
+    )
+    consensus_df = pd.concat(
+        [group_index.get_keys(profiles), pd.DataFrame(modz_x, columns=features)],
+        axis="columns",
+    )
+    if return_weights:
+        return consensus_df, (weights, mean_cor)
+    return consensus_df
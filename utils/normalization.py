@@ -0,0 +1,166 @@
+"""
+Normalize profiles against several reference samples and methods in a single pass
+
+Reference statistics (medians, quantiles, MADs, means and standard deviations) are
+computed once per reference sample subset and shared by every method that needs
+them. Quantiles are selected with a partition per feature rather than a full sort,
+and statistics are computed over column chunks in parallel.
+Results match pycytominer.normalize() for the same samples and method.
+"""
+
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import infer_cp_features
+
+from kernels import map_column_chunks
+
+avail_methods = ["standardize", "robustize", "mad_robustize"]
+
+# Quantiles each method needs, in percent
+method_quantiles = {
+    "standardize": [],
+    "robustize": [25, 50, 75],
+    "mad_robustize": [50],
+}
+
+# Scale the median absolute deviation to be consistent with the standard deviation
+mad_scale = 1.4826
+
+
+def percentiles(x, q):
+    if np.isnan(x).any():
+        return np.nanpercentile(x, q, axis=0)
+    return np.percentile(x, q, axis=0)
+
+
+def compute_chunk_stats(x, methods):
+    quantiles = sorted(set(q for method in methods for q in method_quantiles[method]))
+
+    stats = {}
+    if quantiles:
+        stats.update(zip(quantiles, percentiles(x, quantiles)))
+
+    if "mad_robustize" in methods:
+        stats["mad"] = mad_scale * percentiles(np.abs(x - stats[50]), 50)
+
+    if "standardize" in methods:
+        stats["mean"] = np.nanmean(x, axis=0)
+        stats["std"] = np.nanstd(x, axis=0)
+
+    return stats
+
+
+def compute_reference_stats(x, methods, n_jobs=None):
+    return map_column_chunks(compute_chunk_stats, x, n_jobs, methods=methods)
+
+
+def get_center_scale(stats, method, mad_robustize_epsilon=1e-18):
+    if method == "standardize":
+        center, scale = stats["mean"], stats["std"]
+    elif method == "robustize":
+        center, scale = stats[50], stats[75] - stats[25]
+    elif method == "mad_robustize":
+        return stats[50], stats["mad"] + mad_robustize_epsilon
+
+    # Constant features are centered but not scaled (as in sklearn)
+    return center, np.where(scale == 0, 1.0, scale)
+
+
+def check_methods(methods):
+    for method in methods:
+        if method not in avail_methods:
+            raise ValueError(f"method must be one of {avail_methods}")
+
+
+def iter_normalized(
+    x, reference_masks, methods, mad_robustize_epsilon=1e-18, n_jobs=None
+):
+    for sample_name, reference_mask in reference_masks.items():
+        reference_x = x if reference_mask is None else x[reference_mask]
+
+        # Reference statistics are always computed in float64, profiles keep their dtype
+        stats = compute_reference_stats(
+            reference_x.astype(np.float64, copy=False), methods, n_jobs=n_jobs
+        )
+        for method in methods:
+            center, scale = get_center_scale(stats, method, mad_robustize_epsilon)
+            center, scale = center.astype(x.dtype), scale.astype(x.dtype)
+            yield (sample_name, method), (x - center) / scale
+
+
+def get_reference_masks(metadata_df, samples):
+    return {
+        sample_name: (
+            None
+            if sample_query == "all"
+            else metadata_df.eval(sample_query).to_numpy(dtype=bool)
+        )
+        for sample_name, sample_query in samples.items()
+    }
+
+
+def normalize_variants(
+    profiles,
+    samples=None,
+    methods=None,
+    features="infer",
+    meta_features="infer",
+    mad_robustize_epsilon=1e-18,
+    n_jobs=None,
+):
+    """Normalize profiles once per combination of reference samples and method
+
+    Returns a dictionary keyed by (sample name, method)
+    """
+    if samples is None:
+        samples = {"whole_plate": "all"}
+    if methods is None:
+        methods = ["mad_robustize"]
+    check_methods(methods)
+
+    if features == "infer":
+        features = infer_cp_features(profiles)
+    if meta_features == "infer":
+        meta_features = infer_cp_features(profiles, metadata=True)
+
+    x = profiles.loc[:, features].to_numpy(dtype=np.float64)
+    meta_df = profiles.loc[:, meta_features]
+
+    normalized = {}
+    for key, normalized_x in iter_normalized(
+        x,
+        get_reference_masks(profiles, samples),
+        methods,
+        mad_robustize_epsilon,
+        n_jobs=n_jobs,
+    ):
+        feature_df = pd.DataFrame(normalized_x, columns=features, index=profiles.index)
+        normalized[key] = pd.concat([meta_df, feature_df], axis="columns")
+
+    return normalized
+
+
+def normalize_frame(
+    profile_frame, samples=None, methods=None, mad_robustize_epsilon=1e-18, n_jobs=None
+):
+    """Normalize a ProfileFrame as normalize_variants() does
+
+    Every normalized ProfileFrame shares the metadata table and feature dtype of the
+    input
+    """
+    if samples is None:
+        samples = {"whole_plate": "all"}
+    if methods is None:
+        methods = ["mad_robustize"]
+    check_methods(methods)
+
+    x = profile_frame.values
+    reference_masks = get_reference_masks(profile_frame.metadata, samples)
+
+    return {
+        key: profile_frame.with_matrix(normalized_x)
+        for key, normalized_x in iter_normalized(
+            x, reference_masks, methods, mad_robustize_epsilon, n_jobs=n_jobs
+        )
+    }
@@ -0,0 +1,129 @@
+"""
+Detect outlier features in normalized profiles with mergeable per-plate statistics
+
+Level 4a profiles are robust z-scores, so a feature whose values regularly reach
+extreme magnitudes, or whose median absolute deviation collapses to zero on a
+plate (leaving a near-zero scale to divide by), is an outlier feature. Each plate
+emits counts and maxima per feature that merge by summation, so a batch is
+processed in one pass with one plate in memory.
+"""
+
+import collections
+import numpy as np
+import pandas as pd
+
+from normalization import mad_scale
+from schema import split_columns
+
+# |z| beyond which a normalized value counts as extreme (as pycytominer drop_outliers)
+extreme_cutoff = 15
+
+# Plate MAD (consistent with the standard deviation) below which it has collapsed
+mad_collapse_cutoff = 1e-3
+
+# Proposal rules, a feature is proposed if any rule applies
+default_rules = {
+    "extreme_fraction": 1e-3,
+    "max_abs_z": 1e4,
+    "mad_collapse_fraction": 0.1,
+}
+
+OutlierStats = collections.namedtuple(
+    "OutlierStats",
+    ["n_values", "n_extreme", "max_abs_z", "n_plates", "n_mad_collapsed"],
+)
+
+
+def compute_plate_outlier_stats(
+    x, extreme_cutoff=extreme_cutoff, mad_collapse_cutoff=mad_collapse_cutoff
+):
+    abs_x = np.abs(x.astype(np.float64, copy=False))
+    finite = np.isfinite(abs_x)
+    n_values = finite.sum(axis=0)
+
+    with np.errstate(invalid="ignore"):
+        n_extreme = (abs_x > extreme_cutoff).sum(axis=0)
+        max_abs_z = np.where(finite, abs_x, -np.inf).max(axis=0, initial=-np.inf)
+
+        median = np.nanmedian(x, axis=0)
+        mad = mad_scale * np.nanmedian(np.abs(x - median), axis=0)
+
+    return OutlierStats(
+        n_values=n_values,
+        n_extreme=n_extreme,
+        max_abs_z=max_abs_z,
+        n_plates=(n_values > 0).astype(np.int64),
+        n_mad_collapsed=((n_values > 0) & (mad < mad_collapse_cutoff)).astype(np.int64),
+    )
+
+
+def merge_outlier_stats(a, b):
+    return OutlierStats(
+        n_values=a.n_values + b.n_values,
+        n_extreme=a.n_extreme + b.n_extreme,
+        max_abs_z=np.maximum(a.max_abs_z, b.max_abs_z),
+        n_plates=a.n_plates + b.n_plates,
+        n_mad_collapsed=a.n_mad_collapsed + b.n_mad_collapsed,
+    )
+
+
+def accumulate_outlier_stats(
+    plate_dfs, extreme_cutoff=extreme_cutoff, mad_collapse_cutoff=mad_collapse_cutoff
+):
+    """Reduce the outlier statistics of every plate, returning features and stats"""
+    features = None
+    stats = None
+    for plate_df in plate_dfs:
+        _, plate_features = split_columns(plate_df.columns)
+        if features is None:
+            features = plate_features
+        elif plate_features != features:
+            raise ValueError("Every plate of a batch must have the same features")
+
+        plate_stats = compute_plate_outlier_stats(
+            plate_df.loc[:, features].to_numpy(),
+            extreme_cutoff=extreme_cutoff,
+            mad_collapse_cutoff=mad_collapse_cutoff,
+        )
+        stats = (
+            plate_stats if stats is None else merge_outlier_stats(stats, plate_stats)
+        )
+
+    if stats is None:
+        raise ValueError("No plates to compute outlier statistics from")
+
+    return features, stats
+
+
+def get_outlier_evidence(features, stats, rules=None):
+    """Summarize outlier statistics per feature and flag the rules each one breaks
+
+    Returns a table with one row per feature, proposed features first and sorted by
+    the largest absolute z-score
+    """
+    if rules is None:
+        rules = default_rules
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        evidence_df = pd.DataFrame(
+            {
+                "feature": features,
+                "n_values": stats.n_values,
+                "extreme_fraction": stats.n_extreme / stats.n_values,
+                "max_abs_z": stats.max_abs_z,
+                "n_plates": stats.n_plates,
+                "mad_collapse_fraction": stats.n_mad_collapsed / stats.n_plates,
+            }
+        )
+
+    reasons = pd.DataFrame(
+        {rule: evidence_df[rule] > cutoff for rule, cutoff in rules.items()}
+    )
+    evidence_df = evidence_df.assign(
+        proposed=reasons.any(axis="columns"),
+        reasons=reasons.apply(lambda x: ";".join(x.index[x]), axis="columns"),
+    )
+
+    return evidence_df.sort_values(
+        ["proposed", "max_abs_z"], ascending=False, kind="stable"
+    ).reset_index(drop=True)
@@ -0,0 +1,468 @@
+"""
+Lazy profiling pipeline plans, optimized before they run
+
+Steps (aggregate, annotate, normalize, feature select, output) are recorded as a
+graph instead of running eagerly. Before running, the plan is optimized:
+- identical steps are recorded once and shared by every branch that uses them
+- metadata-only steps are fused into the step that produces their frame
+- normalizations of the same frame are merged into a single pass
+- independent branches (e.g. the DMSO and whole plate outputs) run concurrently
+
+Pipeline.explain() shows the optimized plan.
+"""
+
+import os
+import pathlib
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import output
+from pycytominer.cyto_utils.cells import SingleCells
+
+from annotation import annotate_plate
+from feature_selection import feature_select
+from frame import ProfileFrame
+from normalization import normalize_frame
+from schema import read_profile_columns, split_columns
+
+# Inputs are (step, key) pairs, the key selects one item of a step returning a dict
+Step = collections.namedtuple("Step", ["op", "inputs", "params"])
+
+
+def run_single_cells(sql_file, strata, aggregation_operation):
+    return SingleCells(
+        file_or_conn=sql_file,
+        strata=strata,
+        aggregation_operation=aggregation_operation,
+    )
+
+
+def run_aggregate(single_cells, output_file, float_format, compression_options):
+    single_cells.aggregate_profiles(
+        output_file=output_file,
+        float_format=float_format,
+        compression_options=compression_options,
+    )
+    return output_file
+
+
+def run_count_cells(single_cells, output_file):
+    single_cells.count_cells().to_csv(output_file, sep=",", index=False)
+    return output_file
+
+
+def run_read(*after, profile_file, feature_dtype):
+    _, features = split_columns(read_profile_columns(profile_file))
+    return pd.read_csv(profile_file, dtype={x: feature_dtype for x in features})
+
+
+def get_id_cols(columns, plate_col, well_col):
+    return [
+        x for x in columns if x.startswith("Metadata_") or x in [plate_col, well_col]
+    ]
+
+
+def run_annotate(profile_df, annotation, plate_name, plate_col, well_col):
+    return annotate_plate(
+        profile_df,
+        annotation,
+        plate_name=plate_name,
+        well_col=well_col,
+        id_cols=get_id_cols(profile_df.columns, plate_col, well_col),
+    )
+
+
+def run_rename_metadata(profile_frame, columns):
+    return profile_frame.with_metadata(
+        profile_frame.metadata.rename(dict(columns), axis="columns")
+    )
+
+
+def run_normalize(profile_frame, samples, methods, mad_robustize_epsilon):
+    return normalize_frame(
+        profile_frame,
+        samples=dict(samples),
+        methods=list(methods),
+        mad_robustize_epsilon=mad_robustize_epsilon,
+    )
+
+
+def run_as_written(profile_frame, float_format):
+    return profile_frame.as_written(float_format)
+
+
+def run_feature_select(profile_frame, operation, **kwargs):
+    return feature_select(profile_frame, operation=list(operation), **kwargs)
+
+
+def run_output(profiles, output_file, float_format, compression_options):
+    if isinstance(profiles, ProfileFrame):
+        profiles = profiles.to_pandas()
+    output(
+        df=profiles,
+        output_filename=output_file,
+        float_format=float_format,
+        compression_options=compression_options,
+    )
+    return output_file
+
+
+class Op(
+    collections.namedtuple(
+        "Op",
+        ["func", "metadata_only", "serial"],
+        defaults=[False, False],
+    )
+):
+    """How to run a step
+
+    metadata_only steps may be fused into the step producing their input, and serial
+    steps never run concurrently with other serial steps on the same input
+    """
+
+    __slots__ = ()
+
+
+ops = {
+    "single_cells": Op(run_single_cells),
+    "aggregate": Op(run_aggregate, serial=True),
+    "count_cells": Op(run_count_cells, serial=True),
+    "read": Op(run_read),
+    "annotate": Op(run_annotate),
+    "rename_metadata": Op(run_rename_metadata, metadata_only=True),
+    "normalize": Op(run_normalize),
+    "as_written": Op(run_as_written),
+    "feature_select": Op(run_feature_select),
+    "output": Op(run_output),
+}
+
+
+def freeze(value):
+    # Hashable stand-in for step parameters, large objects are compared by identity
+    if isinstance(value, dict):
+        return tuple((x, freeze(y)) for x, y in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+    if isinstance(
+        value, (str, int, float, bool, type(None), np.dtype, pathlib.PurePath)
+    ):
+        return value
+    return ("id", id(value))
+
+
+def format_value(value, width=48):
+    if isinstance(value, pathlib.PurePath):
+        value = value.name
+    elif isinstance(value, dict) and not all(
+        isinstance(x, (str, int, float)) for x in value.values()
+    ):
+        return "<dict>"
+    text = str(value) if isinstance(value, (str, np.dtype)) else repr(value)
+    return text if len(text) <= width else f"{text[: width - 3]}..."
+
+
+class Node(
+    collections.namedtuple("Node", ["pipeline", "step", "key"], defaults=[None])
+):
+    """A lazy result of a pipeline step, extended by calling its methods
+
+    The key selects one item of a step returning a dictionary
+    """
+
+    __slots__ = ()
+
+    def add(self, op, **params):
+        return self.pipeline.add(op, [self], **params)
+
+    def aggregate(self, output_file, feature_dtype=np.float64):
+        aggregated = self.add(
+            "aggregate",
+            output_file=output_file,
+            float_format=self.pipeline.float_format,
+            compression_options=self.pipeline.compression_options,
+        )
+        return aggregated.add(
+            "read", profile_file=output_file, feature_dtype=np.dtype(feature_dtype)
+        )
+
+    def count_cells(self, output_file):
+        return self.add("count_cells", output_file=output_file)
+
+    def annotate(self, annotation, plate_name, plate_col, well_col):
+        return self.add(
+            "annotate",
+            annotation=annotation,
+            plate_name=plate_name,
+            plate_col=plate_col,
+            well_col=well_col,
+        )
+
+    def rename_metadata(self, columns):
+        return self.add("rename_metadata", columns=columns)
+
+    def normalize(
+        self, samples="all", method="mad_robustize", mad_robustize_epsilon=1e-18
+    ):
+        normalized = self.add(
+            "normalize",
+            samples={samples: samples},
+            methods=[method],
+            mad_robustize_epsilon=mad_robustize_epsilon,
+        )
+        return normalized._replace(key=(samples, method))
+
+    def as_written(self):
+        return self.add("as_written", float_format=self.pipeline.float_format)
+
+    def feature_select(self, operation, **kwargs):
+        # Select on the values of the written input, as when selecting from its file
+        profiles = self
+        if self.pipeline.float_format is not None:
+            profiles = self.as_written()
+        return profiles.add("feature_select", operation=operation, **kwargs)
+
+    def output(self, output_file):
+        return self.add(
+            "output",
+            output_file=output_file,
+            float_format=self.pipeline.float_format,
+            compression_options=self.pipeline.compression_options,
+        )
+
+
+class Pipeline:
+    """Record profiling steps lazily, then optimize and run them
+
+    pipeline = Pipeline(float_format="%.5g")
+    profiles = pipeline.single_cells(sql_file, strata).aggregate(output_file)
+    profiles.annotate(...).normalize(samples="all").output(output_file)
+    print(pipeline.explain())
+    pipeline.run()
+    """
+
+    def __init__(self, float_format=None, compression_options=None, n_jobs=None):
+        self.float_format = float_format
+        self.compression_options = compression_options
+        self.n_jobs = n_jobs
+        self.steps = []
+        self.step_index = {}
+        self.n_shared = 0
+
+    def add(self, op, inputs=(), **params):
+        inputs = tuple((x.step, x.key) for x in inputs)
+        step = Step(op, inputs, params)
+
+        # Identical steps on identical inputs are recorded once
+        step_key = (op, inputs, freeze(params))
+        if step_key in self.step_index:
+            self.n_shared += 1
+            return Node(self, self.step_index[step_key])
+
+        self.steps.append(step)
+        self.step_index[step_key] = len(self.steps) - 1
+        return Node(self, len(self.steps) - 1)
+
+    def single_cells(self, sql_file, strata, aggregation_operation="median"):
+        return self.add(
+            "single_cells",
+            sql_file=sql_file,
+            strata=strata,
+            aggregation_operation=aggregation_operation,
+        )
+
+    def read(self, profile_file, feature_dtype=np.float64):
+        return self.add(
+            "read", profile_file=profile_file, feature_dtype=np.dtype(feature_dtype)
+        )
+
+    def optimize(self):
+        """Return the optimized steps and a log of the optimizations applied"""
+        steps = list(self.steps)
+        log = []
+        if self.n_shared:
+            log.append(f"shared {self.n_shared} repeated step(s)")
+
+        steps, fused = fuse_metadata_steps(steps)
+        log += fused
+        steps, merged = merge_normalize_steps(steps)
+        log += merged
+
+        return steps, log
+
+    def explain(self):
+        steps, log = self.optimize()
+        stages = get_stages(steps)
+
+        lines = [
+            f"Plan: {len(steps)} steps in {max(stages.values()) + 1} stages"
+            " (steps of a stage run concurrently)"
+        ]
+        for stage in sorted(set(stages.values())):
+            lines.append(f"  stage {stage}")
+            for step_id in [x for x in steps if stages[x] == stage]:
+                lines.append(f"    {format_step(step_id, steps[step_id])}")
+
+        lines.append("Optimizations:")
+        lines += [f"  {x}" for x in log] or ["  none"]
+        return "\n".join(lines)
+
+    def run(self, n_jobs=None):
+        """Run the optimized plan, returning the results of steps nothing consumes"""
+        steps, _ = self.optimize()
+        return run_steps(steps, n_jobs=n_jobs or self.n_jobs)
+
+
+def get_consumers(steps):
+    consumers = collections.defaultdict(list)
+    for step_id, step in steps.items():
+        for input_id, _ in step.inputs:
+            consumers[input_id].append(step_id)
+    return consumers
+
+
+def fuse_metadata_steps(steps):
+    steps = dict(enumerate(steps))
+    consumers = get_consumers(steps)
+    fused_log = []
+
+    for step_id in list(steps):
+        step = steps[step_id]
+        if not ops[step.op].metadata_only:
+            continue
+        ((input_id, key),) = step.inputs
+        if key is not None or len(consumers[input_id]) > 1:
+            continue
+
+        # Apply the step right after its producer, then consume the producer instead
+        producer = steps[input_id]
+        fused = producer.params.get("fused", ()) + ((step.op, step.params),)
+        steps[input_id] = producer._replace(params=dict(producer.params, fused=fused))
+        redirect(steps, consumers, step_id, input_id)
+        del steps[step_id]
+        fused_log.append(f"fused {step.op} into {producer.op} [{input_id}]")
+
+    return steps, fused_log
+
+
+def redirect(steps, consumers, old_id, new_id):
+    for consumer_id in consumers.pop(old_id, []):
+        consumer = steps[consumer_id]
+        steps[consumer_id] = consumer._replace(
+            inputs=tuple(
+                (new_id if x == old_id else x, key) for x, key in consumer.inputs
+            )
+        )
+        consumers[new_id].append(consumer_id)
+
+
+def merge_normalize_steps(steps):
+    consumers = get_consumers(steps)
+    groups = collections.defaultdict(list)
+    for step_id, step in steps.items():
+        if step.op == "normalize":
+            groups[(step.inputs, step.params["mad_robustize_epsilon"])].append(step_id)
+
+    merged_log = []
+    for step_ids in groups.values():
+        if len(step_ids) == 1:
+            continue
+
+        # One pass computes the reference statistics of every sample subset once
+        samples, methods = {}, []
+        for step_id in step_ids:
+            samples.update(steps[step_id].params["samples"])
+            methods += [x for x in steps[step_id].params["methods"] if x not in methods]
+
+        merged_id = step_ids[0]
+        steps[merged_id] = steps[merged_id]._replace(
+            params=dict(steps[merged_id].params, samples=samples, methods=methods)
+        )
+        for step_id in step_ids[1:]:
+            redirect(steps, consumers, step_id, merged_id)
+            del steps[step_id]
+        merged_log.append(f"merged {len(step_ids)} normalize steps into [{merged_id}]")
+
+    return steps, merged_log
+
+
+def get_stages(steps):
+    stages = {}
+    for step_id, step in steps.items():
+        stages[step_id] = max([stages[x] + 1 for x, _ in step.inputs], default=0)
+    return stages
+
+
+def format_step(step_id, step):
+    inputs = ", ".join(
+        f"[{x}]" if key is None else f"[{x}]{list(key)}" for x, key in step.inputs
+    )
+    params = ", ".join(
+        f"{x}={format_value(y)}"
+        for x, y in step.params.items()
+        if x not in ["fused", "float_format", "compression_options"]
+    )
+    text = f"[{step_id}] {step.op}({inputs}{', ' if inputs and params else ''}{params})"
+    for op, _ in step.params.get("fused", ()):
+        text += f" + {op}"
+    return text
+
+
+def run_step(step, values, locks):
+    inputs = [values[x] if key is None else values[x][key] for x, key in step.inputs]
+    params = {x: y for x, y in step.params.items() if x != "fused"}
+
+    if ops[step.op].serial:
+        with locks[step.inputs[0][0]]:
+            value = ops[step.op].func(*inputs, **params)
+    else:
+        value = ops[step.op].func(*inputs, **params)
+
+    for op, op_params in step.params.get("fused", ()):
+        value = ops[op].func(value, **op_params)
+    return value
+
+
+def run_steps(steps, n_jobs=None):
+    consumers = get_consumers(steps)
+    remaining_inputs = {x: len(y.inputs) for x, y in steps.items()}
+    remaining_consumers = {x: len(consumers[x]) for x in steps}
+    locks = collections.defaultdict(threading.Lock)
+    values, results = {}, {}
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        running = {}
+
+        def submit_ready(step_ids):
+            for step_id in step_ids:
+                if remaining_inputs[step_id] == 0:
+                    future = pool.submit(run_step, steps[step_id], values, locks)
+                    running[future] = step_id
+
+        submit_ready(steps)
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                step_id = running.pop(future)
+                values[step_id] = future.result()
+                if not consumers[step_id]:
+                    results[step_id] = values[step_id]
+
+                # Release inputs once every consumer has run
+                for input_id, _ in steps[step_id].inputs:
+                    remaining_consumers[input_id] -= 1
+                    if remaining_consumers[input_id] == 0:
+                        values.pop(input_id, None)
+
+                for consumer_id in consumers[step_id]:
+                    remaining_inputs[consumer_id] -= 1
+                submit_ready(set(consumers[step_id]))
+
+    return results
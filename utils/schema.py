@@ -0,0 +1,132 @@
+"""
+Typed schemas for each profile data level and a reader that applies them while parsing
+"""
+
+import numpy as np
+import pandas as pd
+
+metadata_prefix = "Metadata_"
+feature_prefixes = ("Cells_", "Cytoplasm_", "Nuclei_")
+
+# Metadata columns holding numbers; every other metadata column is read as a string
+numeric_metadata = {
+    "Metadata_mg_per_ml": "float64",
+    "Metadata_mmoles_per_liter": "float64",
+    "Metadata_dose_recode": "int64",
+    "Metadata_Batch_Number": "int64",
+    "Metadata_volume_ul": "float64",
+    "Metadata_amount_mg": "float64",
+    "Metadata_n_replicates": "int64",
+    "Metadata_mean_replicate_correlation": "float64",
+}
+
+# Metadata that each data level is expected to carry, in output order
+well_metadata = ["Metadata_Plate", "Metadata_Well", "Metadata_broad_sample"]
+consensus_metadata = [
+    "Metadata_Plate_Map_Name",
+    "Metadata_cell_id",
+    "Metadata_broad_sample",
+    "Metadata_pert_well",
+    "Metadata_mmoles_per_liter",
+    "Metadata_dose_recode",
+    "Metadata_time_point",
+    "Metadata_moa",
+    "Metadata_target",
+]
+
+profile_schemas = {
+    "level_3": {"metadata": well_metadata},
+    "level_4a": {"metadata": well_metadata},
+    "level_4b": {"metadata": well_metadata},
+    "level_5": {"metadata": consensus_metadata},
+    "spherized": {"metadata": well_metadata},
+}
+
+
+def get_schema(level):
+    try:
+        return profile_schemas[level]
+    except KeyError:
+        raise ValueError(
+            f"{level} is not a known data level, select one of {list(profile_schemas)}"
+        )
+
+
+def split_columns(columns):
+    metadata_cols = [x for x in columns if x.startswith(metadata_prefix)]
+    feature_cols = [x for x in columns if x.startswith(feature_prefixes)]
+    return metadata_cols, feature_cols
+
+
+def build_dtypes(columns, feature_dtype=np.float64, categorical_metadata=False):
+    # Categorical metadata are opt-in: grouping on several categorical columns
+    # (e.g. in consensus) would otherwise expand to every category combination
+    string_dtype = "category" if categorical_metadata else str
+
+    metadata_cols, feature_cols = split_columns(columns)
+    dtypes = {x: numeric_metadata.get(x, string_dtype) for x in metadata_cols}
+    dtypes.update({x: feature_dtype for x in feature_cols})
+    return dtypes
+
+
+def schema_column_order(columns, level):
+    schema = get_schema(level)
+    metadata_cols, feature_cols = split_columns(columns)
+
+    missing_cols = [x for x in schema["metadata"] if x not in metadata_cols]
+    if len(missing_cols) > 0:
+        raise ValueError(f"Missing {level} metadata columns: {missing_cols}")
+
+    # Schema metadata first, other metadata as they appear, then features
+    metadata_cols = schema["metadata"] + [
+        x for x in metadata_cols if x not in schema["metadata"]
+    ]
+    other_cols = [x for x in columns if x not in metadata_cols + feature_cols]
+    return metadata_cols + other_cols + feature_cols
+
+
+def read_profile_columns(profile_file, sep=","):
+    return pd.read_csv(profile_file, sep=sep, nrows=0).columns.tolist()
+
+
+def read_profiles(
+    profile_file,
+    level,
+    feature_dtype=np.float64,
+    categorical_metadata=False,
+    usecols=None,
+    schema_order=False,
+    sep=",",
+    **kwargs,
+):
+    """Read a profile file with the dtypes of its data level
+
+    Columns keep their file order, schema_order=True reorders them as the data level
+    expects (unless usecols projects them). With a chunksize, chunks are returned as
+    pd.read_csv() returns them
+
+    Features are read as float64 by default. float32 halves memory, but changes
+    0.2-2% of the values written with %.5g (benchmark/precision_report.py
+    --synthetic), so it is opt-in (feature_dtype=np.float32, --precision float32)
+    """
+    columns = read_profile_columns(profile_file, sep=sep)
+    if usecols is not None:
+        columns = [x for x in columns if x in set(usecols)]
+
+    dtypes = build_dtypes(
+        columns, feature_dtype=feature_dtype, categorical_metadata=categorical_metadata
+    )
+
+    profile_df = pd.read_csv(
+        profile_file, sep=sep, dtype=dtypes, usecols=columns, **kwargs
+    )
+
+    if not schema_order or usecols is not None:
+        return profile_df
+
+    column_order = schema_column_order(columns, level)
+    if kwargs.get("chunksize") is not None:
+        return (x.reindex(column_order, axis="columns") for x in profile_df)
+    if column_order != profile_df.columns.tolist():
+        profile_df = profile_df.reindex(column_order, axis="columns")
+    return profile_df
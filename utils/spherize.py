@@ -0,0 +1,471 @@
+"""
+Spherize profiles while keeping them in their feature dtype
+
+The whitening transform is fit on the reference samples in float64, as it is
+sensitive to precision, while the profiles are transformed in row blocks and
+stored in their own (e.g. float32) dtype. Results match
+pycytominer.normalize(method="spherize") up to the precision of that dtype.
+
+The transform only depends on the count, mean and co-moment (centered cross
+product) of the reference samples, so it can also be fit from per-plate
+statistics merged as plates stream by, and applied to one plate at a time.
+Fitted transforms are saved with their features and fitting group keys, so new
+or reprocessed plates can be spherized without refitting.
+"""
+
+import json
+import pathlib
+import collections
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import infer_cp_features
+from pycytominer.operations.transform import Spherize
+
+# Rows transformed in float64 at a time
+block_rows = 4096
+
+# Version of saved transforms, increased when their contents change
+transform_version = 1
+
+SpherizeStats = collections.namedtuple("SpherizeStats", ["count", "mean", "comoment"])
+
+
+def fit_spherize(reference_x, method="ZCA-cor", epsilon=1e-6, center=True):
+    reference_df = pd.DataFrame(reference_x.astype(np.float64, copy=False))
+    return Spherize(epsilon=epsilon, center=center, method=method).fit(reference_df)
+
+
+def transform_spherize(fitted_spherize, x, dtype=None, block_rows=block_rows):
+    if dtype is None:
+        dtype = x.dtype
+
+    spherized_x = np.empty(x.shape, dtype=dtype)
+    for start in range(0, x.shape[0], block_rows):
+        block_df = pd.DataFrame(x[start : start + block_rows].astype(np.float64))
+        spherized_x[start : start + block_rows] = np.asarray(
+            fitted_spherize.transform(block_df)
+        )
+    return spherized_x
+
+
+def spherize(
+    profiles,
+    features="infer",
+    meta_features="infer",
+    samples="all",
+    method="ZCA-cor",
+    epsilon=1e-6,
+    center=True,
+    dtype=None,
+    block_rows=block_rows,
+):
+    """Spherize profiles as pycytominer.normalize(method="spherize") does
+
+    Features keep the dtype of the input profiles unless another dtype is given
+    """
+    if features == "infer":
+        features = infer_cp_features(profiles)
+    if meta_features == "infer":
+        meta_features = infer_cp_features(profiles, metadata=True)
+
+    x = profiles.loc[:, features].to_numpy()
+    if samples == "all":
+        reference_x = x
+    else:
+        reference_x = x[profiles.eval(samples).to_numpy(dtype=bool)]
+
+    fitted_spherize = fit_spherize(
+        reference_x, method=method, epsilon=epsilon, center=center
+    )
+    spherized_x = transform_spherize(
+        fitted_spherize, x, dtype=dtype, block_rows=block_rows
+    )
+
+    # PCA whitening returns principal components rather than features
+    if method.startswith("PCA"):
+        columns = [f"PC{x}" for x in range(1, len(features) + 1)]
+    else:
+        columns = features
+
+    feature_df = pd.DataFrame(spherized_x, columns=columns, index=profiles.index)
+    return pd.concat([profiles.loc[:, meta_features], feature_df], axis="columns")
+
+
+def compute_spherize_stats(reference_x):
+    x = reference_x.astype(np.float64)
+    mean = x.mean(axis=0)
+    centered = x - mean
+    return SpherizeStats(x.shape[0], mean, centered.T @ centered)
+
+
+def merge_spherize_stats(a, b):
+    """Merge the statistics of two sets of samples (Chan et al.)"""
+    if a is None or a.count == 0:
+        return b
+    if b is None or b.count == 0:
+        return a
+
+    count = a.count + b.count
+    delta = b.mean - a.mean
+    mean = a.mean + delta * (b.count / count)
+    comoment = (
+        a.comoment + b.comoment + np.outer(delta, delta) * (a.count * b.count / count)
+    )
+    return SpherizeStats(count, mean, comoment)
+
+
+SpherizeDecomposition = collections.namedtuple(
+    "SpherizeDecomposition",
+    ["count", "mean", "scale", "singular_values", "eigenvectors", "method", "center"],
+)
+
+
+class SpherizeTransform:
+    """Fitted whitening transform, ((x - mean) / scale) @ W
+
+    eigenvalues are those of the reference covariance (correlation for the -cor
+    methods), in decreasing order, and eigenvectors are its principal axes
+    """
+
+    def __init__(
+        self, mean, scale, W, eigenvalues, eigenvectors, count, method, epsilon, center
+    ):
+        self.mean = mean
+        self.scale = scale
+        self.W = W
+        self.eigenvalues = eigenvalues
+        self.eigenvectors = eigenvectors
+        self.count = count
+        self.method = method
+        self.epsilon = epsilon
+        self.center = center
+
+    def transform(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        return ((x - self.mean) / self.scale) @ self.W
+
+
+def decompose_spherize_stats(stats, method="ZCA-cor", center=True):
+    """Singular values and right singular vectors of the (scaled) reference matrix,
+    as Spherize.fit() finds them
+
+    They are the square roots of the eigenvalues of its cross product, and its
+    eigenvectors. Eigenvectors have arbitrary signs (and are not unique beyond the
+    rank of the reference samples), so PCA components can differ from Spherize
+    there, ZCA is not affected.
+    """
+    n = stats.count
+    cross = stats.comoment
+    mean = stats.mean if center else np.zeros_like(stats.mean)
+    if not center:
+        cross = cross + n * np.outer(stats.mean, stats.mean)
+
+    # Standardize with the population standard deviation, as StandardScaler
+    scale = np.ones_like(stats.mean)
+    if method in ["PCA-cor", "ZCA-cor"]:
+        if not center:
+            raise ValueError("PCA-cor and ZCA-cor require center=True")
+        variances = np.diag(stats.comoment) / n
+        if np.any(variances == 0):
+            raise ValueError(
+                "Divide by zero error, make sure low variance columns are removed"
+            )
+        scale = np.sqrt(variances)
+        cross = cross / np.outer(scale, scale)
+
+    # In decreasing order
+    eigenvalues, eigenvectors = np.linalg.eigh(cross)
+    sigma = np.sqrt(np.clip(eigenvalues[::-1], 0, None))
+    v = eigenvectors[:, ::-1]
+
+    # Beyond the rank of the reference matrix, repeat the last singular value
+    d = len(sigma)
+    rank = min(d, n - 1 if center else n)
+    if rank < d:
+        sigma[rank:] = sigma[rank - 1]
+
+    return SpherizeDecomposition(n, mean, scale, sigma, v, method, center)
+
+
+def whiten_decomposition(decomposition, method="ZCA-cor", epsilon=1e-6):
+    """Whitening transform of a decomposition, for any epsilon and whitening of the
+    same scaling (-cor or not)
+    """
+    if method.endswith("-cor") != decomposition.method.endswith("-cor"):
+        raise ValueError(
+            f"{method} needs a decomposition of the "
+            f"{'correlation' if method.endswith('-cor') else 'covariance'} matrix"
+        )
+
+    n = decomposition.count
+    sigma = decomposition.singular_values
+    v = decomposition.eigenvectors
+
+    W = v / (sigma + epsilon) * np.sqrt(n - 1)
+    if method in ["ZCA", "ZCA-cor"]:
+        W = W @ v.T
+
+    return SpherizeTransform(
+        mean=decomposition.mean,
+        scale=decomposition.scale,
+        W=W,
+        eigenvalues=sigma**2 / (n - 1),
+        eigenvectors=v,
+        count=n,
+        method=method,
+        epsilon=epsilon,
+        center=decomposition.center,
+    )
+
+
+def fit_stats_spherize(stats, method="ZCA-cor", epsilon=1e-6, center=True):
+    """Whitening transform fit from reference statistics, as Spherize.fit() on the
+    reference samples
+    """
+    decomposition = decompose_spherize_stats(stats, method=method, center=center)
+    return whiten_decomposition(decomposition, method=method, epsilon=epsilon)
+
+
+def accumulate_spherize_stats(plate_dfs, features, samples="all"):
+    """Merge the reference statistics of each plate as plates stream by"""
+    stats = None
+    for plate_df in plate_dfs:
+        x = plate_df.loc[:, features].to_numpy()
+        if samples != "all":
+            x = x[plate_df.eval(samples).to_numpy(dtype=bool)]
+        if x.shape[0] > 0:
+            stats = merge_spherize_stats(stats, compute_spherize_stats(x))
+    return stats
+
+
+def fit_spherize_plates(
+    get_plates, features, samples="all", method="ZCA-cor", epsilon=1e-6, center=True
+):
+    """Whitening transform fit from the reference samples of plates, one at a time"""
+    stats = accumulate_spherize_stats(get_plates(), features, samples=samples)
+    return fit_stats_spherize(stats, method=method, epsilon=epsilon, center=center)
+
+
+def apply_spherize(
+    fitted_spherize,
+    profiles,
+    features,
+    meta_features="infer",
+    dtype=None,
+    block_rows=block_rows,
+):
+    """Spherize profiles with a fitted (or saved) transform"""
+    if meta_features == "infer":
+        meta_features = infer_cp_features(profiles, metadata=True)
+
+    # PCA whitening returns principal components rather than features
+    if fitted_spherize.method.startswith("PCA"):
+        columns = [f"PC{x}" for x in range(1, len(features) + 1)]
+    else:
+        columns = features
+
+    spherized_x = transform_spherize(
+        fitted_spherize,
+        profiles.loc[:, features].to_numpy(),
+        dtype=dtype,
+        block_rows=block_rows,
+    )
+    feature_df = pd.DataFrame(spherized_x, columns=columns, index=profiles.index)
+    return pd.concat([profiles.loc[:, meta_features], feature_df], axis="columns")
+
+
+def spherize_plates(
+    get_plates,
+    features,
+    meta_features="infer",
+    samples="all",
+    method="ZCA-cor",
+    epsilon=1e-6,
+    center=True,
+    dtype=None,
+    block_rows=block_rows,
+):
+    """Spherize plates in two passes, yielding one spherized plate at a time
+
+    get_plates() yields plate profiles and is called once per pass: the first
+    merges the reference statistics of each plate, the second transforms each plate
+    with the transform fit once from them. Only one plate and the (features,
+    features) statistics are held in memory.
+    """
+    fitted_spherize = fit_spherize_plates(
+        get_plates,
+        features,
+        samples=samples,
+        method=method,
+        epsilon=epsilon,
+        center=center,
+    )
+    for plate_df in get_plates():
+        yield apply_spherize(
+            fitted_spherize,
+            plate_df,
+            features,
+            meta_features=meta_features,
+            dtype=dtype,
+            block_rows=block_rows,
+        )
+
+
+def get_plate_r2(counts, sums, squares):
+    """Mean fraction of the variance of each feature explained by plate, from the
+    count, feature sums and sums of squares of each plate
+    """
+    counts = np.asarray(counts, dtype=np.float64)[:, None]
+    correction = sums.sum(axis=0) ** 2 / counts.sum()
+    total_ss = squares.sum(axis=0) - correction
+    between_ss = (sums**2 / counts).sum(axis=0) - correction
+
+    # Constant features have no variance to explain
+    varying = total_ss > 0
+    return np.mean(between_ss[varying] / total_ss[varying])
+
+
+def sweep_spherize_plates(
+    get_plates,
+    features,
+    samples="all",
+    methods=("ZCA-cor",),
+    epsilons=(1e-6,),
+    center=True,
+):
+    """Batch effect left by each whitening method and epsilon, from one fit
+
+    The reference statistics are decomposed once (once per scaling, as the -cor
+    methods decompose the correlation rather than the covariance matrix). Each
+    plate's reference profiles are projected on the eigenvectors once, and every
+    method and epsilon only rescales (and, for ZCA, rotates back) the projection.
+    The batch effect is the mean fraction of the variance of each spherized
+    feature of the reference profiles explained by their plate (get_plate_r2),
+    "none" is the unspherized baseline. Epsilon only rescales PCA components, so
+    their plate_r2 does not depend on it.
+    """
+    stats = accumulate_spherize_stats(get_plates(), features, samples=samples)
+    decompositions = {}
+    for method in methods:
+        scaling = method.endswith("-cor")
+        if scaling not in decompositions:
+            decompositions[scaling] = decompose_spherize_stats(
+                stats, method=method, center=center
+            )
+
+    variants = [("none", np.nan)] + [(x, y) for x in methods for y in epsilons]
+    counts = []
+    sums = {x: [] for x in variants}
+    squares = {x: [] for x in variants}
+
+    def add_plate(variant, x):
+        sums[variant].append(x.sum(axis=0))
+        squares[variant].append(np.einsum("ij,ij->j", x, x))
+
+    for plate_df in get_plates():
+        x = plate_df.loc[:, features].to_numpy()
+        if samples != "all":
+            x = x[plate_df.eval(samples).to_numpy(dtype=bool)]
+        if x.shape[0] == 0:
+            continue
+        x = x.astype(np.float64)
+        counts.append(x.shape[0])
+        add_plate(variants[0], x)
+
+        for scaling, decomposition in decompositions.items():
+            v = decomposition.eigenvectors
+            sigma = decomposition.singular_values
+            projected_x = ((x - decomposition.mean) / decomposition.scale) @ v
+
+            for method, epsilon in variants[1:]:
+                if method.endswith("-cor") != scaling:
+                    continue
+                spherized_x = projected_x * (
+                    np.sqrt(decomposition.count - 1) / (sigma + epsilon)
+                )
+                if method in ["ZCA", "ZCA-cor"]:
+                    spherized_x = spherized_x @ v.T
+                add_plate((method, epsilon), spherized_x)
+
+    results = [
+        {
+            "method": method,
+            "epsilon": epsilon,
+            "n_plates": len(counts),
+            "n_reference": stats.count,
+            "plate_r2": get_plate_r2(
+                counts,
+                np.stack(sums[(method, epsilon)]),
+                np.stack(squares[(method, epsilon)]),
+            ),
+        }
+        for method, epsilon in variants
+    ]
+    return pd.DataFrame(results)
+
+
+def get_group_where(group_keys):
+    """Query selecting the profiles of fitting group keys (None for all profiles)"""
+    if len(group_keys) == 0:
+        return None
+    return " and ".join(f"{col} == {value!r}" for col, value in group_keys.items())
+
+
+def save_spherize(
+    fitted_spherize, transform_file, features, group_keys=None, samples="all"
+):
+    """Save a fitted transform, its features and the keys of the group it was fit on
+
+    group_keys maps metadata columns to the values of the fitting group, e.g.
+    {"Metadata_cell_line": "A549", "Metadata_time_point": "24H"}, empty for a batch
+    """
+    if group_keys is None:
+        group_keys = {}
+
+    pathlib.Path(transform_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(transform_file, "wb") as transform_fh:
+        np.savez_compressed(
+            transform_fh,
+            version=transform_version,
+            mean=fitted_spherize.mean,
+            scale=fitted_spherize.scale,
+            W=fitted_spherize.W,
+            eigenvalues=fitted_spherize.eigenvalues,
+            eigenvectors=fitted_spherize.eigenvectors,
+            count=fitted_spherize.count,
+            method=fitted_spherize.method,
+            epsilon=fitted_spherize.epsilon,
+            center=fitted_spherize.center,
+            features=np.array(features, dtype=str),
+            group_keys=json.dumps(group_keys, sort_keys=True),
+            samples=samples,
+        )
+
+
+def load_spherize(transform_file):
+    """Load a saved transform, as (fitted transform, features, group keys, samples)"""
+    with np.load(transform_file, allow_pickle=False) as transform_npz:
+        version = int(transform_npz["version"])
+        if version > transform_version:
+            raise ValueError(
+                f"{transform_file} is a version {version} transform, this code reads "
+                f"up to version {transform_version}"
+            )
+
+        fitted_spherize = SpherizeTransform(
+            mean=transform_npz["mean"],
+            scale=transform_npz["scale"],
+            W=transform_npz["W"],
+            eigenvalues=transform_npz["eigenvalues"],
+            eigenvectors=transform_npz["eigenvectors"],
+            count=int(transform_npz["count"]),
+            method=str(transform_npz["method"]),
+            epsilon=float(transform_npz["epsilon"]),
+            center=bool(transform_npz["center"]),
+        )
+        features = transform_npz["features"].tolist()
+        group_keys = json.loads(str(transform_npz["group_keys"]))
+        samples = str(transform_npz["samples"])
+
+    return fitted_spherize, features, group_keys, samples
@@ -0,0 +1,153 @@
+"""
+Store profiles as a memory-mapped feature matrix with metadata on the side
+
+A store is a directory holding three files:
+
+  features.npy     - contiguous (n_profiles, n_features) matrix, float64 by default
+                     (float32 halves its size but changes written outputs, see
+                     schema.read_profiles, so it is opt-in with dtype=np.float32)
+  features.txt     - one feature name per line, in matrix column order
+  metadata.csv.gz  - one metadata row per profile, in matrix row order
+
+and, if the profiles were staged for consensus (see consensus_builder.py):
+
+  groups.npz       - replicate group index of each platemap (see groups.py)
+"""
+
+import pathlib
+import collections
+import numpy as np
+import pandas as pd
+
+from schema import build_dtypes, read_profiles, split_columns
+
+store_files = {
+    "matrix": "features.npy",
+    "features": "features.txt",
+    "metadata": "metadata.csv.gz",
+    "groups": "groups.npz",
+}
+
+# The npy header is rewritten once the number of rows is known, so reserve room
+header_size = 128
+
+
+class ProfileStore(
+    collections.namedtuple("ProfileStore", ["metadata", "features", "matrix"])
+):
+    __slots__ = ()
+
+    def feature_index(self, features):
+        lookup = {feature: idx for idx, feature in enumerate(self.features)}
+        return np.array([lookup[x] for x in features], dtype=np.intp)
+
+    def to_frame(self, rows=slice(None), features=None):
+        # Contiguous row slices are views of the memory map, features are copied
+        if features is None:
+            features = self.features
+            matrix = self.matrix[rows]
+        else:
+            matrix = self.matrix[rows][:, self.feature_index(features)]
+
+        profile_df = pd.DataFrame(np.array(matrix), columns=features)
+        metadata_df = self.metadata.iloc[rows].reset_index(drop=True)
+        for position, col in enumerate(metadata_df.columns):
+            profile_df.insert(position, col, metadata_df[col].values)
+        return profile_df
+
+
+def get_store_paths(store_dir):
+    return {key: pathlib.Path(store_dir, x) for key, x in store_files.items()}
+
+
+def write_header(file_handle, n_rows, n_features, dtype):
+    header = {
+        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        "fortran_order": False,
+        "shape": (n_rows, n_features),
+    }
+    file_handle.seek(0)
+    np.lib.format.write_array_header_1_0(file_handle, header)
+    assert file_handle.tell() == header_size, "npy header exceeds reserved space"
+
+
+def write_features(store_paths, features):
+    with open(store_paths["features"], "w") as feature_fh:
+        feature_fh.write("\n".join(features) + "\n")
+
+
+def write_store(profile_df, store_dir, features="infer", dtype=np.float64):
+    store_paths = get_store_paths(store_dir)
+    pathlib.Path(store_dir).mkdir(parents=True, exist_ok=True)
+
+    metadata_cols, cp_features = split_columns(profile_df.columns)
+    if features == "infer":
+        features = cp_features
+
+    np.save(
+        store_paths["matrix"],
+        np.ascontiguousarray(profile_df.loc[:, features].to_numpy(dtype=dtype)),
+    )
+    write_features(store_paths, features)
+    profile_df.loc[:, metadata_cols].to_csv(
+        store_paths["metadata"], index=False, compression={"method": "gzip", "mtime": 1}
+    )
+
+
+def append_store(profile_dfs, store_dir, features=None, dtype=np.float64):
+    """Stream profile frames into a store, in order, without concatenating them"""
+    store_paths = get_store_paths(store_dir)
+    pathlib.Path(store_dir).mkdir(parents=True, exist_ok=True)
+
+    n_rows = 0
+    metadata_dfs = []
+    with open(store_paths["matrix"], "wb") as matrix_fh:
+        # Reserve the header before the first rows, it is rewritten at the end
+        write_header(matrix_fh, 0, 0, dtype)
+        for profile_df in profile_dfs:
+            metadata_cols, cp_features = split_columns(profile_df.columns)
+            if features is None:
+                features = cp_features
+
+            matrix_fh.write(
+                np.ascontiguousarray(
+                    profile_df.loc[:, features].to_numpy(dtype=dtype)
+                ).tobytes()
+            )
+            metadata_dfs.append(profile_df.loc[:, metadata_cols])
+            n_rows += profile_df.shape[0]
+            del profile_df
+
+        if len(metadata_dfs) == 0:
+            raise ValueError("No profiles to store")
+        write_header(matrix_fh, n_rows, len(features), dtype)
+
+    write_features(store_paths, features)
+    pd.concat(metadata_dfs, axis="rows").to_csv(
+        store_paths["metadata"], index=False, compression={"method": "gzip", "mtime": 1}
+    )
+
+
+def build_store(profile_files, store_dir, level, features=None, dtype=np.float64):
+    # Stream plates into the matrix so the batch is never concatenated in memory
+    plates = (read_profiles(x, level=level, feature_dtype=dtype) for x in profile_files)
+    append_store(plates, store_dir, features=features, dtype=dtype)
+
+
+def load_store(store_dir, mmap_mode="r", categorical_metadata=False):
+    store_paths = get_store_paths(store_dir)
+
+    with open(store_paths["features"]) as feature_fh:
+        features = [x.strip() for x in feature_fh if x.strip()]
+
+    metadata_cols = pd.read_csv(store_paths["metadata"], nrows=0).columns.tolist()
+    metadata_df = pd.read_csv(
+        store_paths["metadata"],
+        dtype=build_dtypes(metadata_cols, categorical_metadata=categorical_metadata),
+    )
+
+    # Processes mapping the same file share one copy in the page cache
+    matrix = np.load(store_paths["matrix"], mmap_mode=mmap_mode)
+
+    assert matrix.shape == (metadata_df.shape[0], len(features)), "Store is corrupt"
+    return ProfileStore(metadata=metadata_df, features=features, matrix=matrix)
@@ -0,0 +1,47 @@
+import sys
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Modules in utils/ import each other as top-level modules, as the notebooks do
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+default_features = ["Cells_a", "Cells_b", "Cytoplasm_c", "Nuclei_d"]
+
+
+@pytest.fixture
+def make_profiles():
+    """Return a factory for synthetic profiles
+
+    Metadata columns come first, in keyword order, from a scalar or one value per
+    row (make_profiles(4, Plate="P1") gives Metadata_Plate); features are drawn
+    from a seeded normal, or lognormal, distribution.
+    """
+
+    def _make_profiles(
+        n_rows, features=default_features, seed=0, lognormal=False, **metadata
+    ):
+        rng = np.random.default_rng(seed)
+        draw = rng.lognormal if lognormal else rng.normal
+        profile_df = pd.DataFrame(draw(size=(n_rows, len(features))), columns=features)
+        for idx, (column, values) in enumerate(metadata.items()):
+            profile_df.insert(idx, f"Metadata_{column}", values)
+        return profile_df
+
+    return _make_profiles
+
+
+@pytest.fixture
+def write_plates(tmp_path):
+    """Return a function writing each plate to <Metadata_Plate><suffix> in tmp_path"""
+
+    def _write_plates(plate_dfs, suffix=".csv"):
+        plate_files = []
+        for plate_df in plate_dfs:
+            plate_files.append(tmp_path / f"{plate_df.Metadata_Plate.iloc[0]}{suffix}")
+            plate_df.to_csv(plate_files[-1], index=False)
+        return plate_files
+
+    return _write_plates
@@ -0,0 +1,87 @@
+import pathlib
+import pandas as pd
+import pytest
+
+from pycytominer import annotate
+
+from annotation import (
+    annotate_plate,
+    barcode_fields,
+    build_platemap_annotation,
+    derived_cols,
+    external_join_args,
+)
+from dose import get_dose_ladder
+
+batch = "2016_04_01_a549_48hr_batch1"
+platemap_name = "C-7161-01-LM6-001"
+metadata_dir = pathlib.Path(__file__).resolve().parents[2] / "metadata"
+platemap_file = metadata_dir / "platemaps" / batch / "platemap" / f"{platemap_name}.txt"
+barcode_platemap_file = metadata_dir / "platemaps" / batch / "barcode_platemap.csv"
+moa_file = metadata_dir / "moa" / "repurposing_info_external_moa_map_resolved.tsv"
+plate_col, well_col = "Image_Metadata_Plate", "Image_Metadata_Well"
+cell_id = "A549"
+
+
+@pytest.mark.parametrize("duplicate_well", [False, True])
+def test_annotate_plate_matches_annotate(tmp_path, make_profiles, duplicate_well):
+    plate_name = (
+        pd.read_csv(barcode_platemap_file)
+        .query("Plate_Map_Name == @platemap_name")
+        .Assay_Plate_Barcode.iloc[0]
+    )
+
+    # A well the platemap does not list, a well profiled twice, and platemap wells
+    # without profiles
+    wells = ["A08", "A01", "Z99", "A07", "A08", "B11"]
+    profile_df = make_profiles(len(wells), Plate=plate_name, Well=wells).rename(
+        {"Metadata_Plate": plate_col, "Metadata_Well": well_col}, axis="columns"
+    )
+
+    if duplicate_well:
+        # The platemap lists a well twice, with different treatments
+        platemap_df = pd.read_csv(platemap_file, sep="\t")
+        platemap_df = pd.concat(
+            [
+                platemap_df,
+                platemap_df.query("well_position == 'A07'").assign(
+                    broad_sample="BRD-A00147595-001-01-5"
+                ),
+            ]
+        )
+        plate_platemap_file = tmp_path / f"{platemap_name}.txt"
+        platemap_df.to_csv(plate_platemap_file, sep="\t", index=False)
+    else:
+        plate_platemap_file = platemap_file
+
+    expected_df = annotate(
+        profiles=profile_df,
+        platemap=plate_platemap_file,
+        join_on=["Metadata_well_position", well_col],
+        format_broad_cmap=True,
+        external_metadata=pd.read_csv(moa_file, sep="\t"),
+        cmap_args={"cell_id": cell_id, "perturbation_mode": "chemical"},
+        **external_join_args,
+    )
+
+    annotation = build_platemap_annotation(
+        plate_platemap_file,
+        moa_file,
+        barcode_platemap_file,
+        well_col=well_col,
+        cell_id=cell_id,
+        dose_mapping=get_dose_ladder(batch),
+    )
+    annotated_df = annotate_plate(
+        profile_df,
+        annotation,
+        plate_name=plate_name,
+        well_col=well_col,
+        id_cols=[plate_col, well_col],
+    ).to_pandas()
+
+    assert annotated_df.Metadata_Assay_Plate_Barcode.eq(plate_name).all()
+    annotated_df = annotated_df.drop(
+        list(barcode_fields.values()) + derived_cols, axis="columns"
+    )
+    pd.testing.assert_frame_equal(annotated_df, expected_df)
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+from batch_normalization import fit_batch_reference, normalize_plate
+from normalization import avail_methods, normalize_variants
+
+samples = {"whole_plate": "all", "dmso": "Metadata_broad_sample == 'DMSO'"}
+
+
+features = ["Cells_a", "Cytoplasm_b", "Nuclei_c"]
+
+
+def make_plates(make_profiles, n_plates=4, n_rows=24):
+    # Plates drift apart, as they do across a batch
+    plate_dfs = []
+    for plate in range(n_plates):
+        plate_df = make_profiles(
+            n_rows,
+            features,
+            seed=plate,
+            lognormal=True,
+            Plate=f"P{plate}",
+            broad_sample=["DMSO", "BRD-1"] * (n_rows // 2),
+        )
+        plate_df.loc[:, features] *= np.exp(plate / 4)
+        plate_dfs.append(plate_df)
+    return plate_dfs
+
+
+def test_streamed_reference_matches_batch(make_profiles):
+    # Exact while the batch has fewer reference profiles than the sketch size
+    plate_dfs = make_plates(make_profiles)
+    batch_reference = fit_batch_reference(plate_dfs, samples)
+    expected = normalize_variants(
+        pd.concat(plate_dfs, ignore_index=True), samples=samples, methods=avail_methods
+    )
+
+    normalized = [normalize_plate(x, batch_reference, avail_methods) for x in plate_dfs]
+    for key, expected_df in expected.items():
+        normalized_df = pd.concat([x[key] for x in normalized], ignore_index=True)
+        pd.testing.assert_frame_equal(normalized_df, expected_df)
+
+
+def test_small_sketch_stays_close(make_profiles):
+    plate_dfs = make_plates(make_profiles, n_plates=8)
+    batch_reference = fit_batch_reference(plate_dfs, samples, size=32)
+    expected = normalize_variants(
+        pd.concat(plate_dfs, ignore_index=True),
+        samples=samples,
+        methods=["mad_robustize"],
+    )
+
+    normalized = [
+        normalize_plate(x, batch_reference, ["mad_robustize"]) for x in plate_dfs
+    ]
+    normalized_df = pd.concat([x[("dmso", "mad_robustize")] for x in normalized])
+    expected_df = expected[("dmso", "mad_robustize")]
+    np.testing.assert_allclose(
+        normalized_df.loc[:, features], expected_df.loc[:, features], rtol=0.1, atol=0.1
+    )
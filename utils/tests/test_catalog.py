@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import catalog
+from catalog import load_profiles, read_filtered
+
+batch = "2016_04_01_a549_48hr_batch1"
+
+
+features = ["Cells_a", "Nuclei_b"]
+wells = {
+    "Well": ["A01", "A02", "A03", "A04"],
+    "broad_sample": ["DMSO", "BRD-1", "DMSO", "BRD-2"],
+}
+
+
+def test_read_filtered_rows_without_columns(make_profiles, write_plates):
+    profile_df = make_profiles(4, features, Plate="P1", **wells)
+    (profile_file,) = write_plates([profile_df])
+
+    dmso_df = read_filtered(
+        profile_file,
+        level="level_4a",
+        where="Metadata_broad_sample == 'DMSO'",
+        chunksize=2,
+        feature_dtype=np.float64,
+    )
+    pd.testing.assert_frame_equal(
+        dmso_df.reset_index(drop=True),
+        profile_df.query("Metadata_broad_sample == 'DMSO'").reset_index(drop=True),
+    )
+
+
+@pytest.mark.parametrize("chunksize", [None, 2])
+def test_read_filtered_chunksize(make_profiles, write_plates, chunksize):
+    profile_df = make_profiles(4, features, Plate="P1", **wells)
+    (profile_file,) = write_plates([profile_df])
+
+    dmso_df = read_filtered(
+        profile_file,
+        level="level_4a",
+        where="Metadata_broad_sample == 'DMSO' and Metadata_cell_line == 'A549'",
+        partition={"Metadata_cell_line": "A549"},
+        chunksize=chunksize,
+    )
+    assert dmso_df.Metadata_Well.tolist() == ["A01", "A03"]
+
+
+def test_read_filtered_missing_filter_columns(make_profiles, write_plates):
+    (profile_file,) = write_plates([make_profiles(4, features, Plate="P1", **wells)])
+
+    with pytest.raises(ValueError, match="Metadata_time_point"):
+        read_filtered(
+            profile_file, level="level_4a", where="Metadata_time_point == '48H'"
+        )
+
+
+def test_load_profiles_rows_without_columns(
+    tmp_path, monkeypatch, make_profiles, write_plates
+):
+    plates_df = catalog.resolve_plates(batch).head(2)
+    monkeypatch.setattr(catalog, "resolve_plates", lambda batch, where=None: plates_df)
+    monkeypatch.setattr(
+        catalog,
+        "get_plate_file",
+        lambda batch, plate, suffix: tmp_path / f"{plate}{suffix}",
+    )
+
+    suffix = catalog.get_suffix("level_4a", "dmso")
+    plate_dfs = [
+        make_profiles(4, features, Plate=x, **wells) for x in plates_df.Metadata_Plate
+    ]
+    write_plates(plate_dfs, suffix)
+
+    dmso_df = load_profiles(
+        batch,
+        level="level_4a",
+        normalization="dmso",
+        where="Metadata_broad_sample == 'DMSO'",
+        chunksize=3,
+        feature_dtype=np.float64,
+    )
+    expected_df = pd.concat(plate_dfs, ignore_index=True).query(
+        "Metadata_broad_sample == 'DMSO'"
+    )
+    pd.testing.assert_frame_equal(dmso_df, expected_df.reset_index(drop=True))
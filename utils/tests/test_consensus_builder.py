@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from pycytominer import consensus
+
+from consensus_builder import (
+    build_consensus,
+    iter_store_platemaps,
+    load_store_group_indexes,
+    split_platemaps,
+    stage_platemap_profiles,
+)
+from groups import GroupIndex
+from store import load_store
+
+replicate_cols = ["Metadata_Plate_Map_Name", "Metadata_broad_sample"]
+
+
+def test_staged_group_indexes(tmp_path, make_profiles):
+    rng = np.random.default_rng(0)
+    profile_df = make_profiles(
+        24,
+        Plate_Map_Name=["M2", "M1"] * 12,
+        Plate=[f"P{x % 3}" for x in range(24)],
+        broad_sample=rng.choice(["DMSO", "B", "C"], 24),
+    )
+    stage_platemap_profiles(
+        split_platemaps(profile_df), tmp_path / "store", replicate_cols=replicate_cols
+    )
+
+    store = load_store(tmp_path / "store")
+    group_indexes = load_store_group_indexes(tmp_path / "store")
+    assert list(group_indexes) == ["M1", "M2"]
+    for platemap, platemap_df in iter_store_platemaps(store):
+        expected = GroupIndex.from_profiles(platemap_df, replicate_cols)
+        group_index = group_indexes[platemap]
+        assert group_index.replicate_cols == replicate_cols
+        for attr in ["codes", "order", "starts", "sizes"]:
+            np.testing.assert_array_equal(
+                getattr(group_index, attr), getattr(expected, attr)
+            )
+
+    consensus_df = build_consensus(
+        iter_store_platemaps(store),
+        replicate_cols=replicate_cols,
+        operations=["median"],
+        group_indexes=group_indexes,
+    )["median"]
+    expected_df = consensus(
+        profile_df.drop("Metadata_Plate", axis="columns"),
+        replicate_columns=replicate_cols,
+        operation="median",
+    )
+    pd.testing.assert_frame_equal(consensus_df, expected_df, check_dtype=False)
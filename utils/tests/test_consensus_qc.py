@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+import modz
+import consensus_qc as qc
+from consensus_builder import build_consensus, split_platemaps
+from consensus_qc import consensus_qc, join_segments
+from groups import GroupIndex
+
+replicate_cols = ["Metadata_Plate_Map_Name", "Metadata_broad_sample"]
+
+
+def test_qc_reuses_modz_weights(monkeypatch, make_profiles):
+    rng = np.random.default_rng(1)
+    profile_df = make_profiles(
+        30,
+        [f"Cells_{x}" for x in "ab"] + [f"Nuclei_{x}" for x in "cde"],
+        seed=1,
+        Plate_Map_Name=["M1", "M2"] * 15,
+        Plate=[f"P{x % 4}" for x in range(30)],
+        broad_sample=rng.choice(["DMSO", "B", "C"], 30),
+    )
+    expected_df = pd.concat(
+        [consensus_qc(x, replicate_cols) for _, x in split_platemaps(profile_df)],
+        ignore_index=True,
+    )
+
+    n_calls = []
+    compute_modz = modz.compute_modz
+
+    def count_compute_modz(*args, **kwargs):
+        n_calls.append(1)
+        return compute_modz(*args, **kwargs)
+
+    monkeypatch.setattr(modz, "compute_modz", count_compute_modz)
+    monkeypatch.setattr(qc, "compute_modz", count_compute_modz)
+    _, qc_df = build_consensus(
+        split_platemaps(profile_df),
+        replicate_cols=replicate_cols,
+        operations=["median", "modz"],
+        return_qc=True,
+    )
+
+    # One MODZ pass per platemap, shared by the consensus and its QC
+    assert len(n_calls) == 2
+    pd.testing.assert_frame_equal(qc_df, expected_df)
+
+
+def test_join_segments_without_groups():
+    group_index = GroupIndex.from_profiles(
+        pd.DataFrame({"Metadata_broad_sample": pd.Series([], dtype=str)}),
+        ["Metadata_broad_sample"],
+    )
+    assert join_segments(np.array([]), group_index) == []
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+from consensus_builder import as_written, build_consensus, split_platemaps
+from consensus_update import get_membership, is_in, splice_consensus
+from feature_selection import feature_select
+
+replicate_cols = [
+    "Metadata_Plate_Map_Name",
+    "Metadata_broad_sample",
+    "Metadata_mmoles_per_liter",
+]
+float_format = "%5g"
+feature_select_ops = ["drop_na_columns", "variance_threshold", "correlation_threshold"]
+
+
+features = [f"Cells_{x}" for x in "abc"] + [f"Nuclei_{x}" for x in "def"]
+
+
+def make_batch(make_profiles, seed, n_rows=48):
+    rng = np.random.default_rng(seed)
+    profile_df = make_profiles(
+        n_rows,
+        features,
+        seed=seed,
+        Plate_Map_Name=["M1", "M2"] * (n_rows // 2),
+        Plate=[f"P{x % 4}" for x in range(n_rows)],
+        broad_sample=rng.choice(["DMSO", "B", "C"], n_rows),
+        mmoles_per_liter=10 / 3,
+    )
+
+    # A correlated pair for correlation_threshold to drop
+    profile_df["Nuclei_f"] = profile_df.Cells_a + rng.normal(scale=0.1, size=n_rows)
+    return profile_df
+
+
+def get_consensus(profile_df, operation):
+    return build_consensus(
+        split_platemaps(profile_df),
+        replicate_cols=replicate_cols,
+        operations=[operation],
+    )[operation]
+
+
+def test_splice_matches_rebuild(make_profiles):
+    old_df = make_batch(make_profiles, 0)
+
+    # Reprocess plate P1
+    new_df = old_df.copy()
+    plate_rows = new_df.Metadata_Plate == "P1"
+    new_df.loc[plate_rows, "Cells_a":] = make_batch(make_profiles, 1).loc[
+        plate_rows, "Cells_a":
+    ]
+
+    for operation in ["median", "modz"]:
+        table_df = get_consensus(old_df, operation)
+        rebuild_df = get_consensus(new_df, operation)
+
+        membership_df = get_membership(new_df, replicate_cols, float_format)
+        affected_keys_df = membership_df.query("Metadata_Plate == 'P1'").loc[
+            :, replicate_cols
+        ]
+        keys_df = as_written(new_df.loc[:, replicate_cols], float_format)
+        update_df = get_consensus(new_df[is_in(keys_df, affected_keys_df)], operation)
+
+        # Groups are matched as written, values are spliced unrounded
+        metadata_cols = rebuild_df.columns[: len(replicate_cols)].tolist()
+        table_df.loc[:, metadata_cols] = as_written(
+            table_df.loc[:, metadata_cols], float_format
+        )
+        update_df.loc[:, metadata_cols] = as_written(
+            update_df.loc[:, metadata_cols], float_format
+        )
+        spliced_df = splice_consensus(
+            table_df, update_df, affected_keys_df, replicate_cols
+        )
+        pd.testing.assert_frame_equal(
+            spliced_df.loc[:, features], rebuild_df.loc[:, features]
+        )
+        pd.testing.assert_frame_equal(
+            as_written(spliced_df, float_format), as_written(rebuild_df, float_format)
+        )
+
+        # Updates and rebuilds select features on the same values
+        pd.testing.assert_frame_equal(
+            as_written(
+                feature_select(spliced_df, operation=feature_select_ops), float_format
+            ),
+            as_written(
+                feature_select(rebuild_df, operation=feature_select_ops), float_format
+            ),
+        )
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from pycytominer.operations import correlation_threshold as pycytominer_correlation
+
+from correlation import (
+    correlation_threshold,
+    get_correlation_stats,
+    stats_correlation_threshold,
+    update_correlation_stats,
+)
+
+
+@pytest.fixture
+def profile_df(make_profiles):
+    n_rows, n_features = 60, 24
+    profile_df = make_profiles(
+        n_rows,
+        [f"Cells_{x}" for x in range(n_features)],
+        seed=3,
+        broad_sample=["DMSO", "BRD-1"] * (n_rows // 2),
+    )
+
+    # Chains of correlated features, so exclusion order matters
+    rng = np.random.default_rng(3)
+    for idx in range(1, n_features, 3):
+        profile_df.iloc[:, idx + 1] = profile_df.iloc[:, idx] + rng.normal(
+            scale=0.2, size=n_rows
+        )
+    return profile_df
+
+
+@pytest.mark.parametrize("block_size", [5, 256])
+@pytest.mark.parametrize("threshold", [0.8, 0.9])
+def test_correlation_threshold_matches_pycytominer(profile_df, block_size, threshold):
+    excluded = correlation_threshold(
+        profile_df, threshold=threshold, block_size=block_size
+    )
+    expected = pycytominer_correlation(profile_df, threshold=threshold)
+    assert len(expected) > 0
+    assert sorted(excluded) == sorted(expected)
+
+
+def test_correlation_threshold_with_missing_values(profile_df):
+    profile_df.iloc[3, 4] = np.nan
+    assert sorted(correlation_threshold(profile_df)) == sorted(
+        pycytominer_correlation(profile_df)
+    )
+
+
+@pytest.mark.parametrize("threshold", [0.8, 0.9])
+def test_stats_correlation_threshold(profile_df, threshold):
+    features = profile_df.columns[1:].tolist()
+    stats = get_correlation_stats(profile_df.loc[:, features].to_numpy(), features)
+    assert sorted(stats_correlation_threshold(stats, threshold)) == sorted(
+        correlation_threshold(profile_df, threshold=threshold)
+    )
+
+    # Replace some rows, as an update of a consensus does
+    new_df = profile_df.copy()
+    new_df.iloc[:10, 1:] = np.random.default_rng(4).normal(size=(10, len(features)))
+    stats = update_correlation_stats(
+        stats,
+        profile_df.iloc[:10, 1:].to_numpy(),
+        new_df.iloc[:10, 1:].to_numpy(),
+    )
+    assert sorted(stats_correlation_threshold(stats, threshold)) == sorted(
+        correlation_threshold(new_df, threshold=threshold)
+    )
@@ -0,0 +1,51 @@
+import pathlib
+import numpy as np
+import pandas as pd
+
+from dose import get_dose_ladder, primary_dose_mapping, recode_dose, recode_doses
+
+platemap_dir = pathlib.Path(__file__).resolve().parents[2] / "metadata" / "platemaps"
+
+
+def scalar_recode_dose(x, doses, return_level=False):
+    # The original per-value recoding
+    closest_index = np.argmin([np.abs(dose - x) for dose in doses])
+    if np.isnan(x):
+        return 0
+    if return_level:
+        return closest_index + 1
+    return doses[closest_index]
+
+
+def load_batch2_doses():
+    platemap_files = (platemap_dir / "2017_12_05_Batch2" / "platemap").glob("*.csv")
+    return pd.concat([pd.read_csv(x) for x in platemap_files]).mmoles_per_liter
+
+
+def test_recode_doses_matches_scalar():
+    rng = np.random.default_rng(0)
+    x = np.concatenate(
+        [rng.uniform(0, 25, 500), primary_dose_mapping, [0.08, 0.245, np.nan]]
+    )
+    for return_level in [False, True]:
+        expected = [
+            scalar_recode_dose(y, primary_dose_mapping, return_level) for y in x
+        ]
+        np.testing.assert_array_equal(
+            recode_doses(x, primary_dose_mapping, return_level=return_level), expected
+        )
+        assert recode_dose(x[0], primary_dose_mapping, return_level) == expected[0]
+
+
+def test_batch2_dose_ladder():
+    ladder = get_dose_ladder("2017_12_05_Batch2")
+    assert ladder == [0.04, 0.12, 0.37, 1.11, 3.33, 10]
+    assert get_dose_ladder("2016_04_01_a549_48hr_batch1") == primary_dose_mapping
+
+    # Batch 2 doses recode as they did on the primary ladder
+    doses = load_batch2_doses().to_numpy()
+    levels = recode_doses(doses, ladder, return_level=True)
+    np.testing.assert_array_equal(
+        levels, recode_doses(doses, primary_dose_mapping, return_level=True)
+    )
+    assert set(levels) == {0, 1, 2, 3, 4, 5, 6}
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycytominer import feature_select as pycytominer_feature_select
+
+from correlation import get_correlation_stats
+from feature_selection import feature_select, replay_feature_select
+from frame import ProfileFrame
+
+operation = ["variance_threshold", "correlation_threshold", "drop_na_columns"]
+
+
+@pytest.fixture
+def profile_df(make_profiles):
+    n_rows = 80
+    profile_df = make_profiles(
+        n_rows,
+        [f"Cells_{x}" for x in range(12)],
+        seed=8,
+        broad_sample=["DMSO", "BRD-1"] * (n_rows // 2),
+    )
+
+    # A correlated pair, a constant, a near constant and a sparse feature
+    profile_df["Cells_1"] = profile_df.Cells_0 + np.random.default_rng(8).normal(
+        scale=0.1, size=n_rows
+    )
+    profile_df["Cells_2"] = 1.0
+    profile_df.loc[: n_rows - 3, "Cells_3"] = 0.5
+    profile_df.loc[:9, "Cells_4"] = np.nan
+    return profile_df
+
+
+def test_feature_select_matches_pycytominer(profile_df):
+    for samples in ["all", "Metadata_broad_sample == 'DMSO'"]:
+        expected_df = pycytominer_feature_select(
+            profile_df, operation=operation, samples=samples
+        )
+        selected_df = feature_select(
+            profile_df, operation=operation, samples=samples, n_jobs=2
+        )
+        assert selected_df.shape[1] < profile_df.shape[1]
+        pd.testing.assert_frame_equal(selected_df, expected_df)
+
+
+def test_feature_select_profile_frame(profile_df):
+    profile_frame = ProfileFrame.from_pandas(profile_df)
+    for samples in ["all", "Metadata_broad_sample == 'DMSO'"]:
+        selected = feature_select(
+            profile_frame, operation=operation + ["blocklist"], samples=samples
+        )
+        expected_df = feature_select(
+            profile_df, operation=operation + ["blocklist"], samples=samples
+        )
+        assert selected.features == expected_df.columns[1:].tolist()
+        assert selected.matrix is profile_frame.matrix
+
+
+def test_replay_feature_select(profile_df):
+    features = profile_df.columns[1:].tolist()
+    x = profile_df.loc[:, features].to_numpy()
+    replay_ops = ["drop_na_columns", "variance_threshold", "correlation_threshold"]
+
+    # Correlation decisions need the statistics of the features they see
+    exclusions, corr_features = replay_feature_select(x, features, replay_ops)
+    assert exclusions is None
+
+    corr_x = x[:, [features.index(feature) for feature in corr_features]]
+    exclusions, _ = replay_feature_select(
+        x,
+        features,
+        replay_ops + ["blocklist"],
+        corr_stats=get_correlation_stats(corr_x, corr_features),
+    )
+    selected_df = feature_select(profile_df, operation=replay_ops + ["blocklist"])
+    assert sorted(sum(exclusions, [])) == sorted(
+        set(profile_df.columns) - set(selected_df.columns)
+    )
@@ -0,0 +1,43 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+
+from frame import ProfileFrame
+from pipeline import Pipeline
+
+
+@pytest.fixture
+def profile_df(make_profiles):
+    profile_df = make_profiles(
+        6,
+        ["Cells_a", "Cytoplasm_b", "Nuclei_c"],
+        Well=[f"A{x:02d}" for x in range(6)],
+    )
+    profile_df.loc[:, "Cells_a":] /= 3
+    profile_df.loc[1, "Cells_a"] = np.nan
+    return profile_df
+
+
+def test_round_trip(profile_df):
+    profile_frame = ProfileFrame.from_pandas(profile_df)
+    pd.testing.assert_frame_equal(profile_frame.to_pandas(), profile_df)
+
+
+def test_as_written(profile_df):
+    csv_buffer = io.StringIO()
+    profile_df.to_csv(csv_buffer, index=False, float_format="%.5g")
+    csv_buffer.seek(0)
+    written_df = pd.read_csv(csv_buffer)
+
+    written_frame = ProfileFrame.from_pandas(profile_df).as_written("%.5g")
+    pd.testing.assert_frame_equal(written_frame.to_pandas(), written_df)
+
+
+def test_feature_select_uses_written_values():
+    pipeline = Pipeline(float_format="%.5g")
+    profiles = pipeline.read("plate.csv.gz")
+    profiles.feature_select(operation=["variance_threshold"])
+
+    ops = [x.op for x in pipeline.steps]
+    assert ops == ["read", "as_written", "feature_select"]
@@ -0,0 +1,108 @@
+import gzip
+import pandas as pd
+import pytest
+
+from consensus_builder import CsvAppender
+from group_executor import (
+    GroupExecutor,
+    check_groups,
+    feature_select_groups,
+    spherize_groups,
+    spherize_plate_groups,
+)
+from loader import iter_plates
+from spherize import apply_spherize, fit_spherize_plates, load_spherize, spherize
+
+features = ["Cells_a", "Cells_b", "Cytoplasm_c", "Nuclei_d"]
+read_kwargs = {"level": "level_4a"}
+
+
+def make_plates(make_profiles, cell_line, n_plates=3, n_rows=16):
+    return [
+        make_profiles(
+            n_rows,
+            features,
+            seed=len(cell_line) + plate,
+            Plate=f"{cell_line}_{plate}",
+            Well=[f"A{x:02d}" for x in range(n_rows)],
+            broad_sample=["DMSO", "BRD-1"] * (n_rows // 2),
+            cell_line=cell_line,
+        )
+        for plate in range(n_plates)
+    ]
+
+
+def test_groups_match_groupby(make_profiles):
+    samples = "Metadata_broad_sample == 'DMSO'"
+    profile_df = pd.concat(
+        [
+            plate_df
+            for cell_line in ["MCF7", "A549"]
+            for plate_df in make_plates(make_profiles, cell_line)
+        ],
+        ignore_index=True,
+    )
+    group_executor = GroupExecutor(profile_df, ["Metadata_cell_line"], n_jobs=2)
+
+    selected = feature_select_groups(group_executor, operation="drop_na_columns")
+    assert selected == features
+
+    # Rows keep their input order, MCF7 plates first
+    spherize_df = spherize_groups(group_executor, features=features, samples=samples)
+    expected_df = pd.concat(
+        [
+            spherize(x, features=features, samples=samples)
+            for _, x in profile_df.groupby("Metadata_cell_line")
+        ]
+    ).sort_index()
+    pd.testing.assert_frame_equal(spherize_df, expected_df)
+    assert spherize_df.Metadata_cell_line.iloc[0] == "MCF7"
+
+    # Groups of plates from a manifest must be the groups of the profiles
+    check_groups(group_executor, [{"Metadata_cell_line": x} for x in ["A549", "MCF7"]])
+    with pytest.raises(ValueError):
+        check_groups(group_executor, [{"Metadata_cell_line": "A549"}])
+
+
+def test_spherize_plate_groups_matches_serial(tmp_path, make_profiles, write_plates):
+    samples = "Metadata_broad_sample == 'DMSO'"
+    group_plates = [
+        ({"Metadata_cell_line": x}, write_plates(make_plates(make_profiles, x)))
+        for x in ["A549", "MCF7"]
+    ]
+    transform_files = [tmp_path / f"{x}.npz" for x in ["A549", "MCF7"]]
+    compression_options = {"method": "gzip", "mtime": 1}
+
+    output_file = tmp_path / "spherized.csv.gz"
+    spherize_plate_groups(
+        group_plates,
+        features=features,
+        output_file=output_file,
+        read_kwargs=read_kwargs,
+        transform_files=transform_files,
+        samples=samples,
+        compression_options=compression_options,
+        n_jobs=2,
+    )
+
+    serial_file = tmp_path / "serial.csv.gz"
+    with CsvAppender(serial_file, compression_options=compression_options) as appender:
+        for (group_keys, plate_files), transform_file in zip(
+            group_plates, transform_files
+        ):
+
+            def get_plates():
+                return iter_plates(plate_files, read_kwargs=read_kwargs)
+
+            fitted_spherize = fit_spherize_plates(
+                get_plates, features=features, samples=samples
+            )
+            for plate_df in get_plates():
+                appender.append(apply_spherize(fitted_spherize, plate_df, features))
+
+            _, saved_features, saved_keys, _ = load_spherize(transform_file)
+            assert saved_features == features
+            assert saved_keys == group_keys
+
+    with gzip.open(output_file, "rb") as output_fh, gzip.open(serial_file) as serial_fh:
+        assert output_fh.read() == serial_fh.read()
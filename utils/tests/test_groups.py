@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycytominer import consensus
+
+from groups import GroupIndex, get_group_index, median_consensus
+
+replicate_cols = ["Metadata_Plate_Map_Name", "Metadata_broad_sample"]
+
+
+@pytest.fixture
+def profile_df(make_profiles):
+    # Odd and even groups, and groups beyond the sorting network
+    samples = np.random.default_rng(6).choice([f"BRD-{x}" for x in range(10)], 90)
+    samples[:40] = "DMSO"
+    return make_profiles(
+        90,
+        ["Cells_a", "Cells_b", "Cytoplasm_c", "Nuclei_d", "Nuclei_e"],
+        seed=6,
+        Plate_Map_Name=["M1", "M2"] * 45,
+        broad_sample=samples,
+    )
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_median_consensus_matches_pycytominer(profile_df, dtype):
+    profile_df = profile_df.astype({x: dtype for x in profile_df.columns[2:]})
+    profile_df.iloc[5, 3] = np.nan
+
+    expected_df = consensus(
+        profile_df, replicate_columns=replicate_cols, operation="median"
+    )
+    pd.testing.assert_frame_equal(
+        median_consensus(profile_df, replicate_cols), expected_df, check_dtype=False
+    )
+
+
+def test_group_index_is_cached_per_frame(profile_df):
+    group_index = get_group_index(profile_df, replicate_cols)
+    assert get_group_index(profile_df, replicate_cols) is group_index
+    assert get_group_index(profile_df.copy(), replicate_cols) is not group_index
+
+    expected = profile_df.groupby(replicate_cols).size().to_numpy()
+    np.testing.assert_array_equal(group_index.sizes, expected)
+    assert isinstance(group_index, GroupIndex)
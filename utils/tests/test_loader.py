@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+import loader
+from loader import iter_plates, load_plates
+from schema import read_profiles
+
+
+@pytest.fixture
+def profile_files(make_profiles, write_plates):
+    return write_plates(
+        make_profiles(
+            n_rows,
+            ["Cells_a", "Cytoplasm_b", "Nuclei_c"],
+            seed=plate,
+            Plate=f"P{plate}",
+            Well=[f"A{x:02d}" for x in range(n_rows)],
+            broad_sample="DMSO",
+        )
+        for plate, n_rows in enumerate([5, 9, 3])
+    )
+
+
+@pytest.mark.parametrize("rows_per_plate", [384, 2])
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_load_plates_matches_concat(
+    profile_files, monkeypatch, rows_per_plate, executor
+):
+    # Plates larger than the expected size grow the preallocated matrix
+    monkeypatch.setattr(loader, "rows_per_plate", rows_per_plate)
+    read_kwargs = {"level": "level_4a"}
+
+    expected_df = pd.concat(
+        [read_profiles(x, **read_kwargs) for x in profile_files], ignore_index=True
+    )
+    profile_df = load_plates(
+        profile_files, read_kwargs=read_kwargs, n_jobs=2, executor=executor
+    )
+    pd.testing.assert_frame_equal(profile_df, expected_df)
+
+    plates = iter_plates(profile_files, read_kwargs=read_kwargs, max_in_flight=1)
+    assert [x.Metadata_Plate[0] for x in plates] == ["P0", "P1", "P2"]
+
+
+def test_load_plates_checks_features(profile_files):
+    pd.read_csv(profile_files[1]).drop("Nuclei_c", axis="columns").to_csv(
+        profile_files[1], index=False
+    )
+    with pytest.raises(ValueError):
+        load_plates(profile_files, read_kwargs={"level": "level_4a"})
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycytominer import consensus
+
+from modz import modz_consensus
+
+replicate_cols = ["Metadata_Plate_Map_Name", "Metadata_broad_sample"]
+
+
+@pytest.fixture
+def profile_df(make_profiles):
+    # Groups of one to many replicates
+    samples = np.random.default_rng(5).choice([f"BRD-{x}" for x in range(8)], 64)
+    samples[:20] = "DMSO"
+    samples[-1] = "BRD-single"
+    return make_profiles(
+        64,
+        [f"Cells_{x}" for x in "abc"] + [f"Nuclei_{x}" for x in "def"],
+        seed=5,
+        Plate_Map_Name=["M1", "M2"] * 32,
+        broad_sample=samples,
+    )
+
+
+@pytest.mark.parametrize("method", ["spearman", "pearson"])
+def test_modz_consensus_matches_pycytominer(profile_df, method):
+    expected_df = consensus(
+        profile_df,
+        replicate_columns=replicate_cols,
+        operation="modz",
+        modz_args={"method": method},
+    )
+    consensus_df = modz_consensus(
+        profile_df, replicate_cols, method=method, block_elements=64
+    )
+    pd.testing.assert_frame_equal(consensus_df, expected_df)
+
+
+def test_modz_consensus_with_missing_values(profile_df):
+    profile_df.iloc[2, 3] = np.nan
+    expected_df = consensus(
+        profile_df, replicate_columns=replicate_cols, operation="modz"
+    )
+    pd.testing.assert_frame_equal(
+        modz_consensus(profile_df, replicate_cols), expected_df
+    )
@@ -0,0 +1,24 @@
+import pandas as pd
+import pytest
+
+from pycytominer import normalize
+
+from normalization import avail_methods, normalize_variants
+
+samples = {"whole_plate": "all", "dmso": "Metadata_broad_sample == 'DMSO'"}
+
+
+@pytest.mark.parametrize("method", avail_methods)
+def test_normalize_variants_matches_pycytominer(make_profiles, method):
+    profile_df = make_profiles(
+        40,
+        seed=2,
+        lognormal=True,
+        Well=[f"A{x:02d}" for x in range(40)],
+        broad_sample=["DMSO", "BRD-1"] * 20,
+    )
+    normalized = normalize_variants(profile_df, samples=samples, methods=[method])
+
+    for sample_name, sample_query in samples.items():
+        expected_df = normalize(profile_df, samples=sample_query, method=method)
+        pd.testing.assert_frame_equal(normalized[(sample_name, method)], expected_df)
@@ -0,0 +1,87 @@
+import sys
+import runpy
+import pathlib
+import numpy as np
+import pandas as pd
+
+import catalog
+from normalization import mad_scale
+from outlier_features import (
+    accumulate_outlier_stats,
+    extreme_cutoff,
+    get_outlier_evidence,
+    mad_collapse_cutoff,
+)
+
+features = [f"Cells_{x}" for x in range(5)] + [f"Nuclei_{x}" for x in range(5)]
+script = (
+    pathlib.Path(__file__).resolve().parents[2]
+    / "profiles"
+    / "detect_outlier_features.py"
+)
+
+
+def make_plates(make_profiles, n_plates=4, n_rows=40):
+    plate_dfs = []
+    for plate in range(n_plates):
+        plate_df = make_profiles(
+            n_rows,
+            features,
+            seed=plate,
+            Plate=f"P{plate}",
+            Well=[f"A{x:02d}" for x in range(n_rows)],
+        )
+
+        # An outlier feature with a few huge z-scores on every plate
+        plate_df.loc[[3, 17], "Cells_2"] = [2e4, -60]
+
+        # A feature whose MAD collapses on half of the plates
+        if plate % 2 == 0:
+            plate_df.loc[:, "Nuclei_4"] = 0.5
+            plate_df.loc[0, "Nuclei_4"] = 3
+        plate_df.loc[5, "Nuclei_1"] = np.nan
+        plate_dfs.append(plate_df)
+    return plate_dfs
+
+
+def test_streamed_stats_match_batch(make_profiles):
+    plate_dfs = make_plates(make_profiles)
+    stats_features, stats = accumulate_outlier_stats(iter(plate_dfs))
+    assert stats_features == features
+
+    # The statistics of the whole batch in memory, and the plate MADs
+    batch_df = pd.concat(plate_dfs, ignore_index=True)
+    abs_df = batch_df.loc[:, features].abs()
+    mad_df = batch_df.groupby("Metadata_Plate")[features].agg(
+        lambda x: mad_scale * (x - x.median()).abs().median()
+    )
+    np.testing.assert_array_equal(stats.n_values, abs_df.notna().sum())
+    np.testing.assert_array_equal(stats.n_extreme, (abs_df > extreme_cutoff).sum())
+    np.testing.assert_array_equal(stats.max_abs_z, abs_df.max())
+    np.testing.assert_array_equal(stats.n_plates, [len(plate_dfs)] * len(features))
+    np.testing.assert_array_equal(
+        stats.n_mad_collapsed, (mad_df < mad_collapse_cutoff).sum()
+    )
+
+    evidence_df = get_outlier_evidence(stats_features, stats)
+    assert evidence_df.query("proposed").feature.tolist() == ["Cells_2", "Nuclei_4"]
+    assert evidence_df.reasons.iloc[:2].tolist() == [
+        "extreme_fraction;max_abs_z",
+        "mad_collapse_fraction",
+    ]
+
+
+def test_detect_outlier_features_script(
+    tmp_path, monkeypatch, make_profiles, write_plates
+):
+    profile_files = write_plates(make_plates(make_profiles))
+    monkeypatch.setattr(
+        catalog, "get_plate_files", lambda batch, level, normalization: profile_files
+    )
+    monkeypatch.setattr(
+        sys, "argv", [str(script), "--batch", "batch", "--output_dir", str(tmp_path)]
+    )
+    runpy.run_path(str(script))
+
+    blocklist_file = tmp_path / "batch_dmso_outlier_blocklist_features.txt"
+    assert blocklist_file.read_text() == "Cells_2\nNuclei_4\n"
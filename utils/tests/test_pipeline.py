@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from pipeline import Pipeline
+
+
+def test_plan_shares_and_merges_steps(tmp_path):
+    profile_file = tmp_path / "plate.csv"
+    pd.DataFrame(
+        {"Metadata_Well": ["A01", "A02"], "Cells_a": [0.1, 0.2], "Nuclei_b": [1.0, 2.0]}
+    ).to_csv(profile_file, index=False)
+
+    pipeline = Pipeline()
+    for samples in ["Metadata_broad_sample == 'DMSO'", "all"]:
+        pipeline.read(profile_file).normalize(samples=samples).output(
+            tmp_path / f"{samples == 'all'}.csv"
+        )
+
+    steps, log = pipeline.optimize()
+    assert [x.op for x in steps.values()] == ["read", "normalize", "output", "output"]
+    assert log == ["shared 1 repeated step(s)", "merged 2 normalize steps into [1]"]
+
+    # The read step keeps every column of the file
+    read_step = next(x for x in steps.values() if x.op == "read")
+    assert set(read_step.params) == {"profile_file", "feature_dtype"}
+    assert read_step.params["feature_dtype"] == np.float64
@@ -0,0 +1,244 @@
+import sys
+import gzip
+import pathlib
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycytominer.cyto_utils import output
+
+import consensus_update
+from consensus_builder import build_consensus, prepare_profiles, split_platemaps
+from feature_selection import feature_select
+from loader import load_plates
+from schema import read_profile_columns, read_profiles
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "consensus"))
+import run_consensus
+
+blocklist_file = pathlib.Path(__file__).resolve().parents[1] / "consensus_blocklist.txt"
+
+
+features = [f"Cells_{x}" for x in "abcd"] + [f"Nuclei_{x}" for x in "efgh"]
+
+
+def make_plates(make_profiles, n_plates=4, n_rows=32):
+    rng = np.random.default_rng(0)
+    plate_dfs = []
+    for plate in range(n_plates):
+        samples = rng.choice(["DMSO", "BRD-1", "BRD-2", "BRD-3"], n_rows)
+        plate_df = make_profiles(
+            n_rows,
+            features,
+            seed=plate,
+            Plate=f"P{plate}",
+            Well=[f"A{x:02d}" for x in range(n_rows)],
+            Plate_Map_Name=f"M{plate % 2}",
+            cell_id="A549",
+            broad_sample=samples,
+            pert_well=[f"A{x:02d}" for x in range(n_rows)],
+            mmoles_per_liter=np.where(samples == "DMSO", 0, 10 / 3),
+            dose_recode=np.where(samples == "DMSO", 0, 5),
+            time_point="48H",
+            moa="unknown",
+            target="unknown",
+        )
+
+        # A correlated pair for feature selection to drop
+        plate_df["Nuclei_h"] = plate_df.Cells_a + rng.normal(scale=0.05, size=n_rows)
+        plate_dfs.append(plate_df)
+    return plate_dfs
+
+
+def read_batch(make_profiles, write_plates):
+    plate_files = write_plates(make_plates(make_profiles))
+    return load_plates(plate_files, read_kwargs={"level": "level_4a"})
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_run_grid_matches_notebook(tmp_path, make_profiles, write_plates, n_jobs):
+    profile_df = read_batch(make_profiles, write_plates)
+    operations = ["median", "modz"]
+
+    def get_files(output_dir, operation):
+        return {
+            "consensus_file": output_dir / f"consensus_{operation}.csv.gz",
+            "feature_select_file": output_dir / f"consensus_{operation}_fs.csv.gz",
+            "qc_files": {operation: output_dir / f"consensus_{operation}_qc.csv.gz"},
+        }
+
+    tasks = []
+    for operation in operations:
+        task = get_files(tmp_path / "grid", operation)
+        task["qc_files"] = task["qc_files"] if operation == "modz" else {}
+        tasks.append({"operation": operation, "blocklist_file": blocklist_file, **task})
+    grid = [(("batch", "dmso"), split_platemaps(profile_df), tasks, None)]
+    run_consensus.run_grid(grid, tmp_path / "store", n_jobs=n_jobs)
+
+    # The notebook computes every operation in one pass over the platemaps
+    expected = {x: get_files(tmp_path / "notebook", x) for x in operations}
+    (tmp_path / "notebook").mkdir()
+    consensus_dfs = build_consensus(
+        split_platemaps(profile_df),
+        replicate_cols=run_consensus.replicate_cols,
+        operations=operations,
+        output_files={x: expected[x]["consensus_file"] for x in operations},
+        float_format=run_consensus.float_format,
+        compression_options=run_consensus.compression_options,
+        qc_files=expected["modz"]["qc_files"],
+    )
+    for operation in operations:
+        output(
+            df=feature_select(
+                profiles=consensus_dfs[operation],
+                features="infer",
+                operation=run_consensus.feature_select_ops,
+                blocklist_file=blocklist_file,
+            ),
+            output_filename=expected[operation]["feature_select_file"],
+            sep=",",
+            float_format=run_consensus.float_format,
+            compression_options=run_consensus.compression_options,
+        )
+
+    for operation, task in zip(operations, tasks):
+        for key in ["consensus_file", "feature_select_file"]:
+            with gzip.open(task[key]) as grid_fh:
+                with gzip.open(expected[operation][key]) as expected_fh:
+                    assert grid_fh.read() == expected_fh.read()
+
+    with gzip.open(tasks[1]["qc_files"]["modz"]) as grid_fh:
+        with gzip.open(expected["modz"]["qc_files"]["modz"]) as expected_fh:
+            assert grid_fh.read() == expected_fh.read()
+
+
+def get_tasks(output_dir, operations=("median", "modz")):
+    return [
+        {
+            "operation": x,
+            "consensus_file": output_dir / f"consensus_{x}.csv.gz",
+            "feature_select_file": output_dir / f"consensus_{x}_fs.csv.gz",
+            "values_file": output_dir / f"consensus_{x}_values.npz",
+            "blocklist_file": blocklist_file,
+            "qc_files": (
+                {x: output_dir / f"consensus_{x}_qc.csv.gz"} if x == "modz" else {}
+            ),
+        }
+        for x in operations
+    ]
+
+
+def patch_catalog(monkeypatch, plate_files):
+    """Serve plate_files as the level_4a profiles of every batch"""
+    plates_df = pd.concat(
+        [
+            pd.read_csv(x, usecols=["Metadata_Plate", "Metadata_Plate_Map_Name"])
+            .iloc[:1]
+            .assign(file=x)
+            for x in plate_files
+        ],
+        ignore_index=True,
+    )
+
+    def get_plate_checksums(batch, level, normalization):
+        return plates_df.loc[:, ["Metadata_Plate", "Metadata_Plate_Map_Name"]].assign(
+            checksum=[consensus_update.get_checksum(x) for x in plates_df.file]
+        )
+
+    def iter_platemap_profiles(
+        batch, level, normalization, feature_dtype=np.float64, where=None
+    ):
+        platemaps_df = plates_df if where is None else plates_df.query(where)
+        for platemap, platemap_df in platemaps_df.groupby("Metadata_Plate_Map_Name"):
+            profile_df = load_plates(
+                platemap_df.file.tolist(),
+                read_kwargs={"level": level, "feature_dtype": feature_dtype},
+            )
+            yield platemap, profile_df.reset_index(drop=True)
+
+    monkeypatch.setattr(run_consensus, "get_plate_checksums", get_plate_checksums)
+    monkeypatch.setattr(consensus_update, "get_plate_checksums", get_plate_checksums)
+    monkeypatch.setattr(
+        consensus_update, "iter_platemap_profiles", iter_platemap_profiles
+    )
+    return iter_platemap_profiles
+
+
+def build_grid(iter_platemap_profiles, output_dir, store_dir):
+    tasks = get_tasks(output_dir)
+    state_file = output_dir / "consensus_state.csv.gz"
+    platemap_profiles = iter_platemap_profiles("batch", "level_4a", "dmso")
+    grid = [
+        (
+            ("batch", "dmso"),
+            prepare_profiles(platemap_profiles, "batch"),
+            tasks,
+            state_file,
+        )
+    ]
+    run_consensus.run_grid(grid, store_dir, n_jobs=1)
+    return tasks, state_file
+
+
+@pytest.mark.parametrize("reprocess", ["rescale", "decorrelate"])
+def test_update_matches_rebuild(
+    tmp_path, monkeypatch, make_profiles, write_plates, reprocess
+):
+    plate_dfs = make_plates(make_profiles)
+    iter_platemap_profiles = patch_catalog(monkeypatch, write_plates(plate_dfs))
+    tasks, state_file = build_grid(
+        iter_platemap_profiles, tmp_path / "build", tmp_path / "store"
+    )
+
+    # Reprocess plate P1, keeping or changing the feature selection decisions
+    if reprocess == "rescale":
+        plate_dfs[1].loc[:, features] *= 1 + 1e-6
+    else:
+        plate_dfs[1]["Nuclei_h"] = np.random.default_rng(1).normal(
+            scale=10, size=plate_dfs[1].shape[0]
+        )
+    write_plates(plate_dfs)
+    selected = [read_profile_columns(x["feature_select_file"]) for x in tasks]
+
+    feature_select_calls = []
+
+    def feature_select(*args, **kwargs):
+        feature_select_calls.append(kwargs["operation"])
+        return run_consensus.feature_select(*args, **kwargs)
+
+    monkeypatch.setattr(consensus_update, "feature_select", feature_select)
+    run_consensus.run_update("batch", "dmso", tasks, state_file)
+    assert len(feature_select_calls) == (0 if reprocess == "rescale" else 2)
+    for task, columns in zip(tasks, selected):
+        changed = read_profile_columns(task["feature_select_file"]) != columns
+        assert changed == (reprocess == "decorrelate")
+
+    rebuild_tasks, rebuild_state_file = build_grid(
+        iter_platemap_profiles, tmp_path / "rebuild", tmp_path / "rebuild_store"
+    )
+    for task, rebuild_task in zip(tasks, rebuild_tasks):
+        files = [task["consensus_file"], task["feature_select_file"]]
+        rebuild_files = [
+            rebuild_task["consensus_file"],
+            rebuild_task["feature_select_file"],
+        ]
+        files += list(task["qc_files"].values())
+        rebuild_files += list(rebuild_task["qc_files"].values())
+        for update_file, rebuild_file in zip(files, rebuild_files):
+            with gzip.open(update_file) as update_fh:
+                with gzip.open(rebuild_file) as rebuild_fh:
+                    assert update_fh.read() == rebuild_fh.read()
+
+        update_values = consensus_update.read_values(task["values_file"])
+        rebuild_values = consensus_update.read_values(rebuild_task["values_file"])
+        assert update_values[0] == rebuild_values[0]
+        np.testing.assert_array_equal(update_values[1], rebuild_values[1])
+
+    # QC tables are spliced with numeric replicate counts and correlations
+    qc_df = read_profiles(tasks[1]["qc_files"]["modz"], level="level_5")
+    assert qc_df.Metadata_n_replicates.dtype == np.int64
+    assert qc_df.Metadata_mean_replicate_correlation.dtype == np.float64
+
+    with gzip.open(state_file) as update_fh:
+        with gzip.open(rebuild_state_file) as rebuild_fh:
+            assert update_fh.read() == rebuild_fh.read()
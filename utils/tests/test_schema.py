@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from schema import read_profiles
+
+
+def write_plate(path):
+    profile_df = pd.DataFrame(
+        {
+            "Cells_a": [1.5, 2.5, 3.5, 4.5],
+            "Metadata_broad_sample": ["DMSO", "BRD-1", "DMSO", "BRD-2"],
+            "Metadata_Well": ["A01", "A02", "A03", "A04"],
+            "Metadata_Plate": ["P1"] * 4,
+            "Metadata_mmoles_per_liter": [0, 1.11, 0, 3.33],
+            "Nuclei_b": [0.25, 0.5, 0.75, 1.0],
+        }
+    )
+    profile_df.to_csv(path, index=False)
+    return profile_df
+
+
+def test_read_profiles_keeps_file_order(tmp_path):
+    profile_file = tmp_path / "plate.csv"
+    expected_df = write_plate(profile_file)
+
+    profile_df = read_profiles(profile_file, level="level_4a", feature_dtype=np.float64)
+    pd.testing.assert_frame_equal(profile_df, expected_df, check_dtype=False)
+    assert profile_df.dtypes["Cells_a"] == np.float64
+    assert profile_df.dtypes["Metadata_mmoles_per_liter"] == np.float64
+
+
+def test_read_profiles_schema_order(tmp_path):
+    profile_file = tmp_path / "plate.csv"
+    write_plate(profile_file)
+
+    profile_df = read_profiles(profile_file, level="level_4a", schema_order=True)
+    assert profile_df.columns.tolist() == [
+        "Metadata_Plate",
+        "Metadata_Well",
+        "Metadata_broad_sample",
+        "Metadata_mmoles_per_liter",
+        "Cells_a",
+        "Nuclei_b",
+    ]
+
+
+def test_read_profiles_chunks_without_projection(tmp_path):
+    profile_file = tmp_path / "plate.csv"
+    expected_df = write_plate(profile_file)
+
+    for schema_order in [False, True]:
+        chunks = read_profiles(
+            profile_file,
+            level="level_4a",
+            feature_dtype=np.float64,
+            schema_order=schema_order,
+            chunksize=3,
+        )
+        chunk_dfs = list(chunks)
+        assert [x.shape[0] for x in chunk_dfs] == [3, 1]
+
+        profile_df = pd.concat(chunk_dfs, ignore_index=True)
+        pd.testing.assert_frame_equal(
+            profile_df.loc[:, expected_df.columns], expected_df, check_dtype=False
+        )
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycytominer import normalize
+
+from spherize import (
+    apply_spherize,
+    fit_spherize_plates,
+    load_spherize,
+    save_spherize,
+    get_plate_r2,
+    spherize,
+    spherize_plates,
+    sweep_spherize_plates,
+)
+
+features = [f"Cells_{x}" for x in range(6)] + [f"Nuclei_{x}" for x in range(6)]
+samples = "Metadata_broad_sample == 'DMSO'"
+
+
+def make_plates(make_profiles, n_plates=4, n_rows=16):
+    # Correlated features, shifted per plate
+    mixing = np.random.default_rng(7).normal(size=(len(features), len(features)))
+    plate_dfs = []
+    for plate in range(n_plates):
+        plate_df = make_profiles(
+            n_rows,
+            features,
+            seed=plate,
+            Plate=f"P{plate}",
+            broad_sample=["DMSO", "BRD-1"] * (n_rows // 2),
+        )
+        plate_df.loc[:, features] = (
+            plate_df.loc[:, features].to_numpy() @ mixing + plate
+        )
+        plate_dfs.append(plate_df)
+    return plate_dfs
+
+
+@pytest.mark.parametrize("method", ["ZCA", "ZCA-cor"])
+@pytest.mark.parametrize("n_plates", [4, 1])
+def test_spherize_plates_matches_pycytominer(make_profiles, method, n_plates):
+    # One plate has fewer DMSO profiles than features
+    plate_dfs = make_plates(make_profiles, n_plates=n_plates)
+    expected_df = normalize(
+        pd.concat(plate_dfs, ignore_index=True),
+        features=features,
+        samples=samples,
+        method="spherize",
+        spherize_method=method,
+    )
+
+    spherize_df = pd.concat(
+        spherize_plates(
+            lambda: iter(plate_dfs), features=features, samples=samples, method=method
+        ),
+        ignore_index=True,
+    )
+    pd.testing.assert_frame_equal(spherize_df, expected_df, rtol=1e-6, atol=1e-6)
+
+
+def test_spherize_keeps_feature_dtype(make_profiles):
+    profile_df = pd.concat(make_plates(make_profiles), ignore_index=True)
+    expected_df = normalize(profile_df, samples=samples, method="spherize")
+
+    spherize_df = spherize(
+        profile_df.astype({x: np.float32 for x in features}), samples=samples
+    )
+    assert (spherize_df.dtypes[features] == np.float32).all()
+    pd.testing.assert_frame_equal(
+        spherize_df, expected_df, check_dtype=False, rtol=1e-4, atol=1e-4
+    )
+
+
+def test_saved_transform_round_trip(tmp_path, make_profiles):
+    plate_dfs = make_plates(make_profiles)
+    fitted_spherize = fit_spherize_plates(
+        lambda: iter(plate_dfs), features=features, samples=samples
+    )
+    group_keys = {"Metadata_cell_line": "A549"}
+    transform_file = tmp_path / "transform.npz"
+    save_spherize(
+        fitted_spherize,
+        transform_file,
+        features=features,
+        group_keys=group_keys,
+        samples=samples,
+    )
+
+    loaded_spherize, loaded_features, loaded_keys, loaded_samples = load_spherize(
+        transform_file
+    )
+    assert (loaded_features, loaded_keys, loaded_samples) == (
+        features,
+        group_keys,
+        samples,
+    )
+    for plate_df in plate_dfs:
+        pd.testing.assert_frame_equal(
+            apply_spherize(loaded_spherize, plate_df, features),
+            apply_spherize(fitted_spherize, plate_df, features),
+        )
+
+
+def test_sweep_matches_spherized_plates(make_profiles):
+    plate_dfs = make_plates(make_profiles)
+    methods = ["ZCA", "ZCA-cor", "PCA-cor"]
+    epsilons = [1e-6, 1e-2]
+    sweep_df = sweep_spherize_plates(
+        lambda: iter(plate_dfs),
+        features=features,
+        samples=samples,
+        methods=methods,
+        epsilons=epsilons,
+    )
+    assert sweep_df.shape[0] == 1 + len(methods) * len(epsilons)
+
+    # Each variant's batch effect, from the DMSO profiles spherized by a full fit
+    for method in methods:
+        for epsilon in epsilons:
+            spherized_x = [
+                x.query(samples).iloc[:, 2:].to_numpy()
+                for x in spherize_plates(
+                    lambda: iter(plate_dfs),
+                    features=features,
+                    samples=samples,
+                    method=method,
+                    epsilon=epsilon,
+                )
+            ]
+            expected_r2 = get_plate_r2(
+                [len(x) for x in spherized_x],
+                np.stack([x.sum(axis=0) for x in spherized_x]),
+                np.stack([(x**2).sum(axis=0) for x in spherized_x]),
+            )
+            plate_r2 = sweep_df.query("method == @method and epsilon == @epsilon")
+            np.testing.assert_allclose(plate_r2.plate_r2.item(), expected_r2)
+
+    # Spherizing reduces the plate effect of the reference profiles
+    none_r2 = sweep_df.query("method == 'none'").plate_r2.item()
+    assert (
+        sweep_df.plate_r2.drop(sweep_df.index[sweep_df.method == "none"]).max()
+        < none_r2
+    )
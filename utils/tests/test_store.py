@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from store import append_store, build_store, load_store, write_store
+
+features = ["Cells_a", "Cytoplasm_b", "Nuclei_c"]
+
+
+def get_plate(make_profiles, plate, n_rows=5):
+    return make_profiles(
+        n_rows,
+        features,
+        seed=len(plate),
+        Plate=plate,
+        Well=[f"A{x:02d}" for x in range(n_rows)],
+        broad_sample="DMSO",
+    )
+
+
+def test_build_store_with_features(tmp_path, make_profiles, write_plates):
+    profile_files = write_plates(
+        [get_plate(make_profiles, "P1"), get_plate(make_profiles, "P22", n_rows=3)]
+    )
+
+    store_features = ["Nuclei_c", "Cells_a"]
+    build_store(
+        profile_files, tmp_path / "store", level="level_4a", features=store_features
+    )
+    store = load_store(tmp_path / "store")
+
+    expected_x = pd.concat([pd.read_csv(x) for x in profile_files])
+    expected_x = expected_x.loc[:, store_features].to_numpy()
+    assert store.features == store_features
+    assert store.matrix.dtype == np.float64
+    np.testing.assert_array_equal(store.matrix, expected_x)
+    assert store.metadata.Metadata_Plate.tolist() == ["P1"] * 5 + ["P22"] * 3
+
+
+def test_write_store_round_trip(tmp_path, make_profiles):
+    plate_df = get_plate(make_profiles, "P1")
+    write_store(plate_df, tmp_path / "store", dtype=np.float32)
+
+    store_df = load_store(tmp_path / "store").to_frame()
+    pd.testing.assert_frame_equal(
+        store_df,
+        plate_df.astype({x: np.float32 for x in features}),
+    )
+
+
+def test_build_store_with_dtype(tmp_path, make_profiles, write_plates):
+    profile_files = write_plates([get_plate(make_profiles, x) for x in ["P1", "P22"]])
+
+    build_store(profile_files, tmp_path / "store", level="level_4a", dtype=np.float32)
+    store = load_store(tmp_path / "store")
+    assert store.matrix.dtype == np.float32
+    assert store.matrix.shape == (10, 3)
+
+
+def test_append_store_without_profiles(tmp_path):
+    with pytest.raises(ValueError, match="No profiles"):
+        append_store(iter([]), tmp_path / "store", features=["Cells_a"])